@@ -0,0 +1,19 @@
+#!/usr/bin/python
+
+
+# Runs all the benchmark suites.
+
+import sys
+import benchmark
+import bench_promise
+import bench_http
+import bench_rejseplanen
+import bench_clock
+import bench_main
+import bench_gtfs
+import bench_columnar
+import bench_planner
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
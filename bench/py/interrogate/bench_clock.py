@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+
+import sys
+import benchmark
+import clock
+
+
+_COUNT = 10000
+
+
+# Returns a list of (date, time) string pairs covering a range of days and
+# times.
+def _get_date_times(count):
+  result = []
+  for i in range(0, count):
+    date = "%02i.%02i.14" % (1 + (i // 1440) % 28, 1 + (i // (1440 * 28)) % 12)
+    minute = i % 1440
+    result.append((date, "%02i:%02i" % (minute // 60, minute % 60)))
+  return result
+
+
+@benchmark.register("clock.from_date_time", ops=_COUNT)
+def bench_from_date_time():
+  date_times = _get_date_times(_COUNT)
+  def run():
+    for (date, time) in date_times:
+      clock.Timestamp.from_date_time(date, time)
+  return run
+
+
+@benchmark.register("clock.to_date_time", ops=_COUNT)
+def bench_to_date_time():
+  timestamps = [clock.Timestamp.from_date_time(d, t) for (d, t) in _get_date_times(_COUNT)]
+  def run():
+    for timestamp in timestamps:
+      clock.Timestamp.to_date(timestamp)
+      clock.Timestamp.to_time(timestamp)
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+
+import sys
+import os
+import benchmark
+import bench_rejseplanen
+import columnar
+import main
+import rejseplanen
+
+
+_JOURNEYS_PER_ROUTE = 400
+_ROUTES = 25
+_STOPS_PER_JOURNEY = 40
+_TRIPS = _JOURNEYS_PER_ROUTE * _ROUTES
+
+
+# The result the benchmarks write, built once since parsing its journeys
+# takes a while.
+_result = [None]
+
+
+# Returns a result with the given number of routes and journeys.
+def _get_result():
+  if not _result[0] is None:
+    return _result[0]
+  board = rejseplanen.DeparturesRequest().process_response("board",
+    bench_rejseplanen.get_board_text("DepartureBoard", "Departure", "finalStop",
+      1))
+  request = rejseplanen.JourneyRequest(bench_rejseplanen._REF,
+    board.get_departures()[0])
+  text = bench_rejseplanen.get_journey_text(_STOPS_PER_JOURNEY)
+  routes = {}
+  for i in range(0, _ROUTES):
+    name = "Bus %i" % i
+    route_text = text.replace("name=\"Bus 1\"", "name=\"%s\"" % name)
+    journeys = []
+    for j in range(0, _JOURNEYS_PER_ROUTE):
+      # Start the journeys a minute apart so they have different identities.
+      minute = 7 * 60 - j
+      start = "depTime=\"%02i:%02i\"" % (minute // 60, minute % 60)
+      journey_text = route_text.replace("depTime=\"07:00\"", start, 1)
+      journeys.append(request.process_response("journey", journey_text))
+    routes[name] = main.RouteInfo(name, journeys, [])
+  infos = rejseplanen.LocationRequest().process_response("location",
+    bench_rejseplanen.get_location_text(_STOPS_PER_JOURNEY)).get_stop_locations()
+  stops = dict((info.get_name(), info) for info in infos)
+  _result[0] = main.PipelineResult(routes, {}, [], stops)
+  return _result[0]
+
+
+@benchmark.register("columnar.write", ops=_TRIPS * _STOPS_PER_JOURNEY)
+def bench_write():
+  result = _get_result()
+  directory = os.path.join(benchmark.get_temp_dir(), "columnar.write")
+  def run():
+    columnar.write(directory, "01.10.14", result)
+  return run
+
+
+# Opening the timetable and reading a trip from the middle of it, which only
+# touches the pages it needs.
+@benchmark.register("columnar.load", ops=1)
+def bench_load():
+  directory = os.path.join(benchmark.get_temp_dir(), "columnar.load")
+  columnar.write(directory, "01.10.14", _get_result())
+  def run():
+    timetable = columnar.read(directory)
+    try:
+      assert timetable.get_trip_count() == _TRIPS
+      stop_times = timetable.get_trip_stop_times(_TRIPS // 2)
+      assert len(stop_times) == _STOPS_PER_JOURNEY
+    finally:
+      timetable.close()
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
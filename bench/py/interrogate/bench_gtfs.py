@@ -0,0 +1,47 @@
+#!/usr/bin/python
+
+
+import sys
+import shutil
+import tempfile
+import benchmark
+import bench_rejseplanen
+import clock
+import gtfs
+import rejseplanen
+
+
+_JOURNEYS = 500
+_STOPS_PER_JOURNEY = 40
+
+
+@benchmark.register("gtfs.write", ops=_JOURNEYS * _STOPS_PER_JOURNEY)
+def bench_write():
+  clock.set_timezone(rejseplanen.TIMEZONE)
+  text = bench_rejseplanen.get_journey_text(_STOPS_PER_JOURNEY)
+  board = rejseplanen.DeparturesRequest().process_response("board",
+    bench_rejseplanen.get_board_text("DepartureBoard", "Departure", "finalStop",
+      1))
+  request = rejseplanen.JourneyRequest(bench_rejseplanen._REF,
+    board.get_departures()[0])
+  # Different routes so the journeys have different identities.
+  journeys = [request.process_response("journey",
+      text.replace("\"Bus 1\"", "\"Bus %i\"" % i))
+    for i in range(0, _JOURNEYS)]
+  infos = rejseplanen.LocationRequest().process_response("location",
+    bench_rejseplanen.get_location_text(_STOPS_PER_JOURNEY)).get_stop_locations()
+  def run():
+    directory = tempfile.mkdtemp()
+    try:
+      writer = gtfs.GtfsWriter(directory)
+      writer.add_journeys(journeys)
+      writer.add_stops(infos)
+      writer.close()
+      assert writer.trip_count == _JOURNEYS
+    finally:
+      shutil.rmtree(directory)
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+
+import sys
+import os
+import itertools
+import benchmark
+import http
+import stub
+
+
+_COUNT = 1000
+_counter = itertools.count()
+
+
+# Returns a list of (url, response) pairs that look like real departure boards.
+def _get_responses(count):
+  network = stub.SyntheticNetwork(routes=20, stops_per_route=10)
+  base_url = "http://localhost"
+  result = []
+  for i in range(0, count):
+    stop = network.stops[i % len(network.stops)]
+    params = {"id": stop.id, "date": "01.10.14", "time": "%02i:%02i" % (i % 24, i % 60)}
+    url = "%s/departureBoard?id=%s&date=01.10.14&time=%s&n=%i" % (base_url,
+      stop.id, params["time"], i)
+    response = network.get_response(base_url, "departureBoard", params)
+    result.append((url, unicode(response)))
+  return result
+
+
+_RESPONSES = []
+
+
+def _get_shared_responses():
+  if len(_RESPONSES) == 0:
+    _RESPONSES.extend(_get_responses(_COUNT))
+  return _RESPONSES
+
+
+# Returns a fresh cache file name.
+def _new_cache_file():
+  return os.path.join(benchmark.get_temp_dir(), "cache%i.db" % next(_counter))
+
+
+# Returns a new cache file that has been populated with the shared responses.
+def _new_populated_cache_file():
+  filename = _new_cache_file()
+  cache = http.HttpRequestCache(filename)
+  for (index, (url, response)) in enumerate(_get_shared_responses()):
+    cache.add_response(index, url, response)
+  cache.close()
+  return filename
+
+
+@benchmark.register("http_cache.add", ops=_COUNT)
+def bench_add():
+  responses = _get_shared_responses()
+  cache = http.HttpRequestCache(_new_cache_file())
+  def run():
+    for (index, (url, response)) in enumerate(responses):
+      cache.add_response(index, url, response)
+    cache.close()
+  return run
+
+
+@benchmark.register("http_cache.get", ops=_COUNT)
+def bench_get():
+  responses = _get_shared_responses()
+  cache = http.HttpRequestCache(_new_populated_cache_file())
+  # Wait for priming to complete.
+  cache.get_latest_timestamp()
+  def run():
+    for (url, response) in responses:
+      assert cache.get_response(url) == response
+    cache.close()
+  return run
+
+
+@benchmark.register("http_cache.prime", ops=_COUNT)
+def bench_prime():
+  filename = _new_populated_cache_file()
+  def run():
+    cache = http.HttpRequestCache(filename)
+    # Priming happens on the owner thread before any requests are served so
+    # this blocks until it is done.
+    cache.get_latest_timestamp()
+    cache.close()
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+
+import sys
+import os
+import random
+import itertools
+import yaml
+import benchmark
+import clock
+import main
+import stub
+
+
+_RANGES = 2000
+_counter = itertools.count()
+
+
+@benchmark.register("coverage.add_range", ops=_RANGES)
+def bench_add_range():
+  rand = random.Random(8600)
+  ranges = []
+  for i in range(0, _RANGES):
+    start = rand.randint(0, 1000000)
+    ranges.append((start, start + rand.randint(0, 100)))
+  def run():
+    tracker = main.CoverageTracker()
+    for (start, end) in ranges:
+      tracker.add_range(start, end)
+      tracker.get_next_uncovered(start, end + 1)
+  return run
+
+
+# Many small ranges spread over a week, about what a board fetched in short
+# windows over a long time range accumulates.
+_MANY_RANGES = 20000
+
+
+def _get_many_ranges():
+  rand = random.Random(4325)
+  ranges = []
+  for i in range(0, _MANY_RANGES):
+    start = rand.randint(0, 7 * main.DAY_IN_MILLIS)
+    ranges.append((start, start + rand.randint(0, 10 * main.MIN_IN_MILLIS)))
+  return ranges
+
+
+@benchmark.register("coverage.add_range_many", ops=_MANY_RANGES)
+def bench_add_range_many():
+  ranges = _get_many_ranges()
+  def run():
+    tracker = main.CoverageTracker()
+    for (start, end) in ranges:
+      tracker.add_range(start, end)
+      tracker.get_next_uncovered(start, end + 1)
+  return run
+
+
+@benchmark.register("coverage.get_uncovered", ops=_RANGES)
+def bench_get_uncovered():
+  tracker = main.CoverageTracker(_get_many_ranges())
+  rand = random.Random(2354)
+  queries = []
+  for i in range(0, _RANGES):
+    start = rand.randint(0, 7 * main.DAY_IN_MILLIS)
+    queries.append((start, start + main.HOUR_IN_MILLIS))
+  def run():
+    for (start, end) in queries:
+      tracker.get_uncovered(start, end)
+  return run
+
+
+# The fixture backend shared by all pipeline benchmarks.
+_FIXTURE = []
+
+
+def _get_fixture():
+  if len(_FIXTURE) == 0:
+    network = stub.SyntheticNetwork(routes=20, stops_per_route=15, headway=20)
+    server = stub.StubServer().start()
+    server.set_backend(stub.SyntheticBackend(network, server.get_base_url()))
+    _FIXTURE.append((network, server))
+  return _FIXTURE[0]
+
+
+# Writes a config for running the pipeline against the fixture backend using
+# the given http cache and returns the arguments to pass to the pipeline.
+def _get_pipeline_args(http_cache):
+  (network, server) = _get_fixture()
+  config = stub.get_synthetic_config(network, server.get_base_url(), "01.10.14",
+    http_cache)
+  config["time_range"] = {"start": "06:00", "end": "10:00"}
+  config_file = os.path.join(benchmark.get_temp_dir(), "config%i.yaml" % next(_counter))
+  with open(config_file, "wt") as file:
+    yaml.safe_dump(config, file)
+  return ["--config", config_file]
+
+
+def _run_pipeline(args):
+  interrogate = main.Interrogate(args)
+  try:
+    result = interrogate._interrogate()
+    assert len(result.routes) > 0
+  finally:
+    interrogate._close()
+
+
+# Runs the pipeline from scratch, fetching everything from the fixture backend.
+@benchmark.register("pipeline.cold")
+def bench_pipeline_cold():
+  http_cache = os.path.join(benchmark.get_temp_dir(), "cache%i.db" % next(_counter))
+  args = _get_pipeline_args(http_cache)
+  return lambda: _run_pipeline(args)
+
+
+# Runs the pipeline with every response already in the http cache.
+@benchmark.register("pipeline.warm")
+def bench_pipeline_warm():
+  http_cache = os.path.join(benchmark.get_temp_dir(), "cache%i.db" % next(_counter))
+  args = _get_pipeline_args(http_cache)
+  _run_pipeline(args)
+  return lambda: _run_pipeline(args)
+
+
+# Resumes the pipeline from the checkpoint of a run that got to the end, which
+# compared to the warm run leaves out parsing the responses again.
+@benchmark.register("pipeline.resume")
+def bench_pipeline_resume():
+  http_cache = os.path.join(benchmark.get_temp_dir(), "cache%i.db" % next(_counter))
+  args = _get_pipeline_args(http_cache) + ["--checkpoint-interval", "0.001"]
+  _run_pipeline(args)
+  return lambda: _run_pipeline(args + ["--resume"])
+
+
+_EXPLAINED = []
+
+
+# Returns the interrogation and result of a run of the pipeline against the
+# fixture, along with the start and end of its time range.
+def _get_explained_run():
+  if len(_EXPLAINED) == 0:
+    http_cache = os.path.join(benchmark.get_temp_dir(), "cache%i.db" % next(_counter))
+    interrogate = main.Interrogate(_get_pipeline_args(http_cache))
+    try:
+      result = interrogate._interrogate()
+    finally:
+      interrogate._close()
+    start = clock.Timestamp.from_date_time("01.10.14", "06:00")
+    end = clock.Timestamp.from_date_time("01.10.14", "10:00")
+    _EXPLAINED.append((interrogate, result, start, end))
+  return _EXPLAINED[0]
+
+
+# Finds the unexplained transits by comparing all boards against all journeys,
+# which is what checking a turn used to cost.
+@benchmark.register("unexplained.result", ops=10)
+def bench_unexplained_result():
+  (interrogate, result, start, end) = _get_explained_run()
+  def run():
+    for i in range(0, 10):
+      result.get_unexplained_transits(start, end)
+  return run
+
+
+# Finds the unexplained transits using the index kept up as the pipeline runs.
+@benchmark.register("unexplained.index", ops=10)
+def bench_unexplained_index():
+  (interrogate, result, start, end) = _get_explained_run()
+  def run():
+    for i in range(0, 10):
+      interrogate.explanations.get_unexplained_transits(start, end)
+  return run
+
+
+# Builds the index from scratch for all the boards and journeys of a run.
+@benchmark.register("unexplained.build")
+def bench_unexplained_build():
+  (interrogate, result, start, end) = _get_explained_run()
+  boards = list(result._get_boards())
+  journeys = list(result._get_journeys())
+  def run():
+    index = main.ExplanationIndex()
+    for board in boards:
+      for transits in board:
+        index.add_transits(transits)
+    for journey in journeys:
+      index.add_journey(journey)
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+
+import sys
+import random
+import benchmark
+import clock
+import planner
+import stub
+
+
+# A network about the size of a region: 300 routes with 20 stops each, both
+# directions running every 15 minutes all day, which comes to about 45000
+# trips and 850000 connections.
+_ROUTES = 300
+_STOPS_PER_ROUTE = 20
+_HEADWAY = 15
+_QUERIES = 20
+_DATE = "01.10.14"
+
+# The network and the planner for it, built once since they take a while.
+_planner = [None]
+
+
+def _get_planner():
+  if _planner[0] is None:
+    network = stub.SyntheticNetwork(routes=_ROUTES,
+      stops_per_route=_STOPS_PER_ROUTE, headway=_HEADWAY)
+    _planner[0] = planner.Planner.from_result(
+      stub.get_synthetic_result(network, _DATE), _DATE)
+  return _planner[0]
+
+
+# Returns random (origin, destination, departure) queries between the stops
+# routes call at, leaving during the day.
+def _get_queries(planner):
+  generator = random.Random(8600)
+  names = sorted(set(planner.stop_names[s] for s in planner.origins))
+  start = clock.Timestamp.from_date_time(_DATE, "06:00")
+  result = []
+  for i in range(0, _QUERIES):
+    (origin, destination) = generator.sample(names, 2)
+    minute = generator.randint(0, 14 * 60)
+    result.append((origin, destination, start + minute * 60 * 1000))
+  return result
+
+
+@benchmark.register("planner.earliest_arrival", ops=_QUERIES)
+def bench_earliest_arrival():
+  network_planner = _get_planner()
+  queries = _get_queries(network_planner)
+  def run():
+    for (origin, destination, departure) in queries:
+      network_planner.get_earliest_arrival(origin, destination, departure)
+  return run
+
+
+# Profiles of the journeys leaving within an hour.
+@benchmark.register("planner.profile", ops=_QUERIES)
+def bench_profile():
+  network_planner = _get_planner()
+  queries = _get_queries(network_planner)
+  def run():
+    for (origin, destination, departure) in queries:
+      network_planner.get_profile(origin, destination, departure,
+        departure + 60 * 60 * 1000)
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+
+import sys
+import collections
+import benchmark
+import promise
+
+
+_COUNT = 10000
+
+
+@benchmark.register("promise.then", ops=_COUNT)
+def bench_then():
+  sch = promise.Scheduler()
+  def run():
+    p = sch.value(0)
+    for i in range(0, _COUNT):
+      p = p.then(lambda v: v + 1)
+    sch.run_all_tasks()
+    assert p.get() == _COUNT
+  return run
+
+
+@benchmark.register("promise.join", ops=_COUNT)
+def bench_join():
+  sch = promise.Scheduler()
+  def run():
+    promises = [sch.new_promise() for i in range(0, _COUNT)]
+    joint = sch.join(promises)
+    for (index, p) in enumerate(promises):
+      p.fulfill(index)
+    sch.run_all_tasks()
+    assert len(joint.get()) == _COUNT
+  return run
+
+
+@benchmark.register("promise.map_dict", ops=_COUNT)
+def bench_map_dict():
+  sch = promise.Scheduler()
+  def run():
+    values = collections.OrderedDict()
+    for i in range(0, _COUNT):
+      values[i] = sch.value(i)
+    mapped = sch.value(values).map_dict(lambda k, v: k + v)
+    sch.run_all_tasks()
+    assert len(mapped.get()) == _COUNT
+  return run
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+
+import sys
+import io
+import benchmark
+import rejseplanen
+import stub
+
+
+_TRANSITS = 2000
+_JOURNEYS = 200
+_STOPS_PER_JOURNEY = 40
+_REF = "http://localhost/journeyDetail?ref=123%2F456%3Fdate%3D01.10.14"
+
+
+# Returns the text of a board with the given number of transits. The text is
+# written line by line so building it doesn't leave lots of freed memory
+# behind that would skew the memory measurements.
+def get_board_text(board_tag, transit_tag, terminus_attrib, count):
+  out = io.StringIO()
+  out.write(u"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<%s>\n" % board_tag)
+  for i in range(0, count):
+    minute = i % (24 * 60)
+    out.write((u"<%s name=\"Bus %i\" type=\"BUS\" stop=\"Aarhus Rutebilstation\" "
+      u"time=\"%02i:%02i\" date=\"01.10.14\" %s=\"Stop %i (Aarhus)\">\n") % (transit_tag,
+      i % 40, minute // 60, minute % 60, terminus_attrib, i % 100))
+    out.write(u"<JourneyDetailRef ref=\"%s\"/>\n" % _REF.replace("123", str(i)))
+    out.write(u"</%s>\n" % transit_tag)
+  out.write(u"</%s>" % board_tag)
+  return out.getvalue()
+
+
+# Returns the text of a journey with the given number of stops.
+def get_journey_text(stop_count):
+  lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<JourneyDetail>"]
+  for i in range(0, stop_count):
+    minute = 7 * 60 + i * 2
+    time = "%02i:%02i" % (minute // 60, minute % 60)
+    attribs = "name=\"Stop %i (Aarhus)\" x=\"10200000\" y=\"56150000\" routeIdx=\"%i\"" % (i, i)
+    if i > 0:
+      attribs += " arrTime=\"%s\" arrDate=\"01.10.14\"" % time
+    if i < stop_count - 1:
+      attribs += " depTime=\"%s\" depDate=\"01.10.14\"" % time
+    lines.append("<Stop %s/>" % attribs)
+  lines.append("<JourneyName name=\"Bus 1\" routeIdxFrom=\"0\" routeIdxTo=\"%i\"/>" % (stop_count - 1))
+  lines.append("</JourneyDetail>")
+  return u"\n".join(lines)
+
+
+# Returns the text of a location list with the given number of stops.
+def get_location_text(count):
+  lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<LocationList>"]
+  for i in range(0, count):
+    lines.append("<StopLocation name=\"Stop %i (Aarhus)\" x=\"10200000\" "
+      "y=\"56150000\" id=\"%09i\"/>" % (i, 8600000 + i))
+  lines.append("</LocationList>")
+  return u"\n".join(lines)
+
+
+@benchmark.register("parse.arrivals", ops=_TRANSITS)
+def bench_parse_arrivals():
+  text = get_board_text("ArrivalBoard", "Arrival", "origin", _TRANSITS)
+  def run():
+    response = rejseplanen.ArrivalsRequest().process_response("board", text)
+    assert len(response.get_arrivals()) == _TRANSITS
+  return run
+
+
+@benchmark.register("parse.departures", ops=_TRANSITS)
+def bench_parse_departures():
+  text = get_board_text("DepartureBoard", "Departure", "finalStop", _TRANSITS)
+  def run():
+    response = rejseplanen.DeparturesRequest().process_response("board", text)
+    assert len(response.get_departures()) == _TRANSITS
+  return run
+
+
+# A board far larger than any real one, to make the memory use of parsing
+# visible.
+_LARGE_BOARD = 20000
+
+
+@benchmark.register("parse.large_departures", ops=_LARGE_BOARD, memory=True)
+def bench_parse_large_departures():
+  text = get_board_text("DepartureBoard", "Departure", "finalStop", _LARGE_BOARD)
+  def run():
+    response = rejseplanen.DeparturesRequest().process_response("board", text)
+    assert len(response.get_departures()) == _LARGE_BOARD
+  return run
+
+
+# Roughly the number of transits and journeys kept alive by a full day's run
+# for a city.
+_RETAINED_TRANSITS = 50000
+_RETAINED_JOURNEYS = 2000
+
+
+# Measures the memory used by the records the pipeline keeps alive, rather
+# than the cost of parsing.
+@benchmark.register("records.retained", ops=_RETAINED_JOURNEYS, memory=True)
+def bench_retained_records():
+  board_text = get_board_text("DepartureBoard", "Departure", "finalStop",
+    _RETAINED_TRANSITS)
+  journey_text = get_journey_text(_STOPS_PER_JOURNEY)
+  location_text = get_location_text(_TRANSITS)
+  def run():
+    # Share strings between responses the way the service does.
+    strings = rejseplanen.StringTable()
+    board = rejseplanen.DeparturesRequest().process_response("board", board_text,
+      strings)
+    departures = board.get_departures()
+    journeys = []
+    for i in range(0, _RETAINED_JOURNEYS):
+      request = rejseplanen.JourneyRequest(_REF, departures[i])
+      journeys.append(request.process_response("journey", journey_text, strings))
+    location_response = rejseplanen.LocationRequest().process_response(
+      "location", location_text, strings)
+    assert len(journeys) == _RETAINED_JOURNEYS
+    assert len(location_response.get_stop_locations()) == _TRANSITS
+  return run
+
+
+@benchmark.register("parse.journey_stops", ops=_JOURNEYS * _STOPS_PER_JOURNEY)
+def bench_parse_journeys():
+  text = get_journey_text(_STOPS_PER_JOURNEY)
+  board = rejseplanen.DeparturesRequest().process_response("board",
+    get_board_text("DepartureBoard", "Departure", "finalStop", 1))
+  request = rejseplanen.JourneyRequest(_REF, board.get_departures()[0])
+  def run():
+    for i in range(0, _JOURNEYS):
+      response = request.process_response("journey", text)
+      assert len(response.get_stops()) == _STOPS_PER_JOURNEY
+  return run
+
+
+@benchmark.register("parse.locations", ops=_TRANSITS)
+def bench_parse_locations():
+  text = get_location_text(_TRANSITS)
+  def run():
+    response = rejseplanen.LocationRequest().process_response("location", text)
+    assert len(response.get_stop_locations()) == _TRANSITS
+  return run
+
+
+# The same boards and journeys as above in each of the response formats.
+_FORMAT_INPUTS = {
+  "xml": lambda text: text,
+  "json": lambda text: stub.xml_to_json(text),
+}
+
+
+def _register_format_benchmarks(format):
+  convert = _FORMAT_INPUTS[format.name]
+
+  @benchmark.register("format.%s.departures" % format.name, ops=_TRANSITS)
+  def bench_format_departures():
+    text = convert(get_board_text("DepartureBoard", "Departure", "finalStop",
+      _TRANSITS))
+    def run():
+      response = rejseplanen.DeparturesRequest().process_response("board", text,
+        format=format)
+      assert len(response.get_departures()) == _TRANSITS
+    return run
+
+  @benchmark.register("format.%s.journey_stops" % format.name,
+    ops=_JOURNEYS * _STOPS_PER_JOURNEY)
+  def bench_format_journeys():
+    text = convert(get_journey_text(_STOPS_PER_JOURNEY))
+    board = rejseplanen.DeparturesRequest().process_response("board",
+      get_board_text("DepartureBoard", "Departure", "finalStop", 1))
+    request = rejseplanen.JourneyRequest(_REF, board.get_departures()[0])
+    def run():
+      for i in range(0, _JOURNEYS):
+        response = request.process_response("journey", text, format=format)
+        assert len(response.get_stops()) == _STOPS_PER_JOURNEY
+    return run
+
+
+_register_format_benchmarks(rejseplanen.XML)
+_register_format_benchmarks(rejseplanen.JSON)
+
+
+if __name__ == '__main__':
+  sys.exit(benchmark.main(sys.argv[1:]))
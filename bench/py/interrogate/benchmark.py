@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+
+# A small harness for repeatable benchmarks. Benchmarks are registered with the
+# register decorator, run a number of times, and the results are written as
+# json. Results can be compared against a stored baseline so regressions are
+# caught before deploying.
+#
+# A benchmark is a function that does any setup work and returns a thunk that
+# performs the work to be measured. Only the execution of the thunk is timed.
+# The ops count given when registering is the number of operations the thunk
+# performs and is used to report throughput. Benchmarks registered with
+# memory=True also report how much the peak memory use of the process grows
+# while running the thunk, measured in a forked child process.
+
+import argparse
+import atexit
+import collections
+import gc
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+_BENCHMARKS = collections.OrderedDict()
+_TEMP_DIR = []
+
+
+# A registered benchmark.
+class Benchmark(object):
+
+  def __init__(self, name, setup, ops, memory):
+    self.name = name
+    self.setup = setup
+    self.ops = ops
+    self.memory = memory
+
+  # Runs this benchmark the given number of times and returns a dict of
+  # results.
+  def run(self, repeat):
+    timings = []
+    for i in range(0, repeat):
+      thunk = self.setup()
+      gc.collect()
+      start = time.time()
+      thunk()
+      timings.append(time.time() - start)
+    timings.sort()
+    best = timings[0]
+    median = timings[len(timings) // 2]
+    result = collections.OrderedDict([
+      ("ops", self.ops),
+      ("repeat", repeat),
+      ("best_secs", best),
+      ("median_secs", median),
+      ("ops_per_sec", self.ops / median if median > 0 else None),
+    ])
+    if self.memory:
+      result["peak_kb"] = self._measure_peak_kb()
+    return result
+
+  # Runs the benchmark once in a child process and returns how many kilobytes
+  # the peak resident set size grew by while running the thunk.
+  def _measure_peak_kb(self):
+    (read_end, write_end) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_end)
+      try:
+        thunk = self.setup()
+        gc.collect()
+        _reset_peak_rss()
+        before = _get_peak_rss_kb()
+        thunk()
+        after = _get_peak_rss_kb()
+        os.write(write_end, str(after - before))
+      finally:
+        os._exit(0)
+    os.close(write_end)
+    output = os.read(read_end, 64)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return int(output) if output else None
+
+
+# Resets the peak resident set size of this process to the current size, if the
+# platform supports it. A forked child otherwise inherits its parent's peak.
+def _reset_peak_rss():
+  try:
+    with open("/proc/self/clear_refs", "wt") as file:
+      file.write("5")
+  except IOError:
+    pass
+
+
+# Returns the peak resident set size of this process in kilobytes.
+def _get_peak_rss_kb():
+  try:
+    with open("/proc/self/status", "rt") as file:
+      for line in file:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1])
+  except IOError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Decorator that registers a benchmark setup function under the given name.
+def register(name, ops=1, memory=False):
+  def do_register(setup):
+    _BENCHMARKS[name] = Benchmark(name, setup, ops, memory)
+    return setup
+  return do_register
+
+
+# Returns a temporary directory benchmarks can use for files. The directory is
+# deleted when the process exits.
+def get_temp_dir():
+  if len(_TEMP_DIR) == 0:
+    path = tempfile.mkdtemp(prefix="bench")
+    atexit.register(lambda: shutil.rmtree(path, True))
+    _TEMP_DIR.append(path)
+  return _TEMP_DIR[0]
+
+
+# Returns the registered benchmarks whose names match the given regexp.
+def get_benchmarks(filter=None):
+  pattern = None if filter is None else re.compile(filter)
+  result = []
+  for benchmark in _BENCHMARKS.values():
+    if (pattern is None) or pattern.search(benchmark.name):
+      result.append(benchmark)
+  return result
+
+
+# Returns a list of (name, baseline secs, current secs, ratio) for each
+# benchmark that is slower than the baseline by more than the given tolerance.
+def find_regressions(baseline, results, tolerance):
+  regressions = []
+  for (name, result) in results.items():
+    base = baseline.get("results", {}).get(name)
+    if base is None:
+      continue
+    base_secs = base["median_secs"]
+    current_secs = result["median_secs"]
+    if base_secs <= 0:
+      continue
+    ratio = current_secs / base_secs
+    if ratio > 1.0 + tolerance:
+      regressions.append((name, base_secs, current_secs, ratio))
+  return regressions
+
+
+def _build_option_parser():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--filter", type=str,
+    help="Only run benchmarks whose names match this regexp")
+  parser.add_argument("--repeat", type=int, default=5,
+    help="How many times to run each benchmark (default: 5)")
+  parser.add_argument("--output", type=str,
+    help="File to write the json results to")
+  parser.add_argument("--baseline", type=str,
+    help="Json results to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.25,
+    help="How much slower than the baseline a benchmark may be (default: 0.25)")
+  return parser
+
+
+# Runs the registered benchmarks according to the given command-line arguments
+# and returns the process exit code: nonzero if there were regressions.
+def main(args):
+  logging.disable(logging.INFO)
+  options = _build_option_parser().parse_args(args)
+  results = collections.OrderedDict()
+  for benchmark in get_benchmarks(options.filter):
+    result = benchmark.run(options.repeat)
+    results[benchmark.name] = result
+    line = "%-32s %10.4fs %14.1f ops/s" % (benchmark.name, result["median_secs"],
+      result["ops_per_sec"] or 0)
+    if "peak_kb" in result:
+      line += " %10s KB peak" % result["peak_kb"]
+    print line
+  output = collections.OrderedDict([
+    ("timestamp", int(time.time())),
+    ("python", platform.python_version()),
+    ("platform", platform.platform()),
+    ("results", results),
+  ])
+  if not options.output is None:
+    with open(options.output, "wt") as file:
+      json.dump(output, file, indent=2)
+  if options.baseline is None:
+    return 0
+  with open(options.baseline, "rt") as file:
+    baseline = json.load(file)
+  regressions = find_regressions(baseline, results, options.tolerance)
+  for (name, base_secs, current_secs, ratio) in regressions:
+    print "REGRESSION %s: %.4fs -> %.4fs (%.2fx)" % (name, base_secs,
+      current_secs, ratio)
+  return 1 if regressions else 0
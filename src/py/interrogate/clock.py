@@ -1,19 +1,132 @@
+import os
 import time
 
+
+_MIN_IN_MILLIS = 60 * 1000
+_MINUTES_PER_DAY = 24 * 60
+
+
+# Information about a local calendar day. Converting between timestamps and
+# date/time strings is mostly done with arithmetic relative to the day's
+# midnight, which is only valid on days without a daylight saving transition.
+# Irregular days, the few that have one, use the slow library functions.
+class _Day(object):
+
+  def __init__(self, date_str):
+    tup = time.strptime(date_str, "%d.%m.%y")
+    (year, month, day) = tup[0:3]
+    self.midnight = int(time.mktime(tup) * 1000)
+    self.next_midnight = int(time.mktime((year, month, day + 1, 0, 0, 0, 0, 0, -1)) * 1000)
+    last_minute = int(time.mktime((year, month, day, 23, 59, 0, 0, 0, -1)) * 1000)
+    self.is_regular = (
+      (last_minute - self.midnight == (_MINUTES_PER_DAY - 1) * _MIN_IN_MILLIS) and
+      (self.next_midnight - self.midnight == _MINUTES_PER_DAY * _MIN_IN_MILLIS))
+    self.date = time.strftime("%d.%m.%y", time.localtime(self.midnight / 1000.0))
+
+
+# Map from date strings to the corresponding days.
+_days = {}
+
+# The day most recently used to convert a timestamp to strings. Timestamps
+# tend to come in runs from the same day so this saves most lookups.
+_last_day = [None]
+
+
+# Returns the day for the given date string, creating it if necessary.
+def _get_day(date_str):
+  day = _days.get(date_str)
+  if day is None:
+    day = _Day(date_str)
+    _days[date_str] = day
+  return day
+
+
+# Returns the day that contains the given timestamp.
+def _get_day_containing(millis):
+  day = _last_day[0]
+  if (day is None) or not (day.midnight <= millis < day.next_midnight):
+    date_str = time.strftime("%d.%m.%y", time.localtime(millis / 1000.0))
+    day = _get_day(date_str)
+    _last_day[0] = day
+  return day
+
+
+# Returns the minute of the day given by a "HH:MM" string, or None if the
+# string isn't in that exact format.
+def _parse_minute(time_str):
+  if (len(time_str) != 5) or (time_str[2] != ":"):
+    return None
+  hours = time_str[0:2]
+  minutes = time_str[3:5]
+  if not (hours.isdigit() and minutes.isdigit()):
+    return None
+  hours = int(hours)
+  minutes = int(minutes)
+  if (hours > 23) or (minutes > 59):
+    return None
+  return hours * 60 + minutes
+
+
+# Discards all cached information about days. Only needed if the local time
+# zone changes.
+def clear_cache():
+  _days.clear()
+  _last_day[0] = None
+
+
+# Makes the named zone, for instance "Europe/Copenhagen", the local time zone
+# conversions are done in. This changes it for the whole process.
+def set_timezone(name):
+  os.environ["TZ"] = name
+  time.tzset()
+  clear_cache()
+
+
+# Returns the name of the zone conversions are done in if it has been set,
+# otherwise None.
+def get_timezone():
+  return os.environ.get("TZ")
+
+
 class Timestamp(object):
 
   @staticmethod
   def to_date(millis):
+    return _get_day_containing(millis).date
+
+  @staticmethod
+  def to_time(millis):
+    day = _get_day_containing(millis)
+    if not day.is_regular:
+      return Timestamp._to_time_slow(millis)
+    minute = (millis - day.midnight) // _MIN_IN_MILLIS
+    return "%02i:%02i" % divmod(minute, 60)
+
+  @staticmethod
+  def from_date_time(date_str, time_str):
+    minute = _parse_minute(time_str)
+    if minute is None:
+      return Timestamp._from_date_time_slow(date_str, time_str)
+    day = _get_day(date_str)
+    if not day.is_regular:
+      return Timestamp._from_date_time_slow(date_str, time_str)
+    return day.midnight + minute * _MIN_IN_MILLIS
+
+  # Converts a timestamp to a date string using the library functions.
+  @staticmethod
+  def _to_date_slow(millis):
     localtime = time.localtime(millis / 1000.0)
     return time.strftime("%d.%m.%y", localtime)
 
+  # Converts a timestamp to a time string using the library functions.
   @staticmethod
-  def to_time(millis):
-    localtime = time.localtime(millis / 1000.0)    
+  def _to_time_slow(millis):
+    localtime = time.localtime(millis / 1000.0)
     return time.strftime("%H:%M", localtime)
 
+  # Converts date and time strings to a timestamp using the library functions.
   @staticmethod
-  def from_date_time(date_str, time_str):
+  def _from_date_time_slow(date_str, time_str):
     tup = time.strptime("%s-%s" % (date_str, time_str), "%d.%m.%y-%H:%M")
     secs = time.mktime(tup)
     return int(secs * 1000)
@@ -23,3 +136,25 @@ def get_previous_date(date):
   midnight = Timestamp.from_date_time(date, "00:00")
   hour_before_midnight = midnight - (1000 * 60 * 60)
   return Timestamp.to_date(hour_before_midnight)
+
+# Given a date as a string, returns the next date string.
+def get_next_date(date):
+  midnight = Timestamp.from_date_time(date, "00:00")
+  day_and_a_half_after_midnight = midnight + (1000 * 60 * 60 * 36)
+  return Timestamp.to_date(day_and_a_half_after_midnight)
+
+# Returns the timestamp with the same local time as the given one the given
+# number of days later, or earlier if negative.
+def add_days(millis, days):
+  date = Timestamp.to_date(millis)
+  time_str = Timestamp.to_time(millis)
+  step = get_next_date if (days > 0) else get_previous_date
+  for i in range(0, abs(days)):
+    date = step(date)
+  return Timestamp.from_date_time(date, time_str)
+
+# Returns the number of days from one date string to another.
+def get_days_between(from_date, to_date):
+  from_noon = Timestamp.from_date_time(from_date, "12:00")
+  to_noon = Timestamp.from_date_time(to_date, "12:00")
+  return int(round((to_noon - from_noon) / float(_MINUTES_PER_DAY * _MIN_IN_MILLIS)))
@@ -0,0 +1,269 @@
+import array
+import ast
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import clock
+
+
+logging.basicConfig(level=logging.INFO)
+_LOG = logging.getLogger(__name__)
+
+
+_MANIFEST = "manifest.json"
+
+_VERSION = 2
+
+# The value of missing times and positions.
+MISSING = -(1 << 31)
+
+_HOUR_IN_MILLIS = 60 * 60 * 1000
+
+_NPY_MAGIC = "\x93NUMPY\x01\x00"
+
+# The dtype of all the columns, little-endian 32 bit ints.
+_DTYPE = "<i4"
+
+# The columns of a timetable. Trips are stored against their sub-routes: the
+# stops and relative times of all sub-routes are one table, in the order
+# each sub-route calls at them, and trips only have their sub-route and start.
+_COLUMNS = [
+  # Position of each stop in millionths of a degree.
+  "stop_x",
+  "stop_y",
+  # The route of each sub-route.
+  "sub_route_route",
+  # The first row of each sub-route's stops, and one past the last one at the
+  # end so the stops of sub-route i are sub_route_starts[i] to
+  # sub_route_starts[i + 1].
+  "sub_route_starts",
+  # The stops of the sub-routes with their times in seconds after the start.
+  "sub_route_stop",
+  "sub_route_arrival",
+  "sub_route_departure",
+  # The sub-route of each trip and the time it starts.
+  "trip_sub_route",
+  "trip_start",
+]
+
+
+# Returns the header of a .npy file of a one-dimensional int32 array of the
+# given length. The header is padded so the data starts on a 64 byte boundary
+# as numpy likes it.
+def _get_npy_header(length):
+  header = "{'descr': '%s', 'fortran_order': False, 'shape': (%i,), }" % (
+    _DTYPE, length)
+  unpadded = len(_NPY_MAGIC) + 2 + len(header) + 1
+  header += " " * (-unpadded % 64) + "\n"
+  return _NPY_MAGIC + struct.pack("<H", len(header)) + header
+
+
+# Writes the given values to the given file as a .npy array.
+def _write_column(path, values):
+  data = array.array("i", values)
+  assert data.itemsize == 4
+  if sys.byteorder == "big":
+    data.byteswap()
+  with open(path, "wb") as file:
+    file.write(_get_npy_header(len(data)))
+    data.tofile(file)
+
+
+# Returns the timestamp the times of trips running on the given date are
+# relative to, noon minus 12 hours like in GTFS.
+def _get_day_start(date):
+  return clock.Timestamp.from_date_time(date, "12:00") - 12 * _HOUR_IN_MILLIS
+
+
+# Writes the given pipeline result for the given date to a directory as
+# columns of int32s, each a .npy file, and a manifest that holds the stop and
+# route names the columns refer to by index. Trips are deduplicated by
+# identity and written as their sub-route and start, with times in seconds
+# since the start of the date so they fit in 32 bits. The manifest is written
+# last and replaced atomically so a reader never sees a timetable that's only
+# partly written.
+def write(directory, date, result):
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  day_start = _get_day_start(date)
+  def to_seconds(millis):
+    if millis is None:
+      return MISSING
+    return millis // 1000
+  stop_indices = {}
+  stop_names = []
+  def get_stop_index(name):
+    index = stop_indices.get(name)
+    if index is None:
+      index = len(stop_names)
+      stop_indices[name] = index
+      stop_names.append(name)
+    return index
+  infos = result.get_stops()
+  for name in sorted(infos.keys()):
+    get_stop_index(name)
+  columns = dict((name, []) for name in _COLUMNS)
+  route_names = sorted(result.routes.keys())
+  sub_route_indices = {}
+  identities = set()
+  for (route_index, route_name) in enumerate(route_names):
+    for journey in result.routes[route_name].get_journeys():
+      identity = journey.get_identity()
+      if identity in identities:
+        continue
+      identities.add(identity)
+      sub_route = journey.get_sub_route()
+      sub_route_index = sub_route_indices.get(sub_route)
+      if sub_route_index is None:
+        sub_route_index = len(sub_route_indices)
+        sub_route_indices[sub_route] = sub_route_index
+        columns["sub_route_route"].append(route_index)
+        columns["sub_route_starts"].append(len(columns["sub_route_stop"]))
+        columns["sub_route_stop"].extend(get_stop_index(name)
+          for name in sub_route.get_names())
+        columns["sub_route_arrival"].extend(to_seconds(offset)
+          for offset in sub_route.get_arrivals())
+        columns["sub_route_departure"].extend(to_seconds(offset)
+          for offset in sub_route.get_departures())
+      columns["trip_sub_route"].append(sub_route_index)
+      columns["trip_start"].append(to_seconds(journey.get_start() - day_start))
+  columns["sub_route_starts"].append(len(columns["sub_route_stop"]))
+  for name in stop_names:
+    info = infos.get(name)
+    (x, y) = (MISSING, MISSING) if (info is None) else info.get_position()
+    columns["stop_x"].append(x)
+    columns["stop_y"].append(y)
+  manifest = {
+    "version": _VERSION,
+    "date": date,
+    "day_start": day_start,
+    "missing": MISSING,
+    "stops": stop_names,
+    "routes": route_names,
+    "columns": {},
+  }
+  for name in _COLUMNS:
+    file_name = "%s.npy" % name
+    _write_column(os.path.join(directory, file_name), columns[name])
+    manifest["columns"][name] = {"file": file_name, "dtype": _DTYPE,
+      "length": len(columns[name])}
+  manifest_path = os.path.join(directory, _MANIFEST)
+  with open(manifest_path + ".tmp", "wt") as file:
+    json.dump(manifest, file)
+  os.rename(manifest_path + ".tmp", manifest_path)
+  _LOG.info("Wrote %i trips of %i sub-routes of %i routes calling at %i "
+    "stops to %s", len(columns["trip_start"]), len(sub_route_indices),
+    len(route_names), len(stop_names), directory)
+
+
+# A read-only column of int32s backed by a memory-mapped file. Values are
+# unpacked from the mapping when they're accessed, nothing is copied up front,
+# and slicing gives another column over the same mapping.
+class Int32Column(object):
+
+  def __init__(self, mapping, offset, length):
+    self.mapping = mapping
+    self.offset = offset
+    self.length = length
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      (start, stop, step) = index.indices(self.length)
+      assert step == 1
+      return Int32Column(self.mapping, self.offset + 4 * start,
+        max(0, stop - start))
+    if index < 0:
+      index += self.length
+    if not (0 <= index < self.length):
+      raise IndexError(index)
+    return struct.unpack_from("<i", self.mapping, self.offset + 4 * index)[0]
+
+  def __iter__(self):
+    for index in xrange(0, self.length):
+      yield struct.unpack_from("<i", self.mapping, self.offset + 4 * index)[0]
+
+  # Returns a buffer over the raw little-endian data of this column without
+  # copying it.
+  def get_buffer(self):
+    return buffer(self.mapping, self.offset, 4 * self.length)
+
+
+# Maps the given .npy file and returns the column of its data.
+def _map_column(path, expected_length):
+  with open(path, "rb") as file:
+    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  if mapping[0:len(_NPY_MAGIC)] != _NPY_MAGIC:
+    raise ValueError("%s is not a version 1.0 .npy file" % path)
+  (header_length,) = struct.unpack_from("<H", mapping, len(_NPY_MAGIC))
+  offset = len(_NPY_MAGIC) + 2
+  header = ast.literal_eval(mapping[offset:offset + header_length])
+  if (header["descr"] != _DTYPE) or (header["shape"] != (expected_length,)):
+    raise ValueError("%s doesn't hold %i %s values" % (path, expected_length,
+      _DTYPE))
+  return Int32Column(mapping, offset + header_length, expected_length)
+
+
+# A timetable written by write, with its columns memory-mapped. The columns
+# are available as attributes by name. The .npy files can also be loaded with
+# numpy.load(path, mmap_mode="r").
+class Timetable(object):
+
+  def __init__(self, directory):
+    with open(os.path.join(directory, _MANIFEST), "rt") as file:
+      manifest = json.load(file)
+    if manifest["version"] != _VERSION:
+      raise ValueError("Unsupported timetable version %s" % manifest["version"])
+    self.date = manifest["date"]
+    self.day_start = manifest["day_start"]
+    self.stops = manifest["stops"]
+    self.routes = manifest["routes"]
+    self.columns = {}
+    for (name, column) in manifest["columns"].items():
+      self.columns[name] = _map_column(os.path.join(directory, column["file"]),
+        column["length"])
+      setattr(self, name, self.columns[name])
+
+  def get_trip_count(self):
+    return len(self.trip_start)
+
+  def get_sub_route_count(self):
+    return len(self.sub_route_route)
+
+  # Returns the index of the route of the given trip.
+  def get_trip_route(self, trip):
+    return self.sub_route_route[self.trip_sub_route[trip]]
+
+  # Returns the rows of the stop times of the given trip as (stop, arrival,
+  # departure) tuples of indices and seconds since the start of the date.
+  def get_trip_stop_times(self, trip):
+    sub_route = self.trip_sub_route[trip]
+    start = self.sub_route_starts[sub_route]
+    end = self.sub_route_starts[sub_route + 1]
+    trip_start = self.trip_start[trip]
+    def add_start(offset):
+      return MISSING if (offset == MISSING) else (trip_start + offset)
+    return [(stop, add_start(arrival), add_start(departure))
+      for (stop, arrival, departure) in zip(self.sub_route_stop[start:end],
+        self.sub_route_arrival[start:end], self.sub_route_departure[start:end])]
+
+  # Returns the given time of this timetable as a timestamp, or None if it's
+  # missing.
+  def to_timestamp(self, seconds):
+    if seconds == MISSING:
+      return None
+    return self.day_start + seconds * 1000
+
+  def close(self):
+    for column in self.columns.values():
+      column.mapping.close()
+    self.columns = {}
+
+
+def read(directory):
+  return Timetable(directory)
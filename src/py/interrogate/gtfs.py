@@ -0,0 +1,213 @@
+import collections
+import csv
+import logging
+import os
+import time
+import clock
+import rejseplanen
+
+
+logging.basicConfig(level=logging.INFO)
+_LOG = logging.getLogger(__name__)
+
+
+# The GTFS route types of the transport modes.
+_ROUTE_TYPES = {
+  "train": 2,
+  "bus": 3,
+  "metro": 1,
+}
+
+# The route type of routes whose names don't give their transport mode.
+_DEFAULT_ROUTE_TYPE = 3
+
+_AGENCY_ID = "rejseplanen"
+
+# The files of the feed and their columns.
+_COLUMNS = collections.OrderedDict([
+  ("agency.txt", ["agency_id", "agency_name", "agency_url", "agency_timezone"]),
+  ("stops.txt", ["stop_id", "stop_code", "stop_name", "stop_lat", "stop_lon"]),
+  ("routes.txt", ["route_id", "agency_id", "route_short_name", "route_type"]),
+  ("trips.txt", ["route_id", "service_id", "trip_id"]),
+  ("stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_id",
+    "stop_sequence"]),
+  ("calendar.txt", ["service_id", "monday", "tuesday", "wednesday", "thursday",
+    "friday", "saturday", "sunday", "start_date", "end_date"]),
+])
+
+# Rejseplanen gives positions in millionths of a degree.
+_POSITION_SCALE = 1000000.0
+
+_HOUR_IN_MILLIS = 60 * 60 * 1000
+
+
+# Returns the given date string in GTFS' YYYYMMDD format.
+def _format_date(date):
+  return time.strftime("%Y%m%d", time.strptime(date, "%d.%m.%y"))
+
+
+# Returns the given number of milliseconds after the start of a service day in
+# GTFS' HH:MM:SS format, where the hours can go past 24.
+def _format_time(millis):
+  (minutes, seconds) = divmod(millis // 1000, 60)
+  (hours, minutes) = divmod(minutes, 60)
+  return "%02i:%02i:%02i" % (hours, minutes, seconds)
+
+
+# Returns the time of the given journey stop, its departure if it has one
+# otherwise its arrival, or None if it has neither.
+def _get_stop_time(stop):
+  result = stop.get_departure()
+  if result is None:
+    result = stop.get_arrival()
+  return result
+
+
+# Returns the timestamp the times of trips running on the given date are
+# relative to. GTFS measures from noon minus 12 hours which is midnight except
+# on days with a daylight saving transition.
+def _get_service_day_start(date):
+  return clock.Timestamp.from_date_time(date, "12:00") - 12 * _HOUR_IN_MILLIS
+
+
+# Writes interrogated timetables to a directory as a GTFS feed. Rows are
+# written as the journeys and stops resolve rather than from the final result
+# so they go to disk as soon as they're known; the writer only keeps what it
+# needs to not write anything twice, the identities of the trips and the ids
+# given to routes and stops. Journeys have absolute timestamps whereas GTFS
+# gives times relative to the day a trip runs on, its service date, so each
+# trip runs on the date of its first stop and times past midnight go beyond
+# 24:00. Every date trips run on is a service of its own in the calendar.
+# Journeys only name their stops so stops get ids of their own when first
+# seen and their positions are written once the stop infos come in. Times are
+# converted in the clock's zone which is therefore the one the feed is in.
+class GtfsWriter(object):
+
+  def __init__(self, directory, agency_name="Rejseplanen",
+      agency_url="http://www.rejseplanen.dk"):
+    timezone = clock.get_timezone()
+    if timezone is None:
+      raise AssertionError("Can't write a gtfs feed without a clock time zone")
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.files = {}
+    self.writers = {}
+    for (name, columns) in _COLUMNS.items():
+      file = open(os.path.join(directory, name), "wb")
+      self.files[name] = file
+      self.writers[name] = csv.writer(file)
+      self.writers[name].writerow(columns)
+    self.identities = set()
+    self.trip_count = 0
+    # Maps from route and stop names to their ids.
+    self.route_ids = {}
+    self.stop_ids = {}
+    self.stops_written = set()
+    # Map from service dates to their service ids.
+    self.service_ids = {}
+    self._write("agency.txt", [_AGENCY_ID, agency_name, agency_url, timezone])
+
+  def _write(self, name, row):
+    self.writers[name].writerow([_encode(value) for value in row])
+
+  def _get_route_id(self, route_name):
+    route_id = self.route_ids.get(route_name)
+    if route_id is None:
+      route_id = len(self.route_ids) + 1
+      self.route_ids[route_name] = route_id
+      mode = rejseplanen.get_transport_mode(route_name)
+      self._write("routes.txt", [route_id, _AGENCY_ID, route_name,
+        _ROUTE_TYPES.get(mode, _DEFAULT_ROUTE_TYPE)])
+    return route_id
+
+  def _get_stop_id(self, name):
+    stop_id = self.stop_ids.get(name)
+    if stop_id is None:
+      stop_id = len(self.stop_ids) + 1
+      self.stop_ids[name] = stop_id
+    return stop_id
+
+  def _get_service_id(self, date):
+    service_id = self.service_ids.get(date)
+    if service_id is None:
+      service_id = _format_date(date)
+      self.service_ids[date] = service_id
+    return service_id
+
+  # Writes the trip of the given journey unless one with the same identity has
+  # already been written. Returns true if it was written. GTFS requires times
+  # at the first and last stop of a trip so journeys without them are skipped;
+  # stops in between without any times are left for consumers to interpolate.
+  def add_journey(self, journey):
+    stops = journey.get_stops()
+    if len(stops) == 0:
+      return False
+    first_time = _get_stop_time(stops[0])
+    if (first_time is None) or (_get_stop_time(stops[-1]) is None):
+      _LOG.warning("Skipping journey of %s without times at its ends",
+        journey.get_route_name())
+      return False
+    identity = journey.get_identity()
+    if identity in self.identities:
+      return False
+    self.identities.add(identity)
+    self.trip_count += 1
+    trip_id = self.trip_count
+    date = clock.Timestamp.to_date(first_time)
+    day_start = _get_service_day_start(date)
+    self._write("trips.txt", [self._get_route_id(journey.get_route_name()),
+      self._get_service_id(date), trip_id])
+    for (sequence, stop) in enumerate(stops):
+      arrival = stop.get_arrival()
+      departure = stop.get_departure()
+      if arrival is None:
+        arrival = departure
+      if departure is None:
+        departure = arrival
+      if arrival is None:
+        times = ["", ""]
+      else:
+        times = [_format_time(arrival - day_start),
+          _format_time(departure - day_start)]
+      self._write("stop_times.txt", [trip_id] + times +
+        [self._get_stop_id(stop.get_name()), sequence])
+    return True
+
+  def add_journeys(self, journeys):
+    for journey in journeys:
+      self.add_journey(journey)
+
+  # Writes the given stop infos, those that haven't been written already.
+  def add_stops(self, infos):
+    for info in infos:
+      name = info.get_name()
+      if name in self.stops_written:
+        continue
+      self.stops_written.add(name)
+      (x, y) = info.get_position()
+      self._write("stops.txt", [self._get_stop_id(name), info.get_id(), name,
+        "%.6f" % (y / _POSITION_SCALE), "%.6f" % (x / _POSITION_SCALE)])
+
+  # Writes the calendar and closes the feed. Stops that trips call at but
+  # that never got their infos are written without a position.
+  def close(self):
+    missing = [n for n in self.stop_ids if not n in self.stops_written]
+    for name in sorted(missing):
+      _LOG.warning("No position for stop %s", name)
+      self._write("stops.txt", [self.stop_ids[name], "", name, "", ""])
+    for (date, service_id) in sorted(self.service_ids.items(),
+        key=lambda item: item[1]):
+      weekday = time.strptime(date, "%d.%m.%y").tm_wday
+      days = [1 if (day == weekday) else 0 for day in range(0, 7)]
+      self._write("calendar.txt", [service_id] + days + [service_id, service_id])
+    for file in self.files.values():
+      file.close()
+    _LOG.info("Wrote %i trips of %i routes calling at %i stops", self.trip_count,
+      len(self.route_ids), len(self.stop_ids))
+
+
+# Returns the given value as a byte string the csv module can write.
+def _encode(value):
+  if isinstance(value, unicode):
+    return value.encode("utf-8")
+  return value
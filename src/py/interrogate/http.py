@@ -4,12 +4,14 @@ import httplib
 import time
 import logging
 import sqlite3
-import xml.etree.ElementTree
 import promise
 import zlib
 import threading
 import Queue
 import sys
+import fcntl
+import os
+import errno
 import cachetools
 
 
@@ -72,6 +74,162 @@ class LeakyBucket(object):
       self.last_permit = new_last_permit
 
 
+# A leaky bucket whose state is kept in a file such that any number of processes
+# can share the same rate limit. The file holds the time of the last permit
+# issued and is only ever accessed while holding an exclusive lock on it.
+class SharedLeakyBucket(LeakyBucket):
+
+  def __init__(self, filename, permits_per_sec, max_accumulation):
+    self.filename = filename
+    super(SharedLeakyBucket, self).__init__(permits_per_sec, max_accumulation)
+
+  # Sets the time of the last permit unless another process has already issued
+  # a later one.
+  def set_last_permit(self, value):
+    def do_set_last_permit():
+      self.last_permit = max(self.last_permit, value)
+    self._with_shared_state(do_set_last_permit)
+    return self
+
+  # Reserves the next permit in the shared state and then waits until its time
+  # comes. The file is only locked while reserving so other processes can make
+  # their reservations while this one is sleeping.
+  def wait_for_permit(self):
+    self.lock.acquire()
+    try:
+      current_time = self.get_current_time_millis()
+      def reserve_next_permit():
+        self._limit_accumulation(current_time)
+        self.last_permit = self.last_permit + self.millis_per_permit
+      self._with_shared_state(reserve_next_permit)
+      if current_time < self.last_permit:
+        self.sleep_millis(self.last_permit - current_time)
+    finally:
+      self.lock.release()
+
+  # Loads the shared state into this bucket, calls the thunk, and then stores
+  # the state back, all while holding the file lock.
+  def _with_shared_state(self, thunk):
+    with open(self.filename, "a+") as file:
+      fcntl.flock(file, fcntl.LOCK_EX)
+      try:
+        file.seek(0)
+        stored = file.read().strip()
+        if stored:
+          self.last_permit = float(stored)
+        thunk()
+        file.seek(0)
+        file.truncate()
+        file.write(repr(self.last_permit))
+        file.flush()
+      finally:
+        fcntl.flock(file, fcntl.LOCK_UN)
+
+
+# A record of which urls have been claimed for fetching by any of a number of
+# processes that share an http cache. Claims and releases are appended to a
+# file, one per line, while holding an exclusive lock on it. Each process
+# remembers how far into the file it has read so it only has to read the lines
+# written since. A claim records the process that made it and when so a claim
+# held by a process that has died, or that has been held for too long, can be
+# taken over by another process.
+class SharedUrlClaims(object):
+
+  # How long a claim holds before another process may take it over even if
+  # the process that made it is still alive.
+  STALE_SECS = 120
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.claimed = {}
+    self.offset = 0
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+
+  # Returns the current time in seconds since epoch.
+  def get_current_time_secs(self):
+    return time.time()
+
+  # Claims the given url for this process. Returns True if it wasn't claimed
+  # before or the claim has been released, is stale, or belongs to a process
+  # that no longer exists. Returns False if another process holds it.
+  def claim(self, url):
+    def do_claim():
+      holder = self.claimed.get(url)
+      if (not holder is None) and self._is_held(holder):
+        return None
+      now = self.get_current_time_secs()
+      self.claimed[url] = (self.pid, now)
+      return "+ %i %r %s\n" % (self.pid, now, url)
+    return self._with_claims(do_claim)
+
+  # Gives up this process' claim on the given url such that other processes
+  # can take it over straight away.
+  def release(self, url):
+    def do_release():
+      holder = self.claimed.get(url)
+      if (holder is None) or (holder[0] != self.pid):
+        return None
+      del self.claimed[url]
+      return "- %s\n" % url
+    self._with_claims(do_release)
+
+  # Is the given claim still held by some other process?
+  def _is_held(self, holder):
+    (pid, claimed_at) = holder
+    if pid == self.pid:
+      # Within a process requests are deduplicated before they're claimed so
+      # if this process claims a url again it's because it wants to refetch it.
+      return False
+    if self.get_current_time_secs() - claimed_at > SharedUrlClaims.STALE_SECS:
+      return False
+    return is_process_alive(pid)
+
+  # Reads the lines added to the claims file since it was last read and then
+  # calls the thunk, all while holding the file lock. If the thunk returns a
+  # line it is appended to the file. Returns whether a line was written.
+  def _with_claims(self, thunk):
+    self.lock.acquire()
+    try:
+      with open(self.filename, "a+") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+          file.seek(self.offset)
+          added = file.read()
+          self.offset += len(added)
+          for line in added.splitlines():
+            self._apply_line(line)
+          line = thunk()
+          if line is None:
+            return False
+          file.write(line)
+          file.flush()
+          self.offset += len(line)
+          return True
+        finally:
+          fcntl.flock(file, fcntl.LOCK_UN)
+    finally:
+      self.lock.release()
+
+  # Updates the claims according to a line read from the claims file.
+  def _apply_line(self, line):
+    if line.startswith("+ "):
+      (pid, claimed_at, url) = line[2:].split(" ", 2)
+      self.claimed[url] = (int(pid), float(claimed_at))
+    elif line.startswith("- "):
+      self.claimed.pop(line[2:], None)
+
+
+# Returns True if a process with the given pid exists on this machine.
+def is_process_alive(pid):
+  try:
+    os.kill(pid, 0)
+    return True
+  except OSError, e:
+    # EPERM means the process exists but belongs to someone else.
+    return e.errno == errno.EPERM
+
+
 # A persistent cache that stores raw http request information.
 class HttpRequestCache(object):
 
@@ -88,18 +246,33 @@ class HttpRequestCache(object):
   # Only the thread that creates the connection is allowed to use it so we
   # spawn an owner thread which does all the work.
   def _run_owner_thread(self):
-    self.db = sqlite3.connect(self.filename)
-    self.db.execute("CREATE TABLE IF NOT EXISTS requests (timestamp, url, response)")
+    # Shard workers share the cache so allow for some waiting on locks.
+    self.db = sqlite3.connect(self.filename, timeout=60)
+    self.db.execute("CREATE TABLE IF NOT EXISTS requests (timestamp, url, response, content_type)")
+    self._add_content_type_column()
     self._prime_memcache()
     while self.keep_going:
       (thunk, chan) = self.tasks.get()
-      chan.put(thunk())
+      try:
+        chan.put((thunk(), None))
+      except Exception, e:
+        chan.put((None, e))
+
+  # Caches created before the content type was recorded don't have a column
+  # for it. Their responses are all xml.
+  def _add_content_type_column(self):
+    columns = [row[1] for row in self.db.execute("PRAGMA table_info(requests)")]
+    if not "content_type" in columns:
+      self.db.execute("ALTER TABLE requests ADD COLUMN content_type")
+      self.db.execute("UPDATE requests SET content_type = 'application/xml'")
+      self.db.commit()
 
-  # Load the full contents of the cache into memory.
+  # Load the full contents of the cache into memory. The memcache maps urls to
+  # pairs of the compressed response and its content type.
   def _prime_memcache(self):
     _LOG.info("Priming request cache")
     cursor = self.db.execute("""
-      SELECT url, response
+      SELECT url, response, content_type
       FROM requests
       ORDER BY timestamp ASC
     """)
@@ -108,14 +281,14 @@ class HttpRequestCache(object):
     for row in cursor:
       url = row[0]
       response_zip = row[1]
-      self.memcache[url] = response_zip
+      self.memcache[url] = (response_zip, row[2])
       bytes += len(response_zip)
       entries += 1
     _LOG.info("Loaded %iMB of compressed cache, %i entries", int(bytes / 1000000.0), entries)
 
   # Submit a task to be executed on the owner thread. The submitting thread
   # will block until the task has been executed. The result will be the task's
-  # result.
+  # result and errors are rethrown on the submitting thread.
   def _run_as_owner(self, thunk):
     # Use a thread local queue to communicate the result, creating one if it
     # doesn't already exist.
@@ -126,18 +299,20 @@ class HttpRequestCache(object):
     # Enqueue the task for the owner to execute.
     self.tasks.put((thunk, chan))
     # Wait until it's done.
-    return chan.get()
+    (result, error) = chan.get()
+    if not error is None:
+      raise error
+    return result
 
   # Returns the latest response to a request to the given url, None if we
-  # haven't seen that url before.
-  def get_response(self, url):
+  # haven't seen that url before. If a function is given that tells which
+  # content types are accepted a response of any other type is also None.
+  def get_response(self, url, accepts=None):
     def do_get_response():
       cached = self.memcache.get(url)
-      if not cached is None:
-        response_zip = cached
-      else:
+      if cached is None:
         cursor = self.db.execute("""
-          SELECT response
+          SELECT response, content_type
           FROM requests
           WHERE url = ?
           ORDER BY timestamp DESC
@@ -145,9 +320,10 @@ class HttpRequestCache(object):
         result = cursor.fetchone()
         if result is None:
           return None
-        else:
-          response_zip = result[0]
-          self.memcache[url] = response_zip
+        cached = self.memcache[url] = (result[0], result[1])
+      (response_zip, content_type) = cached
+      if (not accepts is None) and not accepts(content_type):
+        return None
       response_str = zlib.decompress(response_zip)
       return response_str.decode("utf-8")
     return self._run_as_owner(do_get_response)
@@ -168,24 +344,25 @@ class HttpRequestCache(object):
     return self._run_as_owner(do_get_latest_timestamp)
 
   # Records a response to a backend request.
-  def add_response(self, timestamp, url, response):
+  def add_response(self, timestamp, url, response, content_type=None):
     def do_add_response():
       # Responses are typically xml which is highly verbose and redundant and so
       # take up obscene amounts of space if not zipped. The unicode/buffer
       # conversion stuff is really fragile so watch out if you change it.
       response_str = response.encode("utf-8")
       response_zip = buffer(zlib.compress(response_str, 9))
-      self.memcache[url] = response_zip
+      self.memcache[url] = (response_zip, content_type)
       self.db.execute("""
         INSERT INTO requests
-        VALUES (?, ?, ?)
-      """, (timestamp, url, response_zip))
+        VALUES (?, ?, ?, ?)
+      """, (timestamp, url, response_zip, content_type))
       self.db.commit()
     return self._run_as_owner(do_add_response)
 
   def drop(self, url):
     def do_drop():
-      del self.memcache[url]
+      # The response may already have been evicted from the memcache.
+      self.memcache.pop(url, None)
       self.db.execute("""
         DELETE FROM requests
         WHERE url = ?
@@ -216,13 +393,15 @@ class HttpRequest(object):
       self.params.append((name, str_value))
     return self
 
-  # Returns the full url of this request.
+  # Returns the full url of this request. The path may already have a query
+  # in which case the parameters are added to it.
   def get_url(self):
     if len(self.params) == 0:
       return self.path
     else:
       params = urllib.urlencode(self.params)
-      return "%s?%s" % (self.path, params)
+      separator = "&" if ("?" in self.path) else "?"
+      return "%s%s%s" % (self.path, separator, params)
 
 
 # A really simple pool that distributes submitted tasks among N threads.
@@ -253,24 +432,34 @@ class SimpleThreadPool(object):
 class HttpProxy(object):
 
   def __init__(self, scheduler, cache, user_agent, reqs_per_sec, max_accum,
-      pool_size):
+      pool_size, limiter_file=None, claims_file=None):
     self.scheduler = scheduler
     self.cache = HttpRequestCache(cache)
-    self.limiter = LeakyBucket(reqs_per_sec, max_accum)
+    if limiter_file is None:
+      self.limiter = LeakyBucket(reqs_per_sec, max_accum)
+    else:
+      self.limiter = SharedLeakyBucket(limiter_file, reqs_per_sec, max_accum)
+    if claims_file is None:
+      self.claims = None
+    else:
+      self.claims = SharedUrlClaims(claims_file)
     self.limiter.set_last_permit(self.cache.get_latest_timestamp())
     self.user_agent = user_agent
     self.thread_pool = SimpleThreadPool(pool_size)
     self.in_flight_lock = threading.Lock()
     self.in_flight = {}
     self.launch_times = set()
+    self.backend_request_count = 0
 
-  # Issues the given request, returning a promise for the text result.
-  def fetch_text(self, request):
+  # Issues the given request, returning a promise for the text result. If a
+  # function is given that tells which content types are accepted, cached
+  # responses of other types are fetched again.
+  def fetch_text(self, request, accepts=None):
     url = request.get_url()
     # Try fetching the response from the cache.
-    cached_response = self.cache.get_response(url)
+    cached_response = self.cache.get_response(url, accepts)
     if cached_response is None:
-      return self._fetch_url_from_backend(url)
+      return self._fetch_url_from_backend(url, accepts)
     else:
       return self.scheduler.value(cached_response)
 
@@ -278,24 +467,18 @@ class HttpProxy(object):
   def drop_from_cache(self, url):
     self.cache.drop(url)
 
-  # Issues the given request, returning a promise for the xml result.
-  def fetch_xml(self, request):
-    def parse_xml(text):
-      return xml.etree.ElementTree.fromstring(text.encode("utf8"))
-    return self.fetch_text(request).then(parse_xml)
-
   # Returns a promise for the result of fetching the given url from this proxy's
   # backend. This also takes care of caching the result.
-  def _fetch_url_from_backend(self, url):
+  def _fetch_url_from_backend(self, url, accepts=None):
     self.in_flight_lock.acquire()
     try:
-      return self._submit_fetch_url_from_backend(url)
+      return self._submit_fetch_url_from_backend(url, accepts)
     finally:
       self.in_flight_lock.release()
 
   # Does the work of fetching from the backend assuming that the in-flight lock
   # is held by the current thread. 
-  def _submit_fetch_url_from_backend(self, url):
+  def _submit_fetch_url_from_backend(self, url, accepts):
     in_flight = self.in_flight.get(url, None)
     if not in_flight is None:
       # There is already a request for the given url in flight so just use that
@@ -304,7 +487,8 @@ class HttpProxy(object):
     result = self.scheduler.new_promise()
     # Launch a new request.
     self.in_flight[url] = result
-    self.thread_pool.submit(lambda: self._do_fetch_url_from_backend(result, url))
+    self.thread_pool.submit(lambda: self._do_fetch_url_from_backend(result, url,
+      accepts))
     return result
 
   # If a request fails try again a few times before killing the whole process.
@@ -316,7 +500,34 @@ class HttpProxy(object):
     600, # 10m
     3600 # 1h
   ]
-  def _do_fetch_url_from_backend(self, result, url):
+
+  # How often to check whether another process has fetched a url it has
+  # claimed.
+  CLAIM_POLL_SECS = 0.1
+
+  def _do_fetch_url_from_backend(self, result, url, accepts):
+    try:
+      if (not self.claims is None) and not self.claims.claim(url):
+        # Another process is fetching this url so wait for its response to
+        # turn up in the shared cache rather than ask the backend again.
+        claimed_response = self._wait_for_claimed_response(url, accepts)
+        if not claimed_response is None:
+          self._remove_in_flight(url)
+          self.scheduler.add_thunk(lambda: result.fulfill(claimed_response))
+          return
+        _LOG.warning("Claim on %s was given up, fetching it here", url)
+      self._do_fetch_claimed_url(result, url)
+    except Exception, e:
+      _LOG.error("Failed to fetch %s: %s", url, e)
+      # Let the other processes have a go rather than wait for us, and let
+      # later requests for the url try again rather than get this failure.
+      self._release_claim(url)
+      self._remove_in_flight(url)
+      self.scheduler.add_thunk(lambda: result.fail(e))
+
+  # Does the work of fetching from the backend once this process holds the
+  # claim on the url, if claims are used.
+  def _do_fetch_claimed_url(self, result, url):
     # Wait for the rate limiter to give permission.
     self.limiter.wait_for_permit()
     thread_name = threading.current_thread().name
@@ -330,6 +541,7 @@ class HttpProxy(object):
         _LOG.info("Backend [%s/%s]: %s" % (thread_name, tries, url))
         response = urllib2.urlopen(request)
         raw_result = response.read()
+        content_type = response.info().gettype()
         break
       except IOError, e:
         _LOG.warning("Error [%s/%s]: %s", thread_name, tries, e)
@@ -341,21 +553,57 @@ class HttpProxy(object):
           tries += 1
         else:
           # We've retried as much as the schedule allows, it's time to give up.
-          result.fail(e)
+          self._release_claim(url)
+          self._remove_in_flight(url)
+          self.scheduler.add_thunk(lambda: result.fail(e))
           return
     decoded_result = raw_result.decode("utf8")
-    # Propagate and cache the result.
-    result.fulfill(unicode(decoded_result))
-    self.cache.add_response(timestamp, url, decoded_result)
-    # Remove this from the set of requests in flight.
+    # Cache and propagate the result. Promises aren't thread safe so the
+    # result has to be delivered on the scheduler's thread. The result is only
+    # delivered once it's been cached so a failure to cache it fails the
+    # promise instead.
+    self.cache.add_response(timestamp, url, decoded_result, content_type)
+    self._remove_in_flight(url, timestamp)
+    self.scheduler.add_thunk(lambda: result.fulfill(unicode(decoded_result)))
+
+  # Polls the cache until the response to the given url shows up. Returns None
+  # if the process fetching it gives up its claim before that, in which case
+  # this process now holds the claim.
+  def _wait_for_claimed_response(self, url, accepts):
+    while True:
+      response = self.cache.get_response(url, accepts)
+      if not response is None:
+        return response
+      if self.claims.claim(url):
+        return None
+      time.sleep(HttpProxy.CLAIM_POLL_SECS)
+
+  # Releases this process' claim on the given url, if claims are used.
+  def _release_claim(self, url):
+    if not self.claims is None:
+      self.claims.release(url)
+
+  # Removes the given url from the set of requests in flight, recording the
+  # launch time if the request went to the backend.
+  def _remove_in_flight(self, url, timestamp=None):
     self.in_flight_lock.acquire()
     try:
-      self.launch_times.add(timestamp)
-      del self.in_flight[url]
+      if not timestamp is None:
+        self.launch_times.add(timestamp)
+        self.backend_request_count += 1
+      self.in_flight.pop(url, None)
     finally:
       self.in_flight_lock.release()
 
 
+  # Returns the number of requests that have gone to the backend so far.
+  def get_backend_request_count(self):
+    self.in_flight_lock.acquire()
+    try:
+      return self.backend_request_count
+    finally:
+      self.in_flight_lock.release()
+
   def get_stats(self):
     if len(self.launch_times) < 2:
       return None
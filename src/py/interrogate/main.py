@@ -64,6 +64,16 @@ import rejseplanen
 import clock
 import collections
 import cachetools
+import multiprocessing
+import os
+import zlib
+import bisect
+import random
+import json
+import cPickle
+import store
+import gtfs
+import columnar
 
 
 logging.basicConfig(level=logging.INFO)
@@ -93,15 +103,46 @@ class Config(object):
   def get_rest_base_url(self):
     return self._get_setting("rest_base_url", None)
 
+  # Returns the max number of board windows to fetch at the same time for a
+  # single stop. Predictions are never exact so fetching windows speculatively
+  # costs some extra requests; it only pays when the latency of the backend
+  # rather than the rate limit is what holds things up.
+  def get_board_windows(self):
+    return self._get_setting("board_windows", 1)
+
   def get_http_cache(self):
     return self._get_setting("http_cache", "httpcache.db")
 
+  # Returns the file used to store what's been learned between runs.
+  def get_store(self):
+    return self._get_setting("store", "%s.store" % self.get_http_cache())
+
   def get_http_user_agent(self):
     return self._get_setting("http_user_agent", _CHROME_USER_AGENT)
 
   def get_date(self):
     return self._get_setting("date", None)
 
+  # Returns the list of dates to fetch plans for. The dates setting can be a
+  # list, a comma-separated string, or a range of the form "first-last";
+  # without it the single date setting is used.
+  def get_dates(self):
+    value = self._get_setting("dates", None)
+    if value is None:
+      date = self.get_date()
+      return [] if (date is None) else [date]
+    if not isinstance(value, basestring):
+      return list(value)
+    if "-" in value:
+      (first, last) = value.split("-")
+      result = [first]
+      while result[-1] != last:
+        if len(result) > 366:
+          raise AssertionError("Invalid date range %s" % value)
+        result.append(clock.get_next_date(result[-1]))
+      return result
+    return value.split(",")
+
   def get_time_range_start(self):
     return self._get_subsetting("time_range", "start", None)
 
@@ -114,6 +155,91 @@ class Config(object):
   def get_route_whitelist(self):
     return self.config.get("route_whitelist", [])
 
+  # Returns the list of transport modes to restrict boards to, None for all of
+  # them. Unless they're configured explicitly they're derived from the route
+  # whitelist.
+  def get_transport_modes(self):
+    value = self._get_setting("transport_modes", None)
+    if value is None:
+      return derive_transport_modes(self.get_route_whitelist())
+    if isinstance(value, basestring):
+      value = value.split(",")
+    if "all" in value:
+      return None
+    return value
+
+  # Returns the name of the format to ask the backend to respond in.
+  def get_response_format(self):
+    return self._get_setting("response_format", rejseplanen.XML.name)
+
+  # Returns the max number of requests to send to the backend in the turns
+  # that expand the scope to explain the transits left unexplained.
+  def get_expansion_budget(self):
+    return self._get_setting("expansion_budget", 1000)
+
+  # Returns true if journeys should be reused from the last date interrogated
+  # before where its timetable is the same.
+  def get_delta(self):
+    return self._get_setting("delta", False)
+
+  # Returns the fraction of reused journeys that are fetched anyway to verify
+  # that they haven't changed.
+  def get_delta_verify_rate(self):
+    return self._get_setting("delta_verify_rate", 0.05)
+
+  # Returns the file to keep checkpoints of the progress of the run in. Each
+  # shard worker keeps its own.
+  def get_checkpoint(self):
+    result = self._get_setting("checkpoint", "%s.checkpoint" % self.get_store())
+    shard_index = self.get_shard_index()
+    if not shard_index is None:
+      result = "%s.%i" % (result, shard_index)
+    return result
+
+  # Returns the number of seconds between checkpoints, 0 to not checkpoint.
+  # Runs only checkpoint when asked to, either by giving an interval or by
+  # resuming, which keeps checkpointing every five minutes by default.
+  def get_checkpoint_interval(self):
+    default = 300 if self.get_resume() else 0
+    return self._get_setting("checkpoint_interval", default)
+
+  # Returns true if the run should resume from the last checkpoint of the
+  # same run rather than start over.
+  def get_resume(self):
+    return self._get_setting("resume", False)
+
+  # Returns the directory to write the timetables to as a GTFS feed, None to
+  # not write one. The feed is written as journeys resolve so it's only
+  # supported when running a single shard.
+  def get_gtfs(self):
+    return self._get_setting("gtfs", None)
+
+  def get_columnar(self):
+    return self._get_setting("columnar", None)
+
+  def get_shards(self):
+    return self._get_setting("shards", 1)
+
+  def get_shard_index(self):
+    return self.vars["shard_index"]
+
+  # Returns the file used to share the rate limit between processes, None if
+  # the limit doesn't need to be shared.
+  def get_rate_limiter_file(self):
+    default = None
+    if self.get_shards() > 1:
+      default = "%s.limiter" % self.get_http_cache()
+    return self._get_setting("rate_limiter_file", default)
+
+  # Returns the file the workers of a sharded interrogation use to claim urls
+  # so only one of them fetches each, None if not running as a worker.
+  def get_url_claims_file(self):
+    return self.vars["url_claims_file"]
+
+  # Is this the coordinating process of a sharded interrogation?
+  def is_coordinator(self):
+    return (self.get_shards() > 1) and (self.get_shard_index() is None)
+
   # Returns the value of the setting with the given name.
   def _get_setting(self, name, default=None):
     if self.vars[name] is None:
@@ -134,10 +260,29 @@ class Config(object):
     _LOG.info("max accum: %s", self.get_max_accum())
     _LOG.info("rest base url: %s", self.get_rest_base_url())
     _LOG.info("parallelism: %s", self.get_parallelism())
+    _LOG.info("board windows: %s", self.get_board_windows())
     _LOG.info("http cache: %s", self.get_http_cache())
+    _LOG.info("store: %s", self.get_store())
     _LOG.info("http user agent: %s", self.get_http_user_agent())
-    _LOG.info("date: %s" % self.get_date())
+    _LOG.info("dates: %s" % ", ".join(self.get_dates()))
     _LOG.info("time range: %s - %s" % (self.get_time_range_start(), self.get_time_range_end()))
+    _LOG.info("response format: %s", self.get_response_format())
+    _LOG.info("transport modes: %s", self.get_transport_modes())
+    _LOG.info("expansion budget: %s", self.get_expansion_budget())
+    _LOG.info("delta: %s", self.get_delta())
+    if self.get_delta():
+      _LOG.info("delta verify rate: %s", self.get_delta_verify_rate())
+    if self.get_checkpoint_interval() > 0:
+      _LOG.info("checkpoint: %s every %ss", self.get_checkpoint(),
+        self.get_checkpoint_interval())
+    _LOG.info("resume: %s", self.get_resume())
+    if not self.get_gtfs() is None:
+      _LOG.info("gtfs: %s", self.get_gtfs())
+    if not self.get_columnar() is None:
+      _LOG.info("columnar: %s", self.get_columnar())
+    _LOG.info("shards: %s", self.get_shards())
+    if not self.get_shard_index() is None:
+      _LOG.info("shard index: %s", self.get_shard_index())
     for hub in self.get_hubs():
       _LOG.info("- hub: %s", hub)
 
@@ -145,7 +290,7 @@ class Config(object):
   def validate(self):
     if self.get_rest_base_url() is None:
       raise AssertionError("No rest_base_url specified")
-    if self.get_date() is None:
+    if len(self.get_dates()) == 0:
       raise AssertionError("No date specified")
     if self.get_hubs() is None:
       raise AssertionError("No hubs specified")
@@ -153,6 +298,21 @@ class Config(object):
       raise AssertionError("No time range start specified")
     if self.get_time_range_end() is None:
       raise AssertionError("No time range end specified")
+    if not self.get_response_format() in rejseplanen.FORMATS:
+      raise AssertionError("Unknown response format %s" % self.get_response_format())
+    for mode in (self.get_transport_modes() or []):
+      if not mode in rejseplanen.TRANSPORT_MODES:
+        raise AssertionError("Unknown transport mode %s" % mode)
+    if not (0 <= self.get_delta_verify_rate() <= 1):
+      raise AssertionError("Delta verify rate %s out of range" % self.get_delta_verify_rate())
+    if self.get_resume() and (self.get_checkpoint_interval() <= 0):
+      raise AssertionError("Can't resume without checkpoints")
+    if (not self.get_gtfs() is None) and (self.get_shards() > 1):
+      raise AssertionError("Can't write a gtfs feed from a sharded run")
+    shard_index = self.get_shard_index()
+    if not shard_index is None:
+      if not (0 <= shard_index < self.get_shards()):
+        raise AssertionError("Shard index %s out of range" % shard_index)
 
   # Parses and returns the yaml config.
   def _parse_config(self, filename):
@@ -173,6 +333,78 @@ class StringFilter(object):
     return False
 
 
+# Characters that end the literal prefix of a regexp.
+_REGEXP_SPECIALS = ".^$*+?{}[]\\|()"
+
+
+# Returns the part of the given regexp that matches literally at the start of
+# any string it matches, or None if it's not that simple.
+def _get_literal_prefix(pattern):
+  if "|" in pattern:
+    return None
+  end = 0
+  while (end < len(pattern)) and not (pattern[end] in _REGEXP_SPECIALS):
+    end += 1
+  if (end < len(pattern)) and (pattern[end] in "*?{"):
+    # The last literal character is optional.
+    end -= 1
+  return pattern[:end]
+
+
+# Given a list of route whitelist patterns returns the list of transport modes
+# that routes matching them can belong to, or None if that can't be determined
+# for all of them in which case boards can't be restricted.
+def derive_transport_modes(patterns):
+  if len(patterns) == 0:
+    return None
+  modes = set()
+  for pattern in patterns:
+    prefix = _get_literal_prefix(pattern)
+    if prefix is None:
+      return None
+    pattern_modes = [mode
+      for (mode, names) in rejseplanen.ROUTE_NAME_PREFIXES.items()
+      if any(prefix.startswith(name) for name in names)]
+    if len(pattern_modes) == 0:
+      return None
+    modes.update(pattern_modes)
+  return [mode for mode in rejseplanen.ROUTE_NAME_PREFIXES if mode in modes]
+
+
+# A filter that splits routes between a number of shards based on a stable
+# hash of their names. A filter for a single shard contains everything.
+class ShardFilter(object):
+
+  def __init__(self, index, count):
+    self.index = index
+    self.count = count
+
+  def contains(self, route_name):
+    if self.count == 1:
+      return True
+    hash = zlib.crc32(route_name.encode("utf8")) & 0xffffffff
+    return (hash % self.count) == self.index
+
+
+# Returns the duration of the longest journey of the given route info, None if
+# there is none. Journeys of the same sub-route take the same time so only the
+# sub-routes need looking at.
+def _get_longest_journey_duration(route_info):
+  result = None
+  if route_info is None:
+    return result
+  for sub_route in route_info.get_sub_routes():
+    if len(sub_route.get_names()) == 0:
+      continue
+    departure = sub_route.get_departures()[0]
+    arrival = sub_route.get_arrivals()[-1]
+    if (departure is None) or (arrival is None):
+      continue
+    if (result is None) or (arrival - departure > result):
+      result = arrival - departure
+  return result
+
+
 # A collection of information about a route.
 class RouteInfo(object):
 
@@ -185,89 +417,739 @@ class RouteInfo(object):
   def get_journeys(self):
     return self.journeys
 
-# A utility for tracking which ranges have been covered in an interval. Coverage
-# trackers are immutable so adding a range produces a new tracker rather than
-# change the existing one.
+  # Returns a map from the sub-routes of this route to the journeys running
+  # them, in the order the sub-routes first occur.
+  def get_sub_routes(self):
+    result = collections.OrderedDict()
+    for journey in self.journeys:
+      result.setdefault(journey.get_sub_route(), []).append(journey)
+    return result
+
+# A utility for tracking which ranges have been covered in an interval. The
+# covered ranges are kept coalesced and sorted in two parallel lists, one of
+# starts and one of ends, so the ranges that matter for an update or a query
+# can be found by bisection. With speculative windows and long time ranges a
+# board can easily accumulate hundreds of them. Unlike the rest of the
+# pipeline state trackers are changed in place; use copy to get one that can
+# be changed separately.
 class CoverageTracker(object):
 
-  def __init__(self, ranges=[]):
-    # Sorted list of coalesced ranges that have been covered. The way this is
-    # going to be used there won't be many ranges so we can afford to be a bit
-    # wasteful here.
-    self.ranges = ranges
+  def __init__(self, ranges=()):
+    self.starts = []
+    self.ends = []
+    for (start, end) in ranges:
+      self.add_range(start, end)
 
-  # Marks the range from start to end (inclusive) as being covered. Note that
-  # this doesn't change this tracker, it creates a new one.
+  # Marks the range from start to end (inclusive) as being covered. This
+  # changes the tracker in place and deliberately returns nothing so a caller
+  # that expects a new tracker fails rather than aliasing this one; use copy
+  # to extend a tracker that is shared.
   def add_range(self, start, end):
-    new_ranges = []
-    index = 0
-    # Copy over the ranges that come fully before this one.
-    while index < len(self.ranges):
-      (s, e) = self.ranges[index]
-      if e >= start - 1:
-        # We've found a range that doesn't come before this one so stop.
-        break
-      else:
-        new_ranges.append((s, e))
-        index += 1
-    if index == len(self.ranges):
-      # All ranges come before this one so just add it at the end and we're
-      # done.
-      return CoverageTracker(new_ranges + [(start, end)])
-    # If the start point of the first range that comes after this one is before
-    # this one we consume it.
-    (first_start, _) = self.ranges[index]
-    start = min(first_start, start)
-    # Now scan through the next ranges and if they fall within this one consume
-    # them. Break when we see one that reaches past the end of the one to add.
-    while index < len(self.ranges):
-      (s, e) = self.ranges[index]
-      if e > end:
-        break
-      else:
-        index += 1
-    if index < len(self.ranges):
-      # If the last range overlaps with this one adjust the bounds to cover that
-      # one as well and then consume it.
-      (last_start, last_end) = self.ranges[index]
-      if last_start <= end + 1:
-        index += 1
-        end = max(end, last_end)
-    # Add this range and any ranges that follow.
-    new_ranges.append((start, end))
-    return CoverageTracker(new_ranges + self.ranges[index:])
+    # The ranges that overlap or touch this one are those from the first that
+    # ends no earlier than just before it up to the last that starts no later
+    # than just after it. They all get replaced by a single range.
+    lo = bisect.bisect_left(self.ends, start - 1)
+    hi = bisect.bisect_right(self.starts, end + 1)
+    if lo < hi:
+      start = min(start, self.starts[lo])
+      end = max(end, self.ends[hi - 1])
+    self.starts[lo:hi] = [start]
+    self.ends[lo:hi] = [end]
 
   # Returns the least value within start and end (inclusive) that has not been
   # covered by a range.
   def get_next_uncovered(self, start, end):
-    for (s, e) in self.ranges:
-      if s <= start and start <= e:
-        if e < end:
-          return e + 1
-        else:
-          return None
+    index = bisect.bisect_right(self.starts, start) - 1
+    if (index >= 0) and (start <= self.ends[index]):
+      last = self.ends[index]
+      if last < end:
+        return last + 1
+      else:
+        return None
     return start
 
+  # Returns a list of the (start, end) ranges (inclusive) within start and end
+  # that have not been covered.
+  def get_uncovered(self, start, end):
+    result = []
+    index = bisect.bisect_right(self.starts, start) - 1
+    if (index >= 0) and (start <= self.ends[index]):
+      start = self.ends[index] + 1
+    index += 1
+    while start <= end:
+      if index == len(self.starts) or self.starts[index] > end:
+        result.append((start, end))
+        break
+      if start < self.starts[index]:
+        result.append((start, self.starts[index] - 1))
+      start = self.ends[index] + 1
+      index += 1
+    return result
+
+  # Returns the list of coalesced (start, end) ranges that have been covered.
+  def get_ranges(self):
+    return zip(self.starts, self.ends)
+
+  # Returns a new tracker that covers the same ranges as this one.
+  def copy(self):
+    result = CoverageTracker()
+    result.starts = list(self.starts)
+    result.ends = list(self.ends)
+    return result
+
 
 SEC_IN_MILLIS = 1000
 MIN_IN_MILLIS = 60 * SEC_IN_MILLIS
 HOUR_IN_MILLIS = 60 * MIN_IN_MILLIS
+DAY_IN_MILLIS = 24 * HOUR_IN_MILLIS
+
+
+# How far apart to space speculative windows relative to the span of the last
+# board for the same stop. A little overlap is cheaper than a gap which costs
+# a whole extra request.
+_WINDOW_STEP = 0.9
+
+# How many of the most recent boards for a stop to predict from.
+_WINDOW_HISTORY = 8
+
+
+# Decides which board windows to fetch for a stop. Each board only covers the
+# time until its last transit so the start of the next window isn't known
+# until the previous one has been fetched. Once a board has been seen for a
+# stop, though, the span of the next ones can be predicted from it and a
+# number of windows can be fetched at the same time. Any gaps left because a
+# prediction was off are filled in by the windows planned next.
+class WindowPlanner(object):
+
+  def __init__(self, max_windows):
+    self.max_windows = max_windows
+    # Map from (type, id) to the spans of the last boards fetched.
+    self.spans = {}
+
+  # Records that a board for the given key had transits from first to last.
+  # The time between the start of the window and the first transit isn't
+  # counted, a board that starts in a quiet period says nothing about how much
+  # the next ones cover.
+  def record(self, key, first, last):
+    if last > first:
+      spans = self.spans.get(key)
+      if spans is None:
+        spans = collections.deque(maxlen=_WINDOW_HISTORY)
+        self.spans[key] = spans
+      spans.append(last - first)
+
+  # Returns the list of timestamps to fetch windows from next in order to cover
+  # the range from start to end of the given coverage. An empty list means that
+  # the range is covered.
+  def plan(self, key, coverage, start, end):
+    gaps = coverage.get_uncovered(start, end)
+    if len(gaps) == 0:
+      return []
+    timestamp = gaps[0][0]
+    result = [timestamp]
+    spans = self.spans.get(key)
+    if spans is None:
+      return result
+    # Busy stops vary a lot from board to board so go by the median of the
+    # recent ones.
+    span = sorted(spans)[len(spans) // 2]
+    step = max(1, int(span * _WINDOW_STEP) // MIN_IN_MILLIS) * MIN_IN_MILLIS
+    index = 0
+    while len(result) < self.max_windows:
+      timestamp += step
+      # Skip to the first gap that isn't over yet.
+      while (index < len(gaps)) and (gaps[index][1] < timestamp):
+        index += 1
+      if index == len(gaps):
+        break
+      timestamp = max(timestamp, gaps[index][0])
+      result.append(timestamp)
+    return result
+
+
+# The number of bits of an explanation key used for the timestamp.
+_TIMESTAMP_BITS = 42
+
+
+# Keeps track of which of the transits seen on boards have been explained by
+# the stops of a journey. Transits and journeys are added as they come in,
+# over all the turns, so the index never needs to be rebuilt. Each (route,
+# type, stop) combination is interned as an integer which, together with the
+# timestamp, makes a single integer key. The transits still waiting for an
+# explanation are bucketed by hour so queries only look at the hours within
+# the range they ask about.
+class ExplanationIndex(object):
+
+  def __init__(self):
+    # Map from route name to type to stop name to interned id.
+    self.ids = {}
+    self.id_count = 0
+    self.explained = set()
+    # Map from hour to a map from key to the unexplained transit.
+    self.pending = {}
+    self.journeys = set()
+
+  # Returns the key for the given transit values.
+  def _get_key(self, route_name, type, stop_name, timestamp):
+    types = self.ids.get(route_name)
+    if types is None:
+      types = self.ids[route_name] = {}
+    stops = types.get(type)
+    if stops is None:
+      stops = types[type] = {}
+    id = stops.get(stop_name)
+    if id is None:
+      id = stops[stop_name] = self.id_count
+      self.id_count += 1
+    return (id << _TIMESTAMP_BITS) | timestamp
+
+  # Adds transits that need to be explained. Adding the same transit again
+  # makes no difference.
+  def add_transits(self, transits):
+    for transit in transits:
+      timestamp = transit.get_timestamp()
+      key = self._get_key(transit.get_route_name(), transit.get_type(),
+        transit.get_stop(), timestamp)
+      if key in self.explained:
+        continue
+      hour = timestamp // HOUR_IN_MILLIS
+      bucket = self.pending.get(hour)
+      if bucket is None:
+        bucket = self.pending[hour] = {}
+      bucket[key] = transit
+
+  # Adds a journey, all the stops of which explain the corresponding
+  # transits.
+  def add_journey(self, journey):
+    if journey in self.journeys:
+      return
+    self.journeys.add(journey)
+    for stop in journey.get_stops():
+      route_name = stop.get_route_name()
+      stop_name = stop.get_name()
+      arrival = stop.get_arrival()
+      if not arrival is None:
+        self._explain(self._get_key(route_name, rejseplanen.ARRIVAL, stop_name,
+          arrival), arrival)
+      departure = stop.get_departure()
+      if not departure is None:
+        self._explain(self._get_key(route_name, rejseplanen.DEPARTURE,
+          stop_name, departure), departure)
+
+  def _explain(self, key, timestamp):
+    self.explained.add(key)
+    bucket = self.pending.get(timestamp // HOUR_IN_MILLIS)
+    if not bucket is None:
+      bucket.pop(key, None)
+
+  # Returns the transits between start and end (inclusive) that haven't been
+  # explained.
+  def get_unexplained_transits(self, start, end):
+    result = []
+    for hour in range(start // HOUR_IN_MILLIS, end // HOUR_IN_MILLIS + 1):
+      bucket = self.pending.get(hour)
+      if bucket is None:
+        continue
+      for transit in bucket.itervalues():
+        if start <= transit.get_timestamp() <= end:
+          result.append(transit)
+    return result
+
+
+# Fetches the boards of route terminuses as soon as they turn up on hub boards
+# rather than waiting for all the hub boards to come in. Only routes that have
+# been seen both arriving and departing are fetched since the others get
+# dropped when the terminuses are joined. Terminuses are shared between the
+# pipelines of all the dates being interrogated: those seen on the hub boards
+# of one date are fetched for all of them, and the pipelines of later turns
+# start out fetching all the terminuses seen so far. The boards end up in the
+# transit cache of each pipeline where its route pipelines pick them up.
+class TerminusPrefetcher(object):
+
+  _TYPES = [rejseplanen.DEPARTURES, rejseplanen.ARRIVALS]
+
+  def __init__(self, route_whitelist, shard):
+    self.route_whitelist = route_whitelist
+    self.shard = shard
+    # Map from route names to starts and ends respectively.
+    self.sides = [{}, {}]
+    self.pipelines = []
+
+  # Starts a new turn, the pipelines of the last one are done.
+  def start_round(self):
+    self.pipelines = []
+
+  # Adds a pipeline of the current turn and starts fetching the boards of all
+  # the terminuses known so far for it.
+  def add_pipeline(self, pipeline):
+    self.pipelines.append(pipeline)
+    (starts, ends) = self.sides
+    for route_name in sorted(starts.keys()):
+      if route_name in ends:
+        for side in [0, 1]:
+          for terminus in sorted(self.sides[side][route_name]):
+            pipeline._fetch_transits_by_name(self._TYPES[side], terminus)
+
+  # Given a side (0 for hub arrivals, 1 for hub departures) and transits from
+  # a hub board, starts fetching the boards of their terminuses.
+  def prefetch(self, side, transits):
+    other = 1 - side
+    for transit in transits:
+      route_name = transit.get_route_name()
+      if not (self.route_whitelist.contains(route_name) and
+          self.shard.contains(route_name)):
+        continue
+      terminuses = self.sides[side].setdefault(route_name, set())
+      terminus = transit.get_terminus()
+      if terminus in terminuses:
+        continue
+      terminuses.add(terminus)
+      if not route_name in self.sides[other]:
+        continue
+      if len(terminuses) == 1:
+        # The route just turned out to be going somewhere so fetch the
+        # terminuses already seen on the other side.
+        for other_terminus in sorted(self.sides[other][route_name]):
+          self._fetch(self._TYPES[other], other_terminus)
+      self._fetch(self._TYPES[side], terminus)
+
+  def _fetch(self, type, name):
+    for pipeline in self.pipelines:
+      pipeline._fetch_transits_by_name(type, name)
+
+
+# Reuses the journeys of the last date interrogated before a given date, where
+# the timetable hasn't changed, and records the journeys of the date for the
+# dates after it. The terminus boards of the two dates are compared: where a
+# board is unchanged all of its journeys are reused, moved to the new date,
+# where it has changed only those of the transits still on it are. A fraction
+# of the reused journeys are fetched anyway to catch changes to a trip that
+# don't show on the boards.
+class TimetableDelta(object):
+
+  def __init__(self, service, date, verify_rate):
+    self.service = service
+    self.history = service.timetable_history
+    self.date = date
+    self.midnight = clock.Timestamp.from_date_time(date, "00:00")
+    self.verify_rate = verify_rate
+    # Seeded by the date such that reruns verify the same journeys.
+    self.random = random.Random(date)
+    self.reference_date = self.history.get_previous_date(date)
+    if self.reference_date is None:
+      self.reference_boards = {}
+      self.days = 0
+    else:
+      self.reference_boards = self.history.get_boards(self.reference_date)
+      self.days = clock.get_days_between(self.reference_date, date)
+    # Map from (route name, type, stop) to a map from (offset, terminus) to
+    # journey urls for this date.
+    self.boards = {}
+    # Map from (route name, type, stop) to whether the board was unchanged the
+    # last time it was checked.
+    self.checked_boards = {}
+    self.stats = collections.Counter()
+
+  # Returns the keys of the given transit's board and of the transit on it.
+  def _get_keys(self, transit):
+    board_key = (transit.get_route_name(), transit.get_type(), transit.get_stop())
+    transit_key = (transit.get_timestamp() - self.midnight, transit.get_terminus())
+    return (board_key, transit_key)
+
+  # Compares the given terminus board, a list of transits of a single route,
+  # to the one on the reference date.
+  def check_board(self, transits):
+    if (len(transits) == 0) or (self.reference_date is None):
+      return
+    (board_key, _) = self._get_keys(transits[0])
+    reference = self.reference_boards.get(board_key)
+    keys = [self._get_keys(t)[1] for t in transits]
+    unchanged = (not reference is None) and (reference[0] == self.history.get_fingerprint(keys))
+    self.checked_boards[board_key] = unchanged
+
+  # Returns a promise for the journey of the given transit if it can be
+  # reused from the reference date, otherwise None.
+  def get_journey(self, transit):
+    (board_key, transit_key) = self._get_keys(transit)
+    reference = self.reference_boards.get(board_key)
+    if reference is None:
+      return None
+    entry = reference[1].get(transit_key)
+    if entry is None:
+      return None
+    (url, days) = entry
+    self.stats["reused journeys"] += 1
+    moved_p = self.service.get_moved_journey(transit, url, days + self.days)
+    if self.random.random() >= self.verify_rate:
+      return moved_p
+    fetched_p = self.service.get_journey(transit)
+    def verify(journeys):
+      (moved, fetched) = journeys
+      self.stats["verified journeys"] += 1
+      if _get_stop_times(moved) != _get_stop_times(fetched):
+        _LOG.warning("Journey of %s changed since %s", transit, self.reference_date)
+        self.stats["changed journeys"] += 1
+      return fetched
+    return self.service.scheduler.join([moved_p, fetched_p]).then(verify)
+
+  # Records the journey that explains the given transit.
+  def add_journey(self, transit, journey):
+    (board_key, transit_key) = self._get_keys(transit)
+    url = journey.get_source_url()
+    days = 0
+    reference = self.reference_boards.get(board_key)
+    if not reference is None:
+      entry = reference[1].get(transit_key)
+      if (not entry is None) and (entry[0] == url):
+        # The journey was reused so it's further from its url's date.
+        days = entry[1] + self.days
+    self.boards.setdefault(board_key, {})[transit_key] = (url, days)
+
+  # Stores the journeys of this date for the dates after it.
+  def save(self):
+    self.history.add_boards(self.date, self.boards)
+    if not self.reference_date is None:
+      unchanged_count = len([v for v in self.checked_boards.values() if v])
+      self.stats["unchanged boards"] = unchanged_count
+      self.stats["changed boards"] = len(self.checked_boards) - unchanged_count
+      _LOG.info("Delta of %s from %s: %s", self.date, self.reference_date,
+        ", ".join("%s %i" % item for item in sorted(self.stats.items())))
+
+
+# Returns a list of the (name, arrival, departure) of the stops of the given
+# journey.
+def _get_stop_times(journey):
+  return [(s.get_name(), s.get_arrival(), s.get_departure()) for s in journey.get_stops()]
+
+
+# Returns the given value pickled, and compressed just enough to keep the size
+# of checkpoints down, such that it can be stored.
+def _pickle(value):
+  return buffer(zlib.compress(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL), 1))
+
+
+def _unpickle(blob):
+  return cPickle.loads(zlib.decompress(blob))
+
+
+# Checkpoints the progress of an interrogation such that a run that's cut short
+# can be resumed from where it got to. The http cache saves fetching again but
+# resuming from that still means parsing every response again; a checkpoint
+# holds the boards, journeys and stops completed so far as they were parsed.
+# Each save only writes what was completed since the last one so saves don't
+# get slower as the run goes on. Progress values, like how far back the boards
+# of each date start, are small and written in full. A checkpoint is only
+# resumed by the run it was made for, identified by the run key. Without a
+# store nothing is saved.
+class Checkpoint(object):
+
+  def __init__(self, run_key, interval, store=None):
+    self.run_key = run_key
+    self.interval = interval
+    self.store = store
+    self.last_save = time.time()
+    # Map from (date, type, id) to the boards and lists of (key, journey) and
+    # (name, stop info) pairs completed since the last save.
+    self.boards = {}
+    self.journeys = []
+    self.stops = []
+    self.progress = {}
+    # Map from date to the boards restored for it, until the date picks them
+    # up.
+    self.restored_boards = {}
+    if not self.store is None:
+      self.store.execute_all([
+        ("CREATE TABLE IF NOT EXISTS checkpoint_boards (date, type, id, board, PRIMARY KEY (date, type, id))", ()),
+        ("CREATE TABLE IF NOT EXISTS checkpoint_batches (batch INTEGER PRIMARY KEY, journeys, stops)", ()),
+        ("CREATE TABLE IF NOT EXISTS checkpoint_progress (name PRIMARY KEY, value)", ())])
+
+  # Discards any saved checkpoint and starts over for this run.
+  def clear(self):
+    if self.store is None:
+      return
+    self.store.execute_all([
+      ("DELETE FROM checkpoint_boards", ()),
+      ("DELETE FROM checkpoint_batches", ()),
+      ("DELETE FROM checkpoint_progress", ()),
+      ("INSERT INTO checkpoint_progress VALUES (?, ?)", ("run", self.run_key))])
+
+  # Loads the saved checkpoint. Returns a pair of maps, from transit keys to
+  # journeys and from names to stop infos, or None if there is no checkpoint
+  # of this run. The boards are kept until their dates ask for them.
+  def load(self):
+    if self.store is None:
+      return None
+    values = dict(self.store.query("SELECT name, value FROM checkpoint_progress"))
+    if values.get("run") != self.run_key:
+      return None
+    if "progress" in values:
+      self.progress = _unpickle(values["progress"])
+    for (date, type, id, board) in self.store.query(
+        "SELECT date, type, id, board FROM checkpoint_boards"):
+      (responses, ranges) = _unpickle(board)
+      self.restored_boards.setdefault(date, {})[(type, id)] = BoardCache(
+        responses, CoverageTracker(ranges))
+    journeys = {}
+    stops = {}
+    for (batch_journeys, batch_stops) in self.store.query(
+        "SELECT journeys, stops FROM checkpoint_batches ORDER BY batch"):
+      journeys.update(_unpickle(batch_journeys))
+      stops.update(_unpickle(batch_stops))
+    return (journeys, stops)
+
+  # Returns the boards restored for the given date, a map from (type, id) to
+  # board caches, and forgets them.
+  def get_boards(self, date):
+    return self.restored_boards.pop(date, {})
+
+  # Records that the given board cache for the given date and (type, id) key
+  # is complete.
+  def add_board(self, date, key, board):
+    if not self.store is None:
+      self.boards[(date,) + key] = board
+
+  # Records the given (key, journey) pairs.
+  def add_journeys(self, journeys):
+    if not self.store is None:
+      self.journeys.extend(journeys)
+
+  # Records the given (name, stop info) pairs.
+  def add_stops(self, stops):
+    if not self.store is None:
+      self.stops.extend(stops)
+
+  def get_progress(self, name, default=None):
+    return self.progress.get(name, default)
+
+  def set_progress(self, name, value):
+    self.progress[name] = value
+
+  # Is it time for the next save?
+  def is_due(self):
+    return (not self.store is None) and (time.time() - self.last_save >= self.interval)
+
+  # Saves what was recorded since the last save.
+  def save(self):
+    self.last_save = time.time()
+    if self.store is None:
+      return
+    statements = []
+    for ((date, type, id), board) in sorted(self.boards.items()):
+      statements.append((
+        "INSERT OR REPLACE INTO checkpoint_boards VALUES (?, ?, ?, ?)",
+        (date, type, id, _pickle((board.responses, board.coverage.get_ranges())))))
+    if (len(self.journeys) > 0) or (len(self.stops) > 0):
+      statements.append((
+        "INSERT INTO checkpoint_batches (journeys, stops) VALUES (?, ?)",
+        (_pickle(self.journeys), _pickle(self.stops))))
+    statements.append((
+      "INSERT OR REPLACE INTO checkpoint_progress VALUES (?, ?)",
+      ("progress", _pickle(self.progress))))
+    self.store.execute_all(statements)
+    _LOG.info("Saved checkpoint of %i boards, %i journeys and %i stops",
+      len(self.boards), len(self.journeys), len(self.stops))
+    self.boards = {}
+    self.journeys = []
+    self.stops = []
+
+  def close(self):
+    if not self.store is None:
+      self.store.close()
+
+
+# The interrogation of a single date. This is the context the pipelines for
+# the date run in; it holds the state that's particular to the date, like the
+# boards fetched in earlier turns, along with that shared between all dates.
+class DateInterrogation(object):
+
+  def __init__(self, context, date):
+    self.scheduler = context.scheduler
+    self.config = context.config
+    self.service = context.service
+    self.route_whitelist = context.route_whitelist
+    self.shard = context.shard
+    self.routes_ignored = context.routes_ignored
+    self.routes_processed = context.routes_processed
+    self.window_planner = context.window_planner
+    self.known_journeys = context.known_journeys
+    self.known_stops = context.known_stops
+    self.explanations = context.explanations
+    self.terminus_prefetcher = context.terminus_prefetcher
+    self.checkpoint = context.checkpoint
+    self.gtfs_writer = context.gtfs_writer
+    self.date = date
+    self.start = clock.Timestamp.from_date_time(date,
+      self.config.get_time_range_start())
+    self.end = clock.Timestamp.from_date_time(date,
+      self.config.get_time_range_end())
+    # When resuming the boards and starts are those of the checkpoint.
+    self.past_transit_board_cache = self.checkpoint.get_boards(date)
+    # Map from (type, stop name) to the time to start fetching boards from
+    # where that's earlier than the start of the time range.
+    self.board_starts = self.checkpoint.get_progress(("board_starts", date), {})
+    self.pipeline = None
+    self.result = None
+    self.unexplained = []
+    self.delta = None
+    if self.config.get_delta():
+      self.delta = TimetableDelta(self.service, date,
+        self.config.get_delta_verify_rate())
+
+  # Sets up the pipeline for the next turn and returns a promise for its
+  # result.
+  def start_turn(self):
+    _LOG.info("Querying %s %s->%s", self.date, clock.Timestamp.to_time(self.start),
+      clock.Timestamp.to_time(self.end))
+    self.pipeline = Pipeline(self, self.start, self.end)
+    return self.pipeline._build_pipeline()
+
+  # Records the result of the turn that was just run. Returns true if there
+  # are still unexplained transits.
+  def finish_turn(self, result):
+    self.result = result
+    self.unexplained = self._get_unexplained_transits()
+    if len(self.unexplained) == 0:
+      return False
+    self.past_transit_board_cache = self.pipeline.new_transit_board_cache
+    return True
+
+  # Expands the boards that could explain the unexplained transits for the
+  # next turn. Returns false if there was nothing to expand.
+  def expand(self):
+    if not self._expand_board_starts():
+      _LOG.info("Nothing left to expand on %s", self.date)
+      return False
+    _LOG.info("Found %i unexplained stops on %s. Expanding scope.",
+      len(self.unexplained), self.date)
+    return True
+
+  # Moves the start of the departure boards back for the starts of the routes
+  # that have unexplained transits. A transit that's left unexplained is part
+  # of a trip that departed from its start before the boards there begin so
+  # that's the only board that needs to change. How far back to go is
+  # estimated from the longest journey seen for the route, or an hour if that
+  # doesn't help. Returns false if there was nothing to expand.
+  def _expand_board_starts(self):
+    # No trip runs for more than a day.
+    floor = self.start - DAY_IN_MILLIS
+    earliest = {}
+    for transit in self.unexplained:
+      route_name = transit.get_route_name()
+      timestamp = transit.get_timestamp()
+      earliest[route_name] = min(earliest.get(route_name, timestamp), timestamp)
+    changed = False
+    for (route_name, timestamp) in sorted(earliest.items()):
+      terminuses = self.pipeline.route_terminuses.get(route_name)
+      if terminuses is None:
+        continue
+      (starts, ends) = terminuses
+      duration = _get_longest_journey_duration(self.result.routes.get(route_name))
+      for start in sorted(starts):
+        key = (rejseplanen.DEPARTURES, start)
+        current = self.board_starts.get(key, self.start)
+        if duration is None:
+          wanted = current - HOUR_IN_MILLIS
+        else:
+          wanted = timestamp - duration - MIN_IN_MILLIS
+          if wanted >= current:
+            # The boards already go back that far so the route must have
+            # longer journeys than the ones seen.
+            wanted = current - HOUR_IN_MILLIS
+        wanted = max(floor, wanted)
+        if wanted < current:
+          self.board_starts[key] = wanted
+          changed = True
+    return changed
+
+  # Returns the transits within the time range that haven't been explained
+  # and that this process is responsible for explaining.
+  def _get_unexplained_transits(self):
+    unexplained = self.explanations.get_unexplained_transits(self.start, self.end)
+    return [t for t in unexplained if self.shard.contains(t.get_route_name())]
 
 
 # The main class that sets up the interrogation pipeline.
 class Interrogate(object):
 
   def __init__(self, args):
+    # Timestamps are converted to and from rejseplanen's times in the local
+    # zone so that had better be the one they're in.
+    clock.set_timezone(rejseplanen.TIMEZONE)
     parser = self._build_option_parser()
+    self.args = args
     self.options = parser.parse_args(args)
     self.config = Config(self.options)
     self.config.validate()
     self.scheduler = promise.Scheduler()
-    self.service = self._new_service()
+    if self.config.is_coordinator():
+      # The coordinator doesn't talk to the backend itself, the shard workers
+      # do that.
+      self.service = None
+    else:
+      self.service = self._new_service()
     self.route_whitelist = StringFilter(self.config.get_route_whitelist())
+    shard_index = self.config.get_shard_index()
+    if shard_index is None:
+      self.shard = ShardFilter(0, 1)
+    else:
+      self.shard = ShardFilter(shard_index, self.config.get_shards())
     self.routes_processed = set()
     self.routes_ignored = set()
-    self.past_transit_board_cache = {}
+    # Journeys by the unique keys of the transits they explain, and stop info
+    # by stop name, resolved in earlier turns or for other dates.
+    self.known_journeys = {}
+    self.known_stops = {}
+    self.explanations = ExplanationIndex()
+    self.window_planner = WindowPlanner(self.config.get_board_windows())
+    self.terminus_prefetcher = TerminusPrefetcher(self.route_whitelist,
+      self.shard)
+    # Map from dates to the state of their interrogation.
+    self.date_interrogations = collections.OrderedDict()
+    self.gtfs_writer = None
+    if (not self.service is None) and (not self.config.get_gtfs() is None):
+      self.gtfs_writer = gtfs.GtfsWriter(self.config.get_gtfs())
+    interval = self.config.get_checkpoint_interval()
+    checkpoint_store = None
+    if (not self.service is None) and (interval > 0):
+      checkpoint_store = store.Store(self.config.get_checkpoint())
+    self.checkpoint = Checkpoint(self._get_run_key(), interval, checkpoint_store)
+    if self.config.get_resume():
+      self._restore_checkpoint()
+    else:
+      self.checkpoint.clear()
+
+  # Returns a string that identifies what this run interrogates such that a
+  # checkpoint is only resumed by the run it was made for.
+  def _get_run_key(self):
+    return json.dumps([
+      self.config.get_rest_base_url(),
+      self.config.get_response_format(),
+      self.config.get_transport_modes(),
+      self.config.get_dates(),
+      self.config.get_time_range_start(),
+      self.config.get_time_range_end(),
+      self.config.get_hubs(),
+      self.config.get_route_whitelist(),
+      self.config.get_delta(),
+      self.config.get_shards(),
+      self.config.get_shard_index()])
+
+  # Restores the journeys and stops of the last checkpoint; the boards are
+  # picked up by the dates they belong to. The turn that was cut short is run
+  # again from there, the part of it that was completed needing no requests,
+  # and rebuilds the explanations and unexplained transits as it goes.
+  def _restore_checkpoint(self):
+    restored = self.checkpoint.load()
+    if restored is None:
+      _LOG.info("No checkpoint of this run to resume from, starting over")
+      self.checkpoint.clear()
+      return
+    (journeys, stops) = restored
+    for (key, journey) in journeys.items():
+      self.known_journeys[key] = self.service.journey_index.add(journey)
+    self.known_stops.update(stops)
+    _LOG.info("Resuming with %i journeys and %i stops", len(journeys),
+      len(stops))
 
   def main(self):
     try:
@@ -289,43 +1171,146 @@ class Interrogate(object):
     stats.print_stats(.1)
     print strio.getvalue()
 
-  # Set up the pipeline, then run it.
+  # Runs the interrogation, either directly or by coordinating a set of shard
+  # workers, and outputs the result.
   def _run(self):
     self.config.log_values()
-    date = self.config.get_date()
-    range_start = self.config.get_time_range_start()
-    range_end = self.config.get_time_range_end()
-    schedule_start = clock.Timestamp.from_date_time(date, range_start)
-    schedule_end = clock.Timestamp.from_date_time(date, range_end)
-    query_start = schedule_start
-    query_end = schedule_end
-    for turn in range(0, 4):
-      _LOG.info("Querying %s->%s", clock.Timestamp.to_time(query_start), clock.Timestamp.to_time(query_end))
-      pipeline = Pipeline(self, query_start, query_end)
-      result_p = pipeline._build_pipeline()
+    if self.config.is_coordinator():
+      results = self._run_coordinator()
+    else:
+      results = self._interrogate_dates()
+    for (date, result) in results.items():
+      self._output_result(date, result)
+    print "Processed: %s" % ", ".join(sorted(self.routes_processed))
+    print "Ignored: %s" % ", ".join(sorted(self.routes_ignored))
+
+  # Splits the routes between a number of worker processes, each running its
+  # own pipeline, and merges their results. The workers share the http cache
+  # and a global rate limiter so together they stay within the allowed rate.
+  # All workers need the hub boards and many stops are shared between routes
+  # in different shards so the workers also claim urls before fetching them;
+  # a worker that needs a url another has claimed waits for that one's
+  # response to appear in the shared cache.
+  def _run_coordinator(self):
+    shards = self.config.get_shards()
+    limiter_file = self.config.get_rate_limiter_file()
+    claims_file = "%s.claims" % limiter_file
+    # Claims only make sense within a single run so start from scratch.
+    open(claims_file, "wt").close()
+    all_args = []
+    for index in range(0, shards):
+      all_args.append(self.args + [
+        "--shards", str(shards),
+        "--shard-index", str(index),
+        "--rate-limiter-file", limiter_file,
+        "--url-claims-file", claims_file])
+    pool = multiprocessing.Pool(shards)
+    try:
+      shard_results = pool.map(_run_shard, all_args)
+    finally:
+      pool.close()
+      pool.join()
+      os.remove(claims_file)
+    date_results = collections.OrderedDict()
+    for (results, processed, ignored) in shard_results:
+      for (date, result) in results.items():
+        date_results.setdefault(date, []).append(result)
+      self.routes_processed.update(processed)
+      self.routes_ignored.update(ignored)
+    return collections.OrderedDict((date, PipelineResult.merge(results))
+      for (date, results) in date_results.items())
+
+  # Runs the interrogation for the routes in this process' shard within this
+  # process and returns a tuple of the results by date and the routes
+  # processed and ignored.
+  def _run_shard(self):
+    try:
+      self.config.log_values()
+      results = self._interrogate_dates()
+      return (results, self.routes_processed, self.routes_ignored)
+    finally:
+      self._print_stats()
+      self._close()
+
+  # Interrogates the one date there is and returns the result.
+  def _interrogate(self):
+    results = self._interrogate_dates()
+    assert len(results) == 1
+    return results.values()[0]
+
+  # Set up the pipelines for all the dates, then run them. All dates share the
+  # scheduler and the service, and each turn runs the pipelines of all the
+  # dates that still have transits to explain at the same time. Returns a map
+  # from dates to their results.
+  def _interrogate_dates(self):
+    if self.config.get_delta():
+      # Each date reuses what it can from the one before so they have to be
+      # interrogated one at a time.
+      for date in self.config.get_dates():
+        interrogation = DateInterrogation(self, date)
+        self.date_interrogations[date] = interrogation
+        self._run_turns([interrogation])
+        interrogation.delta.save()
+    else:
+      for date in self.config.get_dates():
+        self.date_interrogations[date] = DateInterrogation(self, date)
+      self._run_turns(self.date_interrogations.values())
+    results = collections.OrderedDict()
+    for (date, interrogation) in self.date_interrogations.items():
+      if len(interrogation.unexplained) > 0:
+        _LOG.info("Gave up before resolving all transits on %s", date)
+        for transit in interrogation.unexplained:
+          _LOG.info("- %s", transit)
+      results[date] = interrogation.result
+    return results
+
+  # Runs turns of the pipelines of the given date interrogations until they
+  # have explained all their transits or there's no more to be done.
+  def _run_turns(self, interrogations):
+    # The budget is spent on all the dates together.
+    budget = self.config.get_expansion_budget() * len(interrogations)
+    # The number of turns run and the requests spent on the ones after the
+    # first, which carry over when resuming.
+    progress_key = ("turns", tuple(d.date for d in interrogations))
+    (turns, spent) = self.checkpoint.get_progress(progress_key, (0, 0))
+    pending = interrogations
+    while len(pending) > 0:
+      self.terminus_prefetcher.start_round()
+      request_count = self.service.get_backend_request_count()
+      result_p = self.scheduler.join([d.start_turn() for d in pending])
       try:
-        result = self._run_to_result(result_p)
+        results = self._run_to_result(result_p)
       except Exception, e:
-        print result_p.get_error_trace()
+        # Saving a checkpoint can also fail, before the turn is done.
+        if result_p.is_resolved():
+          print result_p.get_error_trace()
         raise e
-      unexplained = result.get_unexplained_transits(schedule_start, schedule_end)
-      if len(unexplained) == 0:
+      if turns > 0:
+        spent += self.service.get_backend_request_count() - request_count
+      turns += 1
+      pending = [d for (d, r) in zip(pending, results) if d.finish_turn(r)]
+      if len(pending) == 0:
         # We've now explained all stops so we can stop running.
         break
-      else:
-        # There are still unexplained stops. Expand the query interval and try
-        # again.
-        _LOG.info("Found %i unexplained stops. Expanding scope.", len(unexplained))
-        query_start -= 1 * HOUR_IN_MILLIS
-        query_end += 1 * HOUR_IN_MILLIS
-        self.past_transit_board_cache = pipeline.new_transit_board_cache
-    if len(unexplained) > 0:
-      _LOG.info("Ran out of turns before resolving all transits")
-      for transit in unexplained:
-        _LOG.info("- %s", transit)
-    self._output_result(result)
-    print "Processed: %s" % ", ".join(sorted(self.routes_processed))
-    print "Ignored: %s" % ", ".join(sorted(self.routes_ignored))
+      if spent >= budget:
+        _LOG.info("Used up the expansion budget")
+        break
+      # There are still unexplained stops. Expand the boards that could explain
+      # them and try again.
+      pending = [d for d in pending if d.expand()]
+      self.checkpoint.set_progress(progress_key, (turns, spent))
+      self._save_checkpoint_if_due()
+    self.checkpoint.set_progress(progress_key, (turns, spent))
+    self._save_checkpoint_if_due()
+
+  # Saves a checkpoint of the progress of all the dates if it's time to.
+  def _save_checkpoint_if_due(self):
+    if not self.checkpoint.is_due():
+      return
+    for (date, interrogation) in self.date_interrogations.items():
+      self.checkpoint.set_progress(("board_starts", date),
+        dict(interrogation.board_starts))
+    self.checkpoint.save()
 
   # Runs the scheduler until the given promise has resolved.
   def _run_to_result(self, promise):
@@ -333,17 +1318,22 @@ class Interrogate(object):
       self.scheduler.run_all_tasks()
       if promise.is_resolved():
         return promise.get()
-      else:
-        time.sleep(0.1)
+      self._save_checkpoint_if_due()
+      time.sleep(0.1)
 
-  def _output_result(self, result):
+  def _output_result(self, date, result):
+    columnar_dir = self.config.get_columnar()
+    if not columnar_dir is None:
+      columnar.write(os.path.join(columnar_dir, date), date, result)
     stops = result.get_stops()
-    print len(stops)
+    print date, len(stops)
     return
     for key in stops.keys():
       print key, stops[key].get_position()
 
   def _print_stats(self):
+    if self.service is None:
+      return
     stats = self.service.get_backend_stats()
     if stats is None:
       return
@@ -360,18 +1350,52 @@ class Interrogate(object):
       help="Max number of request permits that may accumulate (default: 4)")
     parser.add_argument("--parallelism", type=int,
       help="Max number of simultaneour requests to the backend (default: 1)")
+    parser.add_argument("--board-windows", type=int,
+      help="Max number of board windows to fetch at once for a stop (default: 1)")
     parser.add_argument("--rest-base-url", type=str,
       help="The base url of the rest api")
     parser.add_argument("--http-cache", type=str,
       help="The file to use for the persistent http cache (default: httpcache.db)")
+    parser.add_argument("--store", type=str,
+      help="The file to store what's been learned between runs in (default: the http cache's name + .store)")
     parser.add_argument("--http-user-agent", type=str,
       help="The user agent string to use in backend requests (default: chrome's)")
     parser.add_argument("--date", type=str,
       help="The date to fetch plans for")
+    parser.add_argument("--dates", type=str,
+      help="Comma-separated dates, or a first-last range of dates, to fetch plans for instead of a single date")
     parser.add_argument("--time-range-start", type=str,
       help="The beginning of the time range to cover")
     parser.add_argument("--time-range-end", type=str,
       help="The end of the time range to cover")
+    parser.add_argument("--response-format", type=str,
+      help="The format to ask the backend to respond in, xml or json (default: xml)")
+    parser.add_argument("--transport-modes", type=str,
+      help="Comma-separated transport modes to restrict boards to, train, bus, metro or all (default: derived from the route whitelist)")
+    parser.add_argument("--expansion-budget", type=int,
+      help="Max number of backend requests to spend explaining leftover transits (default: 1000)")
+    parser.add_argument("--delta", action="store_const", const=True,
+      help="Reuse journeys from the last date interrogated before where its timetable is the same")
+    parser.add_argument("--delta-verify-rate", type=float,
+      help="The fraction of reused journeys to fetch anyway to verify them (default: 0.05)")
+    parser.add_argument("--checkpoint", type=str,
+      help="The file to keep checkpoints of the progress of the run in (default: the store's name + .checkpoint)")
+    parser.add_argument("--checkpoint-interval", type=float,
+      help="Seconds between checkpoints, 0 to not checkpoint (default: 300 with --resume, otherwise 0)")
+    parser.add_argument("--resume", action="store_const", const=True,
+      help="Resume from the last checkpoint of the same run rather than start over")
+    parser.add_argument("--gtfs", type=str,
+      help="Directory to write the timetables to as a GTFS feed (not with --shards)")
+    parser.add_argument("--columnar", type=str,
+      help="Directory to write the timetables to as memory-mappable columns, one subdirectory per date")
+    parser.add_argument("--shards", type=int,
+      help="The number of worker processes to split the routes between (default: 1)")
+    parser.add_argument("--shard-index", type=int,
+      help="The shard to process within this worker (used internally)")
+    parser.add_argument("--rate-limiter-file", type=str,
+      help="File used to share the rate limit between processes")
+    parser.add_argument("--url-claims-file", type=str,
+      help="File used to claim urls between shard workers (used internally)")
     return parser
 
   # Creates and returns the underlying rest service wrapper.
@@ -383,14 +1407,25 @@ class Interrogate(object):
       http_user_agent=self.config.get_http_user_agent(),
       reqs_per_sec=self.config.get_reqs_per_sec(),
       max_accum=self.config.get_max_accum(),
-      parallelism=self.config.get_parallelism())
+      parallelism=self.config.get_parallelism(),
+      limiter_file=self.config.get_rate_limiter_file(),
+      claims_file=self.config.get_url_claims_file(),
+      store_file=self.config.get_store(),
+      format=rejseplanen.FORMATS[self.config.get_response_format()],
+      transport_modes=self.config.get_transport_modes())
 
   def _close(self):
-    self.service.close()
+    self.checkpoint.close()
+    if not self.gtfs_writer is None:
+      self.gtfs_writer.close()
+    if not self.service is None:
+      self.service.close()
 
 
 # A cached set of transit boards for a particular place along with a coverage
-# tracker indicating the time covered by the boards.
+# tracker indicating the time covered by the boards. A board cache is only made
+# once it's complete and is then shared between the next round and the
+# checkpoint so neither the responses nor the coverage may change after that.
 class BoardCache(object):
 
   def __init__(self, responses, coverage):
@@ -398,8 +1433,8 @@ class BoardCache(object):
     self.coverage = coverage
 
 
-# State associated with an individual pipeline. This looks a lot like an
-# instance of Interrogate but has more state.
+# State associated with an individual pipeline. This looks a lot like the
+# DateInterrogation it runs in but has more state.
 class Pipeline(object):
 
   def __init__(self, context, start, end):
@@ -408,21 +1443,43 @@ class Pipeline(object):
     self.config = context.config
     self.service = context.service
     self.route_whitelist = context.route_whitelist
+    self.shard = context.shard
     self.routes_ignored = context.routes_ignored
     self.routes_processed = context.routes_processed
     self.past_transit_board_cache = context.past_transit_board_cache
+    self.window_planner = context.window_planner
+    self.known_journeys = context.known_journeys
+    self.known_stops = context.known_stops
+    self.board_starts = context.board_starts
+    self.explanations = context.explanations
+    self.delta = context.delta
+    self.checkpoint = context.checkpoint
+    self.gtfs_writer = context.gtfs_writer
+    self.route_terminuses = None
     self.new_transit_board_cache = {}
     self.start = start
     self.end = end
     self.transit_cache = cachetools.LRUCache(maxsize=8196)
 
   # The toplevel function that creates the entire pipeline without running it.
+  # Only the hub boards are a barrier, they're needed to know all the
+  # terminuses of a route; from there each route moves through the remaining
+  # stages on its own as soon as its inputs are in.
   def _build_pipeline(self):
     hubs = self.config.get_hubs()
-    # Look up all arrivals to and departures from the hubs.
-    hub_arrivals_p = self.scheduler.join(map(self._fetch_arrivals_by_name, hubs))
-    hub_departures_p = self.scheduler.join(map(self._fetch_departures_by_name, hubs))
+    # Look up all arrivals to and departures from the hubs. Don't wait for all
+    # the hubs before starting on the terminus boards, start as soon as each
+    # hub board window comes in.
+    prefetcher = self.context.terminus_prefetcher
+    prefetcher.add_pipeline(self)
+    hub_arrival_ps = [self._fetch_transits_by_name(rejseplanen.ARRIVALS, hub,
+      lambda transits: prefetcher.prefetch(0, transits)) for hub in hubs]
+    hub_departure_ps = [self._fetch_transits_by_name(rejseplanen.DEPARTURES, hub,
+      lambda transits: prefetcher.prefetch(1, transits)) for hub in hubs]
+    hub_arrivals_p = self.scheduler.join(hub_arrival_ps)
+    hub_departures_p = self.scheduler.join(hub_departure_ps)
     hub_boards_p = self.scheduler.join([hub_departures_p, hub_arrivals_p])
+    hub_boards_p.then(self._add_boards_to_explain)
     # Extract mappings from route names to their terminuses (start and end
     # stations).
     starts_p = hub_arrivals_p.then(self._extract_terminuses)
@@ -430,42 +1487,67 @@ class Pipeline(object):
     all_terminuses_p = self.scheduler.join([starts_p, ends_p])
     # Join the starts and ends together for each route.
     route_terminuses_p = all_terminuses_p.then_apply(self._join_route_terminuses)
-    # Fetch the departures and arrivals for all the terminuses.
-    terminus_boards_p = route_terminuses_p.map_dict(self._fetch_terminus_boards)
-    # For each transit at a terminus of a route we're interested in, fetch the
-    # journey details.
-    journeys_p = terminus_boards_p.map_dict(self._fetch_terminus_board_journeys)
-    # For each route bundle all the information we've fetched up in an object.
-    routes_p = journeys_p.map_dict(self._bundle_route)
-    # Fetch information for each stop on any route.
-    stops_p = routes_p.then(self._fetch_stop_info)
+    # Fetch the terminus boards, journeys, and stops of each route.
+    route_results_p = route_terminuses_p.map_dict(self._process_route)
     # Finally bundle everything into a pipeline result.
-    result_args_p = self.scheduler.join([routes_p, terminus_boards_p, hub_boards_p, stops_p])
-    return result_args_p.then_apply(PipelineResult)
-
-  # Given the name of a stop, fetches the full departure board for that stop.
-  def _fetch_departures_by_name(self, name):
-    return self._fetch_transits_by_name(rejseplanen.DEPARTURES, name)
-
-  # Given the name of a stop, fetches the full arrival board for that stop.
-  def _fetch_arrivals_by_name(self, name):
-    return self._fetch_transits_by_name(rejseplanen.ARRIVALS, name)
+    result_args_p = self.scheduler.join([route_results_p, hub_boards_p])
+    return result_args_p.then_apply(self._bundle_result)
+
+  # Given a route name and a (starts, ends) tuple returns a promise for a
+  # (terminus boards, route info, stop infos) tuple for the route.
+  def _process_route(self, route_name, terminuses):
+    boards_p = self._fetch_terminus_boards(route_name, terminuses)
+    boards_p.then(self._add_boards_to_explain)
+    journeys_p = boards_p.then(
+      lambda boards: self._fetch_terminus_board_journeys(route_name, boards))
+    route_p = journeys_p.then(
+      lambda journeys: self._bundle_route(route_name, journeys))
+    stops_p = route_p.then(self._fetch_stop_info)
+    return self.scheduler.join([boards_p, route_p, stops_p])
+
+  # Adds the transits of the given boards, a list of lists of boards for each
+  # type, to the ones that need to be explained.
+  def _add_boards_to_explain(self, boards):
+    for type_boards in boards:
+      for board in type_boards:
+        self.explanations.add_transits(board)
+
+  # Given the results of all the route pipelines and the hub boards returns the
+  # pipeline result.
+  def _bundle_result(self, route_results, hub_boards):
+    routes = collections.OrderedDict()
+    terminus_boards = collections.OrderedDict()
+    stops = {}
+    for (route_name, (boards, route_info, stop_infos)) in route_results.items():
+      terminus_boards[route_name] = boards
+      routes[route_name] = route_info
+      stops.update(stop_infos)
+    stops = collections.OrderedDict(sorted(stops.items()))
+    return PipelineResult(routes, terminus_boards, hub_boards, stops)
 
   # Given the name of a stop, fetches either the departures or the arrivals
-  # depending on the type argument.
-  def _fetch_transits_by_name(self, type, name):
+  # depending on the type argument. If given, on_response is called with the
+  # transits of each board response as it comes in.
+  def _fetch_transits_by_name(self, type, name, on_response=None):
+    start = self.board_starts.get((type, name), self.start)
     info_p = self.service.get_location_info_by_name(name)
     id_p = info_p.then(lambda info: info.get_id())
-    return id_p.then(lambda id: self._fetch_transits_by_id(type, id))
+    return id_p.then(
+      lambda id: self._fetch_transits_by_id(type, id, on_response, start))
 
   # Fetches all the transits boards of the given type for the given id. The time
-  # to fetch within is given by the configuration.
-  def _fetch_transits_by_id(self, type, id):
+  # to fetch within is given by the configuration unless a start is given.
+  def _fetch_transits_by_id(self, type, id, on_response=None, start=None):
     cache_key = (type, id)
     cached = self.transit_cache.get(cache_key, None)
     if not cached is None:
+      if not on_response is None:
+        cached.then(on_response)
       return cached
-    result = self._fetch_transits_within(type, id, self.start, self.end).then(self._merge_transits)
+    if start is None:
+      start = self.start
+    result = self._fetch_transits_within(type, id, start, self.end,
+      on_response).then(self._merge_transits)
     self.transit_cache[cache_key] = result
     return result
 
@@ -473,7 +1555,7 @@ class Pipeline(object):
   # timestamps. This potentially causes a number of requests to be sent to
   # the service to cover the whole time period. The result is a list of transit
   # responses.
-  def _fetch_transits_within(self, type, id, start, end):
+  def _fetch_transits_within(self, type, id, start, end, on_response=None):
     # Get the cached past value. If this is a subsequent round it's likely that
     # most of the transits have already been fetched.
     cache_key = (type, id)
@@ -482,32 +1564,63 @@ class Pipeline(object):
       responses = []
       past_coverage = CoverageTracker()
     else:
+      # The past board is shared with the checkpoint so extend copies of it.
       responses = list(past_cache.responses)
-      past_coverage = past_cache.coverage
-    # Adds a response to the result and possibly issues the remaining requests
-    # if there are more to send.
-    def process_response(response, start, coverage):
-      responses.append(response)
-      end = start
-      for transit in response.get_transits():
-        end = max(end, transit.get_timestamp())
-      new_coverage = coverage.add_range(start, end - 1)
-      return send_next_request(new_coverage)
+      past_coverage = past_cache.coverage.copy()
+      if not on_response is None:
+        for response in responses:
+          on_response(response.get_transits())
+    past_count = len(responses)
+    # Adds the responses for a set of windows to the result and possibly issues
+    # the remaining requests if there are more to send.
+    def process_responses(windows, window_responses, coverage):
+      for (timestamp, response) in zip(windows, window_responses):
+        responses.append(response)
+        if not on_response is None:
+          on_response(response.get_transits())
+        first = None
+        last = timestamp
+        for transit in response.get_transits():
+          transit_timestamp = transit.get_timestamp()
+          first = transit_timestamp if (first is None) else min(first, transit_timestamp)
+          last = max(last, transit_timestamp)
+        if not first is None:
+          self.window_planner.record(cache_key, first, last)
+        self.service.record_board_window(type, id, timestamp, last)
+        coverage.add_range(timestamp, last - 1)
+      return send_next_requests(coverage)
     # Sends the remaining requests, using the given coverage tracker to control
-    # which time ranges have been covered.
-    def send_next_request(coverage):
-      timestamp = coverage.get_next_uncovered(start, end)
-      if timestamp is None:
+    # which time ranges have been covered. Unless given, the windows to fetch
+    # are planned from the coverage.
+    def send_next_requests(coverage, windows=None):
+      if windows is None:
+        windows = self.window_planner.plan(cache_key, coverage, start, end)
+      if len(windows) == 0:
         # We've covered the whole range so we're done.
-        self.new_transit_board_cache[cache_key] = BoardCache(responses, coverage)
-        return responses
+        board = BoardCache(responses, coverage)
+        self.new_transit_board_cache[cache_key] = board
+        if len(responses) > past_count:
+          self.checkpoint.add_board(self.context.date, cache_key, board)
+        return self.scheduler.value(responses)
       else:
-        # There's more time left to cover so make another request.
-        response_p = self.service.get_transits(type, id, timestamp)
-        return response_p.then(lambda response: process_response(response, timestamp, coverage))
-    # Send off a request just for the start time. If we need more then the
-    # post-processing of the result will take care of issuing more requests.
-    return send_next_request(past_coverage)
+        # There's more time left to cover so make more requests.
+        response_ps = [self.service.get_transits(type, id, timestamp)
+          for timestamp in windows]
+        responses_p = self.scheduler.join(response_ps)
+        return responses_p.then(lambda rs: process_responses(windows, rs, coverage))
+    # Windows fetched in earlier runs are most likely in the http cache so
+    # load all of those that cover what's left at once.
+    known_windows = []
+    for (gap_start, gap_end) in past_coverage.get_uncovered(start, end):
+      for timestamp in self.service.get_board_windows(type, id, gap_start, gap_end):
+        if (len(known_windows) == 0) or (known_windows[-1] != timestamp):
+          known_windows.append(timestamp)
+    if len(known_windows) > 0:
+      return send_next_requests(past_coverage, known_windows)
+    # Send off a request just for the start time, or more if we know how much
+    # each is likely to cover. If we need more then the post-processing of the
+    # results will take care of issuing more requests.
+    return send_next_requests(past_coverage)
 
   # Given a list of transit board responses (which is a list of lists of
   # transits) merges all the sublists together to a flat list of transits where
@@ -559,9 +1672,12 @@ class Pipeline(object):
     all_routes = sorted(start_routes.union(end_routes))
     result = collections.OrderedDict()
     for route_name in sorted(start_routes.intersection(end_routes)):
+      if not self.shard.contains(route_name):
+        continue
       route_starts = starts.get(route_name, [])
       route_ends = ends.get(route_name, [])
       result[route_name] = (route_starts, route_ends)
+    self.route_terminuses = result
     return result
 
   # Given a route name and a (starts, ends) tuple returns a promise for the
@@ -584,44 +1700,85 @@ class Pipeline(object):
   # Given a route name and a (departure boards, arrival boards) tuple, fetches
   # the journey details for all the transit board transits of the route. The
   # result is a pair or (departure journeys, arrival journeys) matching the
-  # input lists.
+  # input lists. Most trips that arrive at an end terminus also departed from
+  # a start terminus so the arrival journeys are only fetched once the
+  # departure journeys are in, at which point most of them are already known.
   def _fetch_terminus_board_journeys(self, route_name, input):
     (departures, arrivals) = input
     # Filter out the transits that don't involve the route we're interested
-    # in.
+    # in. Transits seen in earlier turns have already been resolved so only
+    # those in the time slices added since need to go to the service.
+    # In delta mode the journeys of the date before are reused where possible.
     def fetch_filtered_journeys(all_transits):
+      keys = []
+      transits = []
       all_journeys_ps = []
       for terminus_transits in all_transits:
-        for transit in terminus_transits:
-          if transit.get_route_name() != route_name:
-            continue
-          journey_p = self.service.get_journey(transit)
+        route_transits = [t for t in terminus_transits
+          if t.get_route_name() == route_name]
+        if not self.delta is None:
+          self.delta.check_board(route_transits)
+        for transit in route_transits:
+          key = transit.get_unique_key()
+          journey = self.known_journeys.get(key)
+          if journey is None:
+            journey_p = None
+            if not self.delta is None:
+              journey_p = self.delta.get_journey(transit)
+            if journey_p is None:
+              journey_p = self.service.get_journey(transit)
+          else:
+            journey_p = self.scheduler.value(journey)
+          keys.append(key)
+          transits.append(transit)
           all_journeys_ps.append(journey_p)
-      return self.scheduler.join(all_journeys_ps)
+      def remember_journeys(journeys):
+        for journey in journeys:
+          self.explanations.add_journey(journey)
+        self.checkpoint.add_journeys([(k, j) for (k, j) in zip(keys, journeys)
+          if not k in self.known_journeys])
+        self.known_journeys.update(zip(keys, journeys))
+        if not self.gtfs_writer is None:
+          self.gtfs_writer.add_journeys(journeys)
+        if not self.delta is None:
+          for (transit, journey) in zip(transits, journeys):
+            self.delta.add_journey(transit, journey)
+        return journeys
+      return self.scheduler.join(all_journeys_ps).then(remember_journeys)
     departure_journeys_p = fetch_filtered_journeys(departures)
-    arrival_journeys_p = fetch_filtered_journeys(arrivals)
+    arrival_journeys_p = departure_journeys_p.then(
+      lambda _: fetch_filtered_journeys(arrivals))
     return self.scheduler.join([departure_journeys_p, arrival_journeys_p])
 
   def _bundle_route(self, route_name, input):
     (departure_journeys, arrival_journeys) = input
     return RouteInfo(route_name, departure_journeys, arrival_journeys)
 
-  # Returns a map from names of stops on any of the routes to info about that
-  # stop.
-  def _fetch_stop_info(self, route_info_map):
+  # Returns a promise for a map from names of stops on the given route to info
+  # about that stop.
+  def _fetch_stop_info(self, route_info):
     # First make a list of all the names to fetch so we can fetch them in
     # order. Since each request fetches a block of names, if you change the
     # order you change the requests that get sent. So it's better to stick to
     # one order.
     names = set()
-    for route_info in route_info_map.values():
-      for journey in route_info.get_journeys():
-        for stop in journey.get_stops():
-          names.add(stop.get_name())
+    for sub_route in route_info.get_sub_routes():
+      names.update(sub_route.get_names())
     infos = collections.OrderedDict()
     for name in sorted(names):
-      infos[name] = self.service.get_location_info_by_name(name)
-    return self.scheduler.join_dict(infos)
+      info = self.known_stops.get(name)
+      if info is None:
+        infos[name] = self.service.get_location_info_by_name(name)
+      else:
+        infos[name] = self.scheduler.value(info)
+    def remember_stops(infos):
+      self.checkpoint.add_stops([(n, i) for (n, i) in infos.items()
+        if not n in self.known_stops])
+      self.known_stops.update(infos)
+      if not self.gtfs_writer is None:
+        self.gtfs_writer.add_stops(infos.values())
+      return infos
+    return self.scheduler.join_dict(infos).then(remember_stops)
 
 
 class PipelineResult(object):
@@ -635,6 +1792,40 @@ class PipelineResult(object):
   def get_stops(self):
     return self.stops
 
+  # Merges the results of a number of pipelines that ran over disjoint sets of
+  # routes into a single result.
+  @staticmethod
+  def merge(results):
+    routes = {}
+    terminus_boards = {}
+    stops = {}
+    for result in results:
+      routes.update(result.routes)
+      terminus_boards.update(result.terminus_boards)
+      stops.update(result.stops)
+    def sort_dict(dict):
+      return collections.OrderedDict(sorted(dict.items()))
+    hub_boards = PipelineResult._merge_hub_boards([r.hub_boards for r in results])
+    return PipelineResult(sort_dict(routes), sort_dict(terminus_boards),
+      hub_boards, sort_dict(stops))
+
+  # Merges the hub boards of a number of pipelines. Pipelines can run a
+  # different number of turns and so cover different time ranges so the boards
+  # for each type and hub are the union of all the pipelines' transits.
+  @staticmethod
+  def _merge_hub_boards(all_hub_boards):
+    result = []
+    for type_boards in zip(*all_hub_boards):
+      merged_type_boards = []
+      for hub_boards in zip(*type_boards):
+        entries = {}
+        for board in hub_boards:
+          for transit in board:
+            entries[transit.get_unique_key()] = transit
+        merged_type_boards.append([entries[k] for k in sorted(entries.keys())])
+      result.append(merged_type_boards)
+    return result
+
   # Returns a list of transits seen on the transit boards that can't be
   # explained by verified routes.
   def get_unexplained_transits(self, start, end):
@@ -687,5 +1878,11 @@ class PipelineResult(object):
         for transit in terminus:
           yield transit
 
+# Entry-point for the worker processes of a sharded interrogation. This has to
+# be a toplevel function for multiprocessing to be able to call it.
+def _run_shard(args):
+  return Interrogate(args)._run_shard()
+
+
 if __name__ == "__main__":
   Interrogate(sys.argv[1:]).main()
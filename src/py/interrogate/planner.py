@@ -0,0 +1,431 @@
+#!/usr/bin/python
+
+
+# Journey planning over interrogated timetables. The timetable is turned into
+# connections, each a vehicle going from one stop to the next without
+# stopping, sorted by departure time, and queries are answered with the
+# connection scan algorithm: a single pass over the connections from the
+# requested time on, keeping the earliest known arrival at every stop. A
+# planner can be built from a pipeline result or from a timetable written
+# with main.py --columnar, which is what the command line uses:
+#
+#   planner.py --columnar out/01.10.14 --from "Aarhus H" --to "Kolt" --time 07:00
+#
+# With --until the planner gives the profile instead: every journey leaving
+# between --time and --until that isn't beaten by another journey leaving
+# within that range, later and arriving no later.
+
+import argparse
+import array
+import bisect
+import logging
+import sys
+import clock
+import columnar
+
+
+logging.basicConfig(level=logging.INFO)
+_LOG = logging.getLogger(__name__)
+
+
+# The time it takes to change between vehicles at a stop, unless the stop has
+# a transfer time of its own.
+DEFAULT_TRANSFER_SECONDS = 2 * 60
+
+_INFINITY = float("inf")
+
+_HOUR_IN_MILLIS = 60 * 60 * 1000
+
+
+# Raised when a query names a stop the timetable doesn't have.
+class UnknownStop(Exception):
+
+  def __init__(self, name):
+    self.name = name
+
+  def __str__(self):
+    return repr(self.name)
+
+
+# A part of a planned journey spent on a single vehicle.
+class Leg(object):
+  __slots__ = ("route_name", "origin", "departure", "destination", "arrival")
+
+  def __init__(self, route_name, origin, departure, destination, arrival):
+    self.route_name = route_name
+    self.origin = origin
+    self.departure = departure
+    self.destination = destination
+    self.arrival = arrival
+
+  def get_route_name(self):
+    return self.route_name
+
+  def get_origin(self):
+    return self.origin
+
+  def get_departure(self):
+    return self.departure
+
+  def get_destination(self):
+    return self.destination
+
+  def get_arrival(self):
+    return self.arrival
+
+  def __unicode__(self):
+    return "%s %s %s - %s %s" % (self.route_name,
+      clock.Timestamp.to_time(self.departure), self.origin,
+      clock.Timestamp.to_time(self.arrival), self.destination)
+
+  def __str__(self):
+    return unicode(self).encode("utf-8")
+
+
+# Collects the trips of a timetable and turns them into a planner.
+class _PlannerBuilder(object):
+
+  def __init__(self, day_start):
+    self.day_start = day_start
+    self.stop_indices = {}
+    self.stop_names = []
+    self.route_indices = {}
+    self.route_names = []
+    self.trip_routes = []
+    self.connections = []
+
+  def get_stop_index(self, name):
+    index = self.stop_indices.get(name)
+    if index is None:
+      index = len(self.stop_names)
+      self.stop_indices[name] = index
+      self.stop_names.append(name)
+    return index
+
+  # Adds a trip of the given route with the given (stop index, arrival,
+  # departure) stop times, in seconds since the start of the day, None where
+  # there is no time.
+  def add_trip(self, route_name, stop_times):
+    route_index = self.route_indices.get(route_name)
+    if route_index is None:
+      route_index = len(self.route_names)
+      self.route_indices[route_name] = route_index
+      self.route_names.append(route_name)
+    trip = len(self.trip_routes)
+    self.trip_routes.append(route_index)
+    for index in range(0, len(stop_times) - 1):
+      (origin, _, departure) = stop_times[index]
+      (destination, arrival, _) = stop_times[index + 1]
+      if (departure is None) or (arrival is None) or (arrival < departure):
+        continue
+      self.connections.append((departure, arrival, origin, destination, trip))
+
+  def build(self, transfer_seconds):
+    self.connections.sort()
+    return Planner(self.day_start, self.stop_names, self.route_names,
+      self.trip_routes, self.connections, transfer_seconds)
+
+
+# Returns the timestamp the times of trips running on the given date are
+# relative to, noon minus 12 hours like in GTFS.
+def _get_day_start(date):
+  return clock.Timestamp.from_date_time(date, "12:00") - 12 * _HOUR_IN_MILLIS
+
+
+# Plans journeys over the trips of a day. The connections are kept in
+# parallel arrays of ints sorted by departure, times in seconds since the
+# start of the day, and every stop has a transfer time that changing vehicles
+# there takes; staying on a vehicle takes none. The planner answers
+# earliest-arrival queries, the legs of the journey from one stop to another
+# that gets there first when leaving no earlier than some time, and profile
+# queries, all the journeys worth taking when leaving within some range of
+# times.
+class Planner(object):
+
+  def __init__(self, day_start, stop_names, route_names, trip_routes,
+      connections, transfer_seconds=DEFAULT_TRANSFER_SECONDS):
+    self.day_start = day_start
+    self.stop_names = stop_names
+    self.stop_indices = dict((n, i) for (i, n) in enumerate(stop_names))
+    self.route_names = route_names
+    self.trip_routes = array.array("i", trip_routes)
+    self.departures = array.array("i", (c[0] for c in connections))
+    self.arrivals = array.array("i", (c[1] for c in connections))
+    self.origins = array.array("i", (c[2] for c in connections))
+    self.destinations = array.array("i", (c[3] for c in connections))
+    self.trips = array.array("i", (c[4] for c in connections))
+    self.transfer_seconds = array.array("i",
+      [transfer_seconds] * len(stop_names))
+
+  # Returns a planner for the journeys of the given pipeline result, which
+  # must have been interrogated for the given date.
+  @staticmethod
+  def from_result(result, date, transfer_seconds=DEFAULT_TRANSFER_SECONDS):
+    builder = _PlannerBuilder(_get_day_start(date))
+    def to_seconds(millis, start):
+      if millis is None:
+        return None
+      return (start + millis) // 1000
+    identities = set()
+    for (route_name, route_info) in sorted(result.routes.items()):
+      for (sub_route, journeys) in route_info.get_sub_routes().items():
+        stops = [builder.get_stop_index(n) for n in sub_route.get_names()]
+        for journey in journeys:
+          identity = journey.get_identity()
+          if identity in identities:
+            continue
+          identities.add(identity)
+          start = journey.get_start() - builder.day_start
+          builder.add_trip(route_name, zip(stops,
+            [to_seconds(a, start) for a in sub_route.get_arrivals()],
+            [to_seconds(d, start) for d in sub_route.get_departures()]))
+    return builder.build(transfer_seconds)
+
+  # Returns a planner for the given columnar timetable.
+  @staticmethod
+  def from_timetable(timetable, transfer_seconds=DEFAULT_TRANSFER_SECONDS):
+    builder = _PlannerBuilder(timetable.day_start)
+    for name in timetable.stops:
+      builder.get_stop_index(name)
+    def from_column(seconds):
+      return None if (seconds == columnar.MISSING) else seconds
+    for trip in range(0, timetable.get_trip_count()):
+      stop_times = [(stop, from_column(arrival), from_column(departure))
+        for (stop, arrival, departure) in timetable.get_trip_stop_times(trip)]
+      builder.add_trip(timetable.routes[timetable.get_trip_route(trip)],
+        stop_times)
+    return builder.build(transfer_seconds)
+
+  def get_connection_count(self):
+    return len(self.departures)
+
+  # Sets the time it takes to change vehicles at the stop with the given name.
+  def set_transfer_seconds(self, name, seconds):
+    self.transfer_seconds[self._get_stop_index(name)] = seconds
+
+  def _get_stop_index(self, name):
+    index = self.stop_indices.get(name)
+    if index is None:
+      raise UnknownStop(name)
+    return index
+
+  def _to_seconds(self, timestamp):
+    return (timestamp - self.day_start) // 1000
+
+  def _to_timestamp(self, seconds):
+    return self.day_start + seconds * 1000
+
+  # Returns the legs of the journey from the stop with the given origin name
+  # to the one with the given destination name that arrives first when
+  # leaving no earlier than the given timestamp, an empty list if the origin
+  # is the destination and None if there is no such journey today.
+  def get_earliest_arrival(self, origin, destination, departure):
+    origin_index = self._get_stop_index(origin)
+    destination_index = self._get_stop_index(destination)
+    (arrivals, exits) = self._scan(origin_index, destination_index,
+      self._to_seconds(departure))
+    if arrivals[destination_index] == _INFINITY:
+      return None
+    legs = []
+    stop = destination_index
+    while stop != origin_index:
+      (board, alight) = exits[stop]
+      route_name = self.route_names[self.trip_routes[self.trips[board]]]
+      stop = self.origins[board]
+      legs.append(Leg(route_name, self.stop_names[stop],
+        self._to_timestamp(self.departures[board]),
+        self.stop_names[self.destinations[alight]],
+        self._to_timestamp(self.arrivals[alight])))
+    legs.reverse()
+    return legs
+
+  # Scans the connections from the given time, in seconds, until none can
+  # improve the arrival at the given destination. Returns the earliest
+  # arrival at each stop and, for the stops that were reached, the
+  # connections the trip that got there first was boarded and left with. If
+  # a latest departure is given no trips leaving the origin after then are
+  # boarded there.
+  def _scan(self, origin, destination, departure, latest_departure=None):
+    departures = self.departures
+    arrivals = self.arrivals
+    origins = self.origins
+    destinations = self.destinations
+    trips = self.trips
+    transfer_seconds = self.transfer_seconds
+    earliest = [_INFINITY] * len(self.stop_names)
+    earliest[origin] = departure
+    # Map from the trips that can be reached to the connection they're
+    # boarded with.
+    boarded = {}
+    exits = {}
+    for index in xrange(bisect.bisect_left(departures, departure),
+        len(departures)):
+      connection_departure = departures[index]
+      if connection_departure >= earliest[destination]:
+        break
+      trip = trips[index]
+      board = boarded.get(trip)
+      if board is None:
+        stop = origins[index]
+        ready = earliest[stop]
+        if stop != origin:
+          ready += transfer_seconds[stop]
+        elif (not latest_departure is None) and (connection_departure > latest_departure):
+          continue
+        if ready > connection_departure:
+          continue
+        board = boarded[trip] = index
+      arrival = arrivals[index]
+      stop = destinations[index]
+      if arrival < earliest[stop]:
+        earliest[stop] = arrival
+        exits[stop] = (board, index)
+    return (earliest, exits)
+
+  # Returns the profile of the journeys from the stop with the given origin
+  # name to the one with the given destination name leaving between the given
+  # start and end timestamps: a list of (departure, arrival) timestamp pairs
+  # ordered by departure, each journey arriving earlier than the ones that
+  # leave after it within the range. Connections are scanned backwards
+  # keeping, for each stop, the same kind of list of the journeys on to the
+  # destination. Journeys leaving the origin after the end can still be part
+  # of journeys that pass through it so the origin's list holds all of them,
+  # and the journeys leaving within the range are kept in a list of their own.
+  # The journey leaving last within the range arrives after all the others
+  # worth taking so if there is one only the connections before its earliest
+  # arrival are scanned.
+  def get_profile(self, origin, destination, start, end):
+    origin_index = self._get_stop_index(origin)
+    destination_index = self._get_stop_index(destination)
+    start_seconds = self._to_seconds(start)
+    end_seconds = self._to_seconds(end)
+    last = len(self.departures)
+    last_departure = self._get_last_departure(origin_index, start_seconds,
+      end_seconds)
+    if not last_departure is None:
+      (latest, exits) = self._scan(origin_index, destination_index,
+        last_departure, end_seconds)
+      if latest[destination_index] != _INFINITY:
+        last = bisect.bisect_right(self.departures, latest[destination_index])
+    departures = self.departures
+    arrivals = self.arrivals
+    origins = self.origins
+    destinations = self.destinations
+    trips = self.trips
+    transfer_seconds = self.transfer_seconds
+    # Map from trips to the earliest arrival at the destination when on them.
+    trip_arrivals = {}
+    # Map from stops to a pair of lists, the negated departures of the
+    # journeys from there in increasing order, so they can be bisected, and
+    # their arrivals which decrease in the same order.
+    profiles = {}
+    # The same kind of pair for the journeys leaving the origin within range.
+    window = ([], [])
+    for index in xrange(last - 1, bisect.bisect_left(departures, start_seconds)
+        - 1, -1):
+      trip = trips[index]
+      best = trip_arrivals.get(trip, _INFINITY)
+      stop = destinations[index]
+      if stop == destination_index:
+        best = min(best, arrivals[index])
+      else:
+        profile = profiles.get(stop)
+        if not profile is None:
+          ready = arrivals[index] + transfer_seconds[stop]
+          position = bisect.bisect_right(profile[0], -ready) - 1
+          if (position >= 0) and (profile[1][position] < best):
+            best = profile[1][position]
+      if best == _INFINITY:
+        continue
+      trip_arrivals[trip] = best
+      stop = origins[index]
+      if stop == destination_index:
+        continue
+      profile = profiles.get(stop)
+      if profile is None:
+        profile = profiles[stop] = ([], [])
+      departure = departures[index]
+      _add_to_profile(profile, departure, best)
+      if (stop == origin_index) and (departure <= end_seconds):
+        _add_to_profile(window, departure, best)
+    (negated_departures, stop_arrivals) = window
+    return [(self._to_timestamp(-negated_departure), self._to_timestamp(arrival))
+      for (negated_departure, arrival)
+      in reversed(zip(negated_departures, stop_arrivals))]
+
+  # Returns the time of the last connection from the given origin between the
+  # given start and end, in seconds, None if there is none.
+  def _get_last_departure(self, origin, start, end):
+    departures = self.departures
+    origins = self.origins
+    for index in xrange(bisect.bisect_right(departures, end) - 1,
+        bisect.bisect_left(departures, start) - 1, -1):
+      if origins[index] == origin:
+        return departures[index]
+    return None
+
+
+# Adds a journey leaving at the given departure and arriving at the given
+# arrival to a profile, unless one of the journeys leaving later arrives no
+# later. Journeys are added in decreasing order of departure.
+def _add_to_profile(profile, departure, arrival):
+  (negated_departures, arrivals) = profile
+  if (len(arrivals) > 0) and (arrivals[-1] <= arrival):
+    return
+  if (len(negated_departures) > 0) and (negated_departures[-1] == -departure):
+    arrivals[-1] = arrival
+  else:
+    negated_departures.append(-departure)
+    arrivals.append(arrival)
+
+
+def _build_option_parser():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--columnar", required=True,
+    help="The directory of a timetable written with main.py --columnar")
+  parser.add_argument("--from", dest="origin", required=True,
+    help="The name of the stop to leave from")
+  parser.add_argument("--to", dest="destination", required=True,
+    help="The name of the stop to go to")
+  parser.add_argument("--time", required=True,
+    help="The time to leave at, HH:MM")
+  parser.add_argument("--until", type=str,
+    help="Give the profile of the journeys leaving until this time, HH:MM")
+  parser.add_argument("--transfer-time", type=int,
+    default=DEFAULT_TRANSFER_SECONDS,
+    help="Seconds it takes to change vehicles (default: %i)" % DEFAULT_TRANSFER_SECONDS)
+  return parser
+
+
+def main(args):
+  options = _build_option_parser().parse_args(args)
+  timetable = columnar.read(options.columnar)
+  try:
+    planner = Planner.from_timetable(timetable, options.transfer_time)
+  finally:
+    timetable.close()
+  _LOG.info("Planning over %i connections", planner.get_connection_count())
+  origin = options.origin.decode("utf-8")
+  destination = options.destination.decode("utf-8")
+  departure = clock.Timestamp.from_date_time(timetable.date, options.time)
+  try:
+    if options.until is None:
+      legs = planner.get_earliest_arrival(origin, destination, departure)
+      if legs is None:
+        print "No journey"
+      for leg in legs or []:
+        print leg
+    else:
+      end = clock.Timestamp.from_date_time(timetable.date, options.until)
+      for (leave, arrive) in planner.get_profile(origin, destination,
+          departure, end):
+        print "%s - %s" % (clock.Timestamp.to_time(leave),
+          clock.Timestamp.to_time(arrive))
+  except UnknownStop as e:
+    print "Unknown stop %s" % e
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -1,28 +1,178 @@
 import http
+import store
 import promise
 import clock
 import abc
 import logging
 import cachetools
 import re
+import urlparse
+import io
+import json
+import collections
+import hashlib
+import xml.etree.cElementTree
 
 
 logging.basicConfig(level=logging.INFO)
 _LOG = logging.getLogger(__name__)
 
 
+# The zone the times given by rejseplanen are in.
+TIMEZONE = "Europe/Copenhagen"
+
 ARRIVALS = "arrivals"
 DEPARTURES = "departures"
 ARRIVAL = "arrival"
 DEPARTURE = "departure"
 
 
+# Streams through the given xml text and yields the elements with the given
+# tags as they are completed. After an element has been yielded it is discarded
+# along with everything before it so the full tree is never built. That means
+# the consumer has to extract what it needs from each element before asking
+# for the next one.
+def iter_xml_elements(text, tags):
+  source = io.BytesIO(text.encode("utf8"))
+  root = None
+  for (event, elm) in xml.etree.cElementTree.iterparse(source, ("start", "end")):
+    if event == "start":
+      if root is None:
+        root = elm
+    elif elm.tag in tags:
+      yield elm
+      root.clear()
+
+
+# A json object that looks enough like an xml element for the response
+# classes to read from it. Rejseplanen's json is a direct translation of its
+# xml: attributes become string properties and child elements become
+# properties holding an object, or a list of objects if there is more than one.
+# Being a dict keeps get as cheap as it is on an element.
+class JsonElement(dict):
+  __slots__ = ("tag",)
+
+  def __init__(self, tag, values):
+    super(JsonElement, self).__init__(values)
+    self.tag = tag
+
+  # Returns the first child element with the given tag, None if there is none.
+  def find(self, tag):
+    children = _as_list(dict.get(self, tag))
+    if len(children) == 0:
+      return None
+    return JsonElement(tag, children[0])
+
+
+# Returns the given json property value as a list of objects.
+def _as_list(value):
+  if value is None:
+    return []
+  elif isinstance(value, list):
+    return value
+  else:
+    return [value]
+
+
+# The xml format rejseplanen responds with by default.
+class XmlFormat(object):
+
+  name = "xml"
+
+  # Adds any parameters needed to ask for this format to the given request.
+  def add_params(self, request):
+    return request
+
+  # Returns true if a response with the given content type can be decoded in
+  # this format. Only responses known to be in another format are refused.
+  def accepts(self, content_type):
+    return (content_type is None) or not ("json" in content_type)
+
+  # Yields the elements with the given tags in the given response text.
+  def iter_elements(self, text, tags):
+    return iter_xml_elements(text, tags)
+
+
+# The json format rejseplanen responds with when asked to. It's considerably
+# cheaper to decode than the xml but the whole response has to be decoded
+# before any elements can be yielded. Elements are yielded grouped by tag in
+# the order of the given tags.
+class JsonFormat(object):
+
+  name = "json"
+
+  def add_params(self, request):
+    return request.add_param(format="json")
+
+  def accepts(self, content_type):
+    return (content_type is None) or not ("xml" in content_type)
+
+  def iter_elements(self, text, tags):
+    data = json.loads(text)
+    # The response is an object with a single property named after the root
+    # element.
+    root = data.values()[0] if (len(data) == 1) else {}
+    for tag in tags:
+      for values in _as_list(root.get(tag)):
+        yield JsonElement(tag, values)
+
+
+XML = XmlFormat()
+JSON = JsonFormat()
+
+# Map from names to the response formats.
+FORMATS = {XML.name: XML, JSON.name: JSON}
+
+
+# A table used to share a single copy of strings that occur over and over
+# again, like stop and route names, and of other immutable values like
+# sub-routes. The builtin intern only accepts byte strings. The service owns
+# one table so it lives as long as the service does; responses parsed without
+# one get a table of their own.
+class StringTable(object):
+
+  def __init__(self):
+    self.strings = {}
+
+  # Returns the canonical copy of the given string or value.
+  def get(self, value):
+    if value is None:
+      return None
+    return self.strings.setdefault(value, value)
+
+
+# The transport modes boards can be restricted to and, for each, the parameter
+# that turns it off in board requests.
+TRANSPORT_MODES = collections.OrderedDict([
+  ("train", "useTog"),
+  ("bus", "useBus"),
+  ("metro", "useMetro"),
+])
+
+# The literal prefixes of the names of the routes of each transport mode.
+ROUTE_NAME_PREFIXES = collections.OrderedDict([
+  ("train", ["IC ", "ICL ", "Lyn ", "Re ", "RE ", "Tog ", "S-tog "]),
+  ("bus", ["Bus ", "ExpB ", "Natbus ", "Flexbus ", "Togbus ", "TB "]),
+  ("metro", ["Metro "]),
+])
+
+
+# Returns the transport mode of the route with the given name, None if the
+# name doesn't tell.
+def get_transport_mode(route_name):
+  for (mode, prefixes) in ROUTE_NAME_PREFIXES.items():
+    if any(route_name.startswith(prefix) for prefix in prefixes):
+      return mode
+  return None
+
+
 # Common superclass for arrivals and departures requests.
 class AbstractTransitRequest(object):
 
   def __init__(self):
     self.id = None
     self.timestamp = None
+    self.modes = None
 
   # Sets the id of the location to fetch information about.
   def set_id(self, value):
@@ -34,10 +184,25 @@ class AbstractTransitRequest(object):
     self.timestamp = value
     return self
 
+  # Sets the transport modes to include in the board, None for all of them.
+  def set_modes(self, value):
+    self.modes = value
+    return self
+
   # Returns the date string corresponding to the timestamp.
   def get_date(self):
     return clock.Timestamp.to_date(self.timestamp)
 
+  # Adds the parameters that turn off the modes that aren't included to the
+  # given http request. Nothing is added when all modes are included so those
+  # urls stay the same as they've always been.
+  def add_mode_params(self, http_request):
+    if not self.modes is None:
+      for (mode, param) in TRANSPORT_MODES.items():
+        if not mode in self.modes:
+          http_request.add_param(**{param: 0})
+    return http_request
+
   # Returns the time string corresponding to the timestamp.
   def get_time(self):
     return clock.Timestamp.to_time(self.timestamp)
@@ -47,19 +212,23 @@ class AbstractTransitRequest(object):
 class ArrivalsRequest(AbstractTransitRequest):
   
   def get_http_request(self, service):
-    return (http.HttpRequest(service.get_request_path("arrivalBoard"))
-      .add_param(id=self.id)
-      .add_param(date=self.get_date())
-      .add_param(time=self.get_time()))
+    return self.add_mode_params(
+      http.HttpRequest(service.get_request_path("arrivalBoard"))
+        .add_param(id=self.id)
+        .add_param(date=self.get_date())
+        .add_param(time=self.get_time()))
 
-  def process_response(self, url, xml):
-    return ArrivalsResponse(url, xml)
+  def process_response(self, url, text, strings=None, format=XML):
+    return ArrivalsResponse(url, format.iter_elements(text, ["Arrival"]), strings)
 
 
 class ArrivalsResponse(object):
 
-  def __init__(self, url, xml):
-    self.arrivals = [Arrival(url, elm) for elm in xml.findall("Arrival")]
+  # Creates a response from a sequence of Arrival elements.
+  def __init__(self, url, elements, strings=None):
+    if strings is None:
+      strings = StringTable()
+    self.arrivals = [Arrival(url, elm, strings) for elm in elements]
 
   def get_arrivals(self):
     return self.arrivals
@@ -72,19 +241,24 @@ class ArrivalsResponse(object):
 class DeparturesRequest(AbstractTransitRequest):
   
   def get_http_request(self, service):
-    return (http.HttpRequest(service.get_request_path("departureBoard"))
-      .add_param(id=self.id)
-      .add_param(date=self.get_date())
-      .add_param(time=self.get_time()))
+    return self.add_mode_params(
+      http.HttpRequest(service.get_request_path("departureBoard"))
+        .add_param(id=self.id)
+        .add_param(date=self.get_date())
+        .add_param(time=self.get_time()))
 
-  def process_response(self, url, xml):
-    return DepartureResponse(url, xml)
+  def process_response(self, url, text, strings=None, format=XML):
+    return DepartureResponse(url, format.iter_elements(text, ["Departure"]),
+      strings)
 
 
 class DepartureResponse(object):
 
-  def __init__(self, url, xml):
-    self.departures = [Departure(url, elm) for elm in xml.findall("Departure")]
+  # Creates a response from a sequence of Departure elements.
+  def __init__(self, url, elements, strings=None):
+    if strings is None:
+      strings = StringTable()
+    self.departures = [Departure(url, elm, strings) for elm in elements]
 
   def get_departures(self):
     return self.departures
@@ -93,22 +267,29 @@ class DepartureResponse(object):
     return self.get_departures()
 
 
-# Abstract superclass of an individual departure or arrival.
+# Abstract superclass of an individual departure or arrival. There are a lot of
+# these around so they're kept compact: names are interned and the date and
+# time strings are derived from the timestamp when needed.
 class AbstractTransit(object):
   __metaclass__ = abc.ABCMeta
+  __slots__ = ("source_url", "timestamp", "route_name", "stop", "journey_url")
 
-  def __init__(self, source_url, xml):
+  def __init__(self, source_url, xml, strings):
     self.source_url = source_url
-    self.date = xml.get("date")
-    self.time = xml.get("time")
-    self.timestamp = clock.Timestamp.from_date_time(self.date, self.time)
-    self.route_name = xml.get("name")
-    self.stop = xml.get("stop")
+    self.timestamp = clock.Timestamp.from_date_time(xml.get("date"), xml.get("time"))
+    self.route_name = strings.get(xml.get("name"))
+    self.stop = strings.get(xml.get("stop"))
     self.journey_url = xml.find("JourneyDetailRef").get("ref")
 
   def get_timestamp(self):
     return self.timestamp
 
+  def get_date(self):
+    return clock.Timestamp.to_date(self.timestamp)
+
+  def get_time(self):
+    return clock.Timestamp.to_time(self.timestamp)
+
   def get_route_name(self):
     return self.route_name
 
@@ -137,7 +318,8 @@ class AbstractTransit(object):
     pass
 
   def __unicode__(self):
-    return "%s@%s(%s %s)" % (self.route_name, self.stop, self.date, self.time)
+    return "%s@%s(%s %s)" % (self.route_name, self.stop, self.get_date(),
+      self.get_time())
 
   def __str__(self):
     return unicode(self).encode("utf-8")
@@ -145,10 +327,11 @@ class AbstractTransit(object):
 
 # An individual arrival.
 class Arrival(AbstractTransit):
+  __slots__ = ("start",)
 
-  def __init__(self, url, xml):
-    super(Arrival, self).__init__(url, xml)
-    self.start = xml.get("origin")
+  def __init__(self, url, xml, strings):
+    super(Arrival, self).__init__(url, xml, strings)
+    self.start = strings.get(xml.get("origin"))
 
   def get_start(self):
     return self.start
@@ -168,10 +351,11 @@ class Arrival(AbstractTransit):
 
 # An individual departure.
 class Departure(AbstractTransit):
+  __slots__ = ("end",)
 
-  def __init__(self, url, xml):
-    super(Departure, self).__init__(url, xml)
-    self.end = xml.get("finalStop")
+  def __init__(self, url, xml, strings):
+    super(Departure, self).__init__(url, xml, strings)
+    self.end = strings.get(xml.get("finalStop"))
 
   def get_end(self):
     return self.end
@@ -200,23 +384,54 @@ class JourneyRequest(object):
   def get_http_request(self, service):
     return http.HttpRequest(self.url)
 
-  def process_response(self, url, xml):
-    return JourneyResponse(url, self.transit, xml)
+  def process_response(self, url, text, strings=None, format=XML):
+    elements = format.iter_elements(text, JourneyResponse.TAGS)
+    return JourneyResponse(url, self.transit, elements, strings)
 
 
 class JourneyResponse(object):
-
-  def __init__(self, source_url, transit, xml):
-    self.source_url = source_url
-    self.transit = transit
-    journey_name = xml.find("JourneyName")
-    if journey_name is None:
+  __slots__ = ("source_url", "transit", "sub_route", "start")
+
+  TAGS = ["Stop", "JourneyName"]
+
+  # Creates a response from a sequence of Stop and JourneyName elements.
+  def __init__(self, source_url, transit, elements, strings=None):
+    if strings is None:
+      strings = StringTable()
+    route_name = None
+    names = []
+    arrivals = []
+    departures = []
+    for elm in elements:
+      if elm.tag == "Stop":
+        names.append(strings.get(elm.get("name")))
+        arrivals.append(_get_timestamp(elm, "arrDate", "arrTime"))
+        departures.append(_get_timestamp(elm, "depDate", "depTime"))
+      elif route_name is None:
+        route_name = strings.get(elm.get("name"))
+    if route_name is None:
       error = InvalidResponse("Invalid XML response to %s" % source_url)
       error.add_invalid_url(source_url)
       error.add_invalid_url(transit.get_source_url())
       raise error
-    self.route_name = journey_name.get("name")
-    self.stops = map(self._wrap_stop, xml.findall("Stop"))
+    self.source_url = source_url
+    self.transit = transit
+    (self.sub_route, self.start) = SubRoute.get(route_name, names, arrivals,
+      departures, strings)
+
+  # Returns a journey of the given route calling at stops given as (name,
+  # arrival, departure) tuples.
+  @staticmethod
+  def from_stops(source_url, transit, route_name, stops, strings=None):
+    if strings is None:
+      strings = StringTable()
+    result = JourneyResponse.__new__(JourneyResponse)
+    result.source_url = source_url
+    result.transit = transit
+    (names, arrivals, departures) = zip(*stops) if stops else ([], [], [])
+    (result.sub_route, result.start) = SubRoute.get(strings.get(route_name),
+      [strings.get(n) for n in names], arrivals, departures, strings)
+    return result
 
   # Yields the url that yielded this response. Note that this url may be
   # different from the journey url given in the transit, though only very
@@ -227,14 +442,32 @@ class JourneyResponse(object):
   def get_transit(self):
     return self.transit
 
+  # Returns this journey as the journey of the given transit, which may be
+  # another sighting of the same trip.
+  def with_transit(self, transit):
+    if transit is self.transit:
+      return self
+    result = JourneyResponse.__new__(JourneyResponse)
+    result.source_url = self.source_url
+    result.transit = transit
+    result.sub_route = self.sub_route
+    result.start = self.start
+    return result
+
   def get_route_name(self):
-    return self.route_name
+    return self.sub_route.route_name
 
-  def get_stops(self):
-    return self.stops
+  def get_sub_route(self):
+    return self.sub_route
 
-  def _wrap_stop(self, xml):
-    return JourneyStop(self, xml)
+  # Returns the timestamp the times of the sub-route are relative to.
+  def get_start(self):
+    return self.start
+
+  # Returns the stops of this journey. They're made from the sub-route each
+  # time so keep the list rather than calling this over and over.
+  def get_stops(self):
+    return self.sub_route.get_stops(self.start)
 
   def has_transit(self, transit):
     for stop in self.get_stops():
@@ -242,25 +475,154 @@ class JourneyResponse(object):
         return True
     return False
 
+  # Returns a copy of this journey moved the given number of days, as the
+  # journey of the given transit. The stops keep their local times, which
+  # across a daylight saving transition changes the times relative to the
+  # start so the copy keeps the sub-route only if they don't; otherwise the
+  # new sub-route is shared through the given table.
+  def add_days(self, transit, days, strings=None):
+    def move(timestamp):
+      return None if (timestamp is None) else clock.add_days(timestamp, days)
+    stops = self.get_stops()
+    (start, arrivals, departures) = SubRoute.get_offsets(
+      [move(s.arrival) for s in stops], [move(s.departure) for s in stops])
+    result = JourneyResponse.__new__(JourneyResponse)
+    result.source_url = self.source_url
+    result.transit = transit
+    result.start = start
+    sub_route = self.sub_route
+    if (arrivals != sub_route.arrivals) or (departures != sub_route.departures):
+      if strings is None:
+        strings = StringTable()
+      sub_route = strings.get(SubRoute(sub_route.route_name, sub_route.names,
+        strings.get(arrivals), strings.get(departures)))
+    result.sub_route = sub_route
+    return result
+
+  # Returns a tuple that identifies the physical trip this is a journey of:
+  # (route name, origin, departure time, destination, arrival time).
+  def get_identity(self):
+    sub_route = self.sub_route
+    if len(sub_route.names) == 0:
+      return (sub_route.route_name, None, None, None, None)
+    departure = sub_route.departures[0]
+    arrival = sub_route.arrivals[-1]
+    return (sub_route.route_name, sub_route.names[0],
+      None if (departure is None) else self.start + departure,
+      sub_route.names[-1],
+      None if (arrival is None) else self.start + arrival)
+
+
+# Returns the timestamp given by the date and time attributes with the given
+# names, None if either is missing.
+def _get_timestamp(xml, date_attrib, time_attrib):
+  date = xml.get(date_attrib, None)
+  time = xml.get(time_attrib, None)
+  if (date is None) or (time is None):
+    return None
+  return clock.Timestamp.from_date_time(date, time)
+
+
+# The stops a journey calls at and their times relative to the start of the
+# journey, which is what the journeys of a route that take the same way at
+# the same pace have in common. Most trips of a route run one of a handful of
+# sub-routes so journeys share them and only keep their start time, and the
+# sub-routes of a route are just the distinct ones among its journeys. The
+# parts are shared through the service's string table, which works since they
+# are immutable values: sub-routes with the same route, stops and relative
+# times are equal.
+class SubRoute(object):
+  __slots__ = ("route_name", "names", "arrivals", "departures")
+
+  def __init__(self, route_name, names, arrivals, departures):
+    self.route_name = route_name
+    self.names = names
+    self.arrivals = arrivals
+    self.departures = departures
+
+  # Returns a tuple of the canonical sub-route of a journey of the given route
+  # through stops of the given names at the given arrival and departure
+  # timestamps, and the start those times are relative to: the first time
+  # there is, 0 if there is none.
+  @staticmethod
+  def get(route_name, names, arrivals, departures, strings):
+    (start, arrival_offsets, departure_offsets) = SubRoute.get_offsets(
+      arrivals, departures)
+    sub_route = SubRoute(route_name, strings.get(tuple(names)),
+      strings.get(arrival_offsets), strings.get(departure_offsets))
+    return (strings.get(sub_route), start)
+
+  # Returns a tuple of the start of a journey with the given arrival and
+  # departure timestamps and tuples of the times relative to it.
+  @staticmethod
+  def get_offsets(arrivals, departures):
+    start = None
+    for (arrival, departure) in zip(arrivals, departures):
+      start = departure if (arrival is None) else arrival
+      if not start is None:
+        break
+    if start is None:
+      start = 0
+    def offset(timestamp):
+      return None if (timestamp is None) else (timestamp - start)
+    return (start, tuple(offset(a) for a in arrivals),
+      tuple(offset(d) for d in departures))
+
+  def get_route_name(self):
+    return self.route_name
+
+  # Returns the names of the stops, in the order they're called at.
+  def get_names(self):
+    return self.names
+
+  # Returns the arrivals at the stops in milliseconds after the start, None
+  # where there is none.
+  def get_arrivals(self):
+    return self.arrivals
+
+  # Returns the departures from the stops in milliseconds after the start,
+  # None where there is none.
+  def get_departures(self):
+    return self.departures
+
+  # Returns the stops of the journey of this sub-route starting at the given
+  # timestamp.
+  def get_stops(self, start):
+    result = []
+    for (name, arrival, departure) in zip(self.names, self.arrivals,
+        self.departures):
+      result.append(JourneyStop(self.route_name, name,
+        None if (arrival is None) else start + arrival,
+        None if (departure is None) else start + departure))
+    return result
+
+  def _get_key(self):
+    return (self.route_name, self.names, self.arrivals, self.departures)
+
+  def __eq__(self, that):
+    return isinstance(that, SubRoute) and (self._get_key() == that._get_key())
+
+  def __ne__(self, that):
+    return not (self == that)
+
+  def __hash__(self):
+    return hash(self._get_key())
+
 
+# A stop on a journey. Like transits these are kept compact, only the
+# timestamps are stored and the route name is shared with the journey.
+# Journeys don't keep these, they're made from the journey's sub-route.
 class JourneyStop(object):
+  __slots__ = ("route_name", "name", "arrival", "departure")
 
-  def __init__(self, journey, xml):
-    self.journey = journey
-    self.name = xml.get("name")
-    self.arr_date = xml.get("arrDate", None)
-    self.arr_time = xml.get("arrTime", None)
-    self.arrival = None
-    if not (self.arr_date is None or self.arr_time is None):
-      self.arrival = clock.Timestamp.from_date_time(self.arr_date, self.arr_time)
-    self.dep_date = xml.get("depDate", None)
-    self.dep_time = xml.get("depTime", None)
-    self.departure = None
-    if not (self.dep_date is None or self.dep_time is None):
-      self.departure = clock.Timestamp.from_date_time(self.dep_date, self.dep_time)
+  def __init__(self, route_name, name, arrival, departure):
+    self.route_name = route_name
+    self.name = name
+    self.arrival = arrival
+    self.departure = departure
 
   def get_route_name(self):
-    return self.journey.get_route_name()
+    return self.route_name
 
   def get_name(self):
     return self.name
@@ -305,16 +667,20 @@ class LocationRequest(object):
     return (http.HttpRequest(service.get_request_path("location"))
       .add_param(input=self.input))
 
-  def process_response(self, url, xml):
-    return LocationResponse(url, xml)
+  def process_response(self, url, text, strings=None, format=XML):
+    elements = format.iter_elements(text, ["StopLocation"])
+    return LocationResponse(url, elements, strings)
 
 
 # The result of a location request.
 class LocationResponse(object):
 
-  def __init__(self, url, xml):
+  # Creates a response from a sequence of StopLocation elements.
+  def __init__(self, url, elements, strings=None):
+    if strings is None:
+      strings = StringTable()
     self.url = url
-    self.stop_locations = map(self._wrap_stop_location, xml.findall("StopLocation"))
+    self.stop_locations = [StopLocation(url, elm, strings) for elm in elements]
 
   def get_source_url(self):
     return self.url
@@ -323,24 +689,23 @@ class LocationResponse(object):
   def get_stop_locations(self):
     return self.stop_locations
 
-  def _wrap_stop_location(self, xml):
-    return StopLocation(self, xml)
-
 
 
-# Wrapper around an xml stop location object.
+# Information about a stop location extracted from a location response. The
+# attributes can come from anything with an element style get, for instance a
+# dict of values loaded from the gazetteer.
 class StopLocation(object):
+  __slots__ = ("source_url", "name", "id", "x", "y")
 
-  def __init__(self, response, xml):
-    self.response = response
-    self.name = xml.get("name")
-    self.id = xml.get("id")
+  def __init__(self, source_url, xml, strings):
+    self.source_url = source_url
+    self.name = strings.get(xml.get("name"))
+    self.id = strings.get(xml.get("id"))
     self.x = int(xml.get("x"))
     self.y = int(xml.get("y"))
-    self.xml = xml
 
   def get_source_url(self):
-    return self.response.get_source_url()
+    return self.source_url
 
   def get_name(self):
     return self.name
@@ -365,45 +730,447 @@ class UnknownLocation(Exception):
     return repr(self.name)
 
 
-# Wrapper that keeps track of information about geographic locations.
+# Parses a journey detail url into a (trip, date) pair that identifies the trip
+# independently of the board the url was taken from. Journey urls look like
+#
+#   .../journeyDetail?ref=829281%2F272541%2F61476%2F172254%2F86%3Fdate%3D01.10.14%26station_evaId%3D...
+#
+# where the quoted ref holds the trip and, after a "?", its own parameters of
+# which only the date matters. Returns None if the url isn't in that form.
+def parse_journey_ref(url):
+  query = urlparse.urlparse(url).query
+  refs = urlparse.parse_qs(query).get("ref")
+  if not refs:
+    return None
+  (trip, _, ref_query) = refs[0].partition("?")
+  dates = urlparse.parse_qs(ref_query).get("date")
+  if (trip == "") or not dates:
+    return None
+  return (trip, dates[0])
+
+
+# Index of the journeys fetched so far. A physical trip is seen several times,
+# as a departure at its start, an arrival at its end and possibly on hub boards,
+# and each sighting has its own journey url. The index maps every transit a
+# journey explains to the journey so later sightings can reuse it, and makes
+# sure there is only one journey for each trip identity.
+class JourneyIndex(object):
+
+  def __init__(self):
+    self.by_identity = {}
+    self.by_sighting = {}
+
+  # Returns the key of the sighting of a trip that the given transit is.
+  @staticmethod
+  def get_transit_key(transit):
+    return (transit.get_route_name(), transit.get_type(), transit.get_stop(),
+      transit.get_timestamp(), transit.get_terminus())
+
+  # Returns the journey that explains the given transit, None if there is none.
+  def get(self, transit):
+    return self.by_sighting.get(JourneyIndex.get_transit_key(transit))
+
+  # Adds the given journey to the index and returns the canonical journey for
+  # its trip, which is the given one unless the trip was already known.
+  def add(self, journey):
+    identity = journey.get_identity()
+    canonical = self.by_identity.get(identity)
+    if not canonical is None:
+      return canonical
+    self.by_identity[identity] = journey
+    stops = journey.get_stops()
+    if len(stops) == 0:
+      return journey
+    origin = stops[0].get_name()
+    destination = stops[-1].get_name()
+    route_name = journey.get_route_name()
+    for stop in stops:
+      arrival = stop.get_arrival()
+      if not arrival is None:
+        key = (route_name, ARRIVAL, stop.get_name(), arrival, origin)
+        self.by_sighting[key] = journey
+      departure = stop.get_departure()
+      if not departure is None:
+        key = (route_name, DEPARTURE, stop.get_name(), departure, destination)
+        self.by_sighting[key] = journey
+    return journey
+
+  def __len__(self):
+    return len(self.by_identity)
+
+
+# Learns which transits have journey urls with the wrong date. Rejseplanen gets
+# the date wrong for some trips around midnight, giving the date of the transit
+# rather than the date the trip started, and whether it does so depends on the
+# route and the time of the transit. For each route and half hour of the day
+# this counts how many journeys needed their date corrected, such that the
+# right url can be tried first. If given a store the counts are kept there
+# between runs.
+class DateCorrections(object):
+
+  _BUCKET_MINUTES = 30
+
+  def __init__(self, store=None):
+    self.store = store
+    # Map from keys to [corrected, total] counts.
+    self.counts = {}
+    # Map from keys to the counts added since they were last stored.
+    self.unsaved = {}
+    if not self.store is None:
+      self._load()
+
+  def _load(self):
+    self.store.execute_all([(
+      "CREATE TABLE IF NOT EXISTS date_corrections (route_name, bucket, corrected, total, PRIMARY KEY (route_name, bucket))",
+      ())])
+    for (route_name, bucket, corrected, total) in self.store.query(
+        "SELECT route_name, bucket, corrected, total FROM date_corrections"):
+      self.counts[(route_name, bucket)] = [corrected, total]
+
+  # Returns the key to count the given transit under.
+  @staticmethod
+  def get_key(transit):
+    (hours, minutes) = transit.get_time().split(":")
+    minute = int(hours) * 60 + int(minutes)
+    return (transit.get_route_name(), minute // DateCorrections._BUCKET_MINUTES)
+
+  # Returns true if the journey url of the given transit most likely has the
+  # wrong date.
+  def should_correct(self, transit):
+    counts = self.counts.get(DateCorrections.get_key(transit))
+    if counts is None:
+      return False
+    (corrected, total) = counts
+    return 2 * corrected > total
+
+  # Records whether the given transit's journey url had to be corrected.
+  def record(self, transit, corrected):
+    key = DateCorrections.get_key(transit)
+    delta = 1 if corrected else 0
+    for counts in [self.counts, self.unsaved]:
+      entry = counts.setdefault(key, [0, 0])
+      entry[0] += delta
+      entry[1] += 1
+
+  # Adds the counts recorded since the last save to the store. The counts are
+  # added rather than overwritten since other processes may have added theirs.
+  def save(self):
+    if (self.store is None) or (len(self.unsaved) == 0):
+      return
+    statements = []
+    for ((route_name, bucket), (corrected, total)) in self.unsaved.items():
+      statements.append((
+        "INSERT OR IGNORE INTO date_corrections VALUES (?, ?, 0, 0)",
+        (route_name, bucket)))
+      statements.append((
+        "UPDATE date_corrections SET corrected = corrected + ?, total = total + ? WHERE route_name = ? AND bucket = ?",
+        (corrected, total, route_name, bucket)))
+    self.store.execute_all(statements)
+    self.unsaved = {}
+
+
+# Remembers which board windows have been fetched, such that a later run can
+# load the ones it needs straight away, from the http cache, instead of
+# fetching them one after the other to find out how far each one reaches. A
+# window is recorded as the timestamp it was fetched for and the timestamp of
+# its last transit, per type of board, stop id and date. Boards fetched with
+# different parameters can differ so windows are only reused for the same
+# variant. If given a store the windows are kept there between runs.
+class BoardWindows(object):
+
+  def __init__(self, variant, store=None):
+    self.variant = variant
+    self.store = store
+    # Map from (type, id) to a map from window timestamps to the timestamp of
+    # the last transit.
+    self.windows = {}
+    # List of (type, id, timestamp, last) windows recorded since the last save.
+    self.unsaved = []
+    if not self.store is None:
+      self._load()
+
+  def _load(self):
+    self.store.execute_all([(
+      "CREATE TABLE IF NOT EXISTS board_windows (variant, type, id, date, timestamp, last, PRIMARY KEY (variant, type, id, timestamp))",
+      ())])
+    for (type, id, timestamp, last) in self.store.query(
+        "SELECT type, id, timestamp, last FROM board_windows WHERE variant = ?",
+        (self.variant,)):
+      self.windows.setdefault((type, id), {})[timestamp] = last
+
+  # Records that the board of the given type for the given id fetched at the
+  # given timestamp had transits up until last. Empty boards say nothing
+  # about coverage and are ignored.
+  def record(self, type, id, timestamp, last):
+    if last <= timestamp:
+      return
+    windows = self.windows.setdefault((type, id), {})
+    if windows.get(timestamp) == last:
+      return
+    windows[timestamp] = last
+    self.unsaved.append((type, id, timestamp, last))
+
+  # Returns a list of the timestamps of known windows of the given type for the
+  # given id that, between them, cover as much of the time from start to end
+  # as the known windows can. Where windows overlap the ones that reach
+  # furthest are used.
+  def get_windows(self, type, id, start, end):
+    windows = self.windows.get((type, id))
+    if windows is None:
+      return []
+    items = sorted(windows.items())
+    result = []
+    # The first time not covered by the windows picked so far.
+    cursor = start
+    index = 0
+    while cursor <= end:
+      # Of the windows that start before the cursor pick the one that reaches
+      # furthest past it.
+      best = None
+      reach = cursor
+      while (index < len(items)) and (items[index][0] <= cursor):
+        (timestamp, last) = items[index]
+        if last > reach:
+          best = timestamp
+          reach = last
+        index += 1
+      if best is None:
+        # There's a gap so skip to the next window.
+        if (index == len(items)) or (items[index][0] > end):
+          break
+        cursor = items[index][0]
+      else:
+        result.append(best)
+        cursor = reach
+    return result
+
+  # Adds the windows recorded since the last save to the store.
+  def save(self):
+    if (self.store is None) or (len(self.unsaved) == 0):
+      return
+    statements = []
+    for (type, id, timestamp, last) in self.unsaved:
+      statements.append((
+        "INSERT OR REPLACE INTO board_windows VALUES (?, ?, ?, ?, ?, ?)",
+        (self.variant, type, id, clock.Timestamp.to_date(timestamp),
+          timestamp, last)))
+    self.store.execute_all(statements)
+    self.unsaved = []
+
+
+# Remembers, for each terminus board of a date, which journeys explained its
+# transits such that a later date with the same timetable can reuse them
+# rather than fetch them again. A board is identified by route, type and stop
+# and its transits by their time relative to midnight and their terminus. The
+# journeys are remembered by their urls, the responses being in the http
+# cache, and the number of days the journey at the url is before the board
+# since reused journeys keep the url they were originally fetched from. Each
+# board also has a fingerprint that tells whether it has changed. If given a
+# store the boards are kept there between runs.
+class TimetableHistory(object):
+
+  def __init__(self, store=None):
+    self.store = store
+    self.dates = set()
+    if not self.store is None:
+      self._load()
+
+  def _load(self):
+    self.store.execute_all([(
+      "CREATE TABLE IF NOT EXISTS timetable_history (route_name, type, stop, date, fingerprint, transits, PRIMARY KEY (route_name, type, stop, date))",
+      ())])
+    for (date,) in self.store.query("SELECT DISTINCT date FROM timetable_history"):
+      self.dates.add(date)
+
+  # Returns the fingerprint of a board with transits with the given (offset,
+  # terminus) keys.
+  @staticmethod
+  def get_fingerprint(keys):
+    return hashlib.sha1(json.dumps(sorted(keys))).hexdigest()
+
+  # Returns the latest date before the given one that boards have been
+  # remembered for, None if there is none.
+  def get_previous_date(self, date):
+    def get_midnight(d):
+      return clock.Timestamp.from_date_time(d, "00:00")
+    midnight = get_midnight(date)
+    earlier = [d for d in self.dates if get_midnight(d) < midnight]
+    if len(earlier) == 0:
+      return None
+    return max(earlier, key=get_midnight)
+
+  # Returns a map from (route name, type, stop) to a (fingerprint, transits)
+  # pair for the boards of the given date, where transits maps (offset,
+  # terminus) keys to (journey url, days) pairs.
+  def get_boards(self, date):
+    result = {}
+    if self.store is None:
+      return result
+    for (route_name, type, stop, fingerprint, transits) in self.store.query(
+        "SELECT route_name, type, stop, fingerprint, transits FROM timetable_history WHERE date = ?",
+        (date,)):
+      journeys = dict(((offset, terminus), (url, days))
+        for (offset, terminus, url, days) in json.loads(transits))
+      result[(route_name, type, stop)] = (fingerprint, journeys)
+    return result
+
+  # Remembers the boards of the given date, a map from (route name, type,
+  # stop) to a map from (offset, terminus) keys to (journey url, days) pairs.
+  def add_boards(self, date, boards):
+    self.dates.add(date)
+    if (self.store is None) or (len(boards) == 0):
+      return
+    statements = []
+    for ((route_name, type, stop), journeys) in boards.items():
+      transits = sorted([offset, terminus, url, days]
+        for ((offset, terminus), (url, days)) in journeys.items())
+      statements.append((
+        "INSERT OR REPLACE INTO timetable_history VALUES (?, ?, ?, ?, ?, ?)",
+        (route_name, type, stop, date, TimetableHistory.get_fingerprint(journeys.keys()),
+          json.dumps(transits))))
+    self.store.execute_all(statements)
+
+
+# Returns the given stop name in a normal form that ignores case, punctuation
+# and spacing, such that for instance "Lystrup. Bygaden  (Aarhus)" and
+# "Lystrup Bygaden (Aarhus)" are considered the same.
+def normalize_stop_name(name):
+  return " ".join(_NON_NAME_RE.sub(" ", name.lower()).split())
+
+_NON_NAME_RE = re.compile(r"[^\w()]+", re.UNICODE)
+
+
+# Index of all the stop locations seen so far, by exact and normalized name.
+# If given a store the gazetteer loads the locations seen in previous runs from
+# it and records new ones there. Aliases are found on lookups, which happen a
+# lot, so they're only written along with the next locations or on save.
+class Gazetteer(object):
+
+  def __init__(self, strings, store=None):
+    self.strings = strings
+    self.store = store
+    self.by_name = {}
+    self.by_normalized_name = {}
+    # The (alias, name) pairs found since they were last written.
+    self.unsaved = []
+    if not self.store is None:
+      self._load()
+
+  def _load(self):
+    self.store.execute_all([
+      ("CREATE TABLE IF NOT EXISTS stops (name PRIMARY KEY, id, x, y, source_url)", ()),
+      ("CREATE TABLE IF NOT EXISTS stop_aliases (alias PRIMARY KEY, name)", ())])
+    for (name, id, x, y, source_url) in self.store.query(
+        "SELECT name, id, x, y, source_url FROM stops"):
+      attribs = {"name": name, "id": id, "x": x, "y": y}
+      self._index(StopLocation(source_url, attribs, self.strings))
+    for (alias, name) in self.store.query("SELECT alias, name FROM stop_aliases"):
+      location = self.by_name.get(name)
+      if not location is None:
+        self.by_name[alias] = location
+
+  def _index(self, location):
+    name = location.get_name()
+    self.by_name[name] = location
+    self.by_normalized_name.setdefault(normalize_stop_name(name), location)
+
+  # Returns the location with the given name, None if it isn't known. Names
+  # that only match a known location after normalization are recorded as
+  # aliases.
+  def get(self, name):
+    location = self.by_name.get(name)
+    if not location is None:
+      return location
+    location = self.by_normalized_name.get(normalize_stop_name(name))
+    if not location is None:
+      self.by_name[name] = location
+      if not self.store is None:
+        self.unsaved.append((name, location.get_name()))
+    return location
+
+  # Adds the given locations.
+  def add_all(self, locations):
+    statements = []
+    for location in locations:
+      if self.by_name.get(location.get_name()) is location:
+        continue
+      self._index(location)
+      (x, y) = location.get_position()
+      statements.append(("INSERT OR REPLACE INTO stops VALUES (?, ?, ?, ?, ?)",
+        (location.get_name(), location.get_id(), x, y, location.get_source_url())))
+    if (not self.store is None) and (len(statements) > 0):
+      self.store.execute_all(self._get_alias_statements() + statements)
+
+  # Adds the aliases found since the last save to the store.
+  def save(self):
+    if (self.store is None) or (len(self.unsaved) == 0):
+      return
+    self.store.execute_all(self._get_alias_statements())
+
+  # Returns the statements that write the unsaved aliases, which are then
+  # considered saved.
+  def _get_alias_statements(self):
+    result = [("INSERT OR REPLACE INTO stop_aliases VALUES (?, ?)", alias)
+      for alias in self.unsaved]
+    self.unsaved = []
+    return result
+
+  def __len__(self):
+    return len(self.by_name)
+
+
+# Wrapper that keeps track of information about geographic locations. Names
+# are resolved from the gazetteer where possible and only the unknown ones are
+# requested from the backend, with up to a given number of requests in flight.
 class LocationRepository(object):
 
-  def __init__(self, scheduler, service):
+  def __init__(self, scheduler, service, gazetteer, max_in_flight=1):
     self.scheduler = scheduler
     self.service = service
-    self.name_to_info = {}
+    self.gazetteer = gazetteer
+    self.max_in_flight = max_in_flight
     self.queried = set()
-    self.current_request = None
+    # Map from the names being queried to the requests for them, oldest first.
+    self.in_flight = collections.OrderedDict()
 
   # Returns a promise for the information about the location with the given
   # name.
   def get_info_by_name(self, name):
-    if name in self.name_to_info:
-      return self.name_to_info[name]
+    location = self.gazetteer.get(name)
+    if not location is None:
+      return self.scheduler.value(location)
     if name in self.queried:
       # If we've queried that specific name and still have no info that means
       # there is no info to get so we stop looking here.
       return self.scheduler.failure(UnknownLocation(name))
-    # There can only be one backend request active at any one time so we only
-    # issue one if one isn't already active. This is because the response from
-    # one request contains information about many stops so we always want to
-    # check that the response to the current request didn't contain the info
-    # we're looking for before issuing a new request for it.
-    if (self.current_request is None) or self.current_request.is_resolved():
-      # There is no active request so we get to start one.
-      def process_response(response):
-        return self._process_response(name, response)
-      self.current_request = self._get_info_from_backend(name).then(process_response)
-    # Wait for any currently active requests to finish and then try getting the
-    # info we're interested in again. Either we'll know the answer after the
-    # request is done or we'll have another chance to issue a request.
-    return self.current_request.then(lambda v: self.get_info_by_name(name))
-
-  # Add the information from a location response to the mapping.
+    request = self.in_flight.get(name)
+    if (request is None) and (len(self.in_flight) < self.max_in_flight):
+      request = self._start_request(name)
+    if request is None:
+      # All the requests we allow are in flight. The response to the oldest one
+      # might well contain this name too, so wait for that one before deciding
+      # whether to issue a request for it.
+      request = next(iter(self.in_flight.values()))
+    # Either we'll know the answer after the request is done or we'll have
+    # another chance to issue a request.
+    return request.then(lambda v: self.get_info_by_name(name))
+
+  # Starts a backend request for the given name and returns a promise that
+  # resolves when the response has been added to the gazetteer.
+  def _start_request(self, name):
+    def process_response(response):
+      self._process_response(name, response)
+    def on_failed(error, trace):
+      del self.in_flight[name]
+    request = self._get_info_from_backend(name).then(process_response, on_failed)
+    self.in_flight[name] = request
+    return request
+
+  # Add the information from a location response to the gazetteer.
   def _process_response(self, name, response):
+    del self.in_flight[name]
     self.queried.add(name)
-    for location in response.get_stop_locations():
-      self.name_to_info[location.get_name()] = self.scheduler.value(location)
+    self.gazetteer.add_all(response.get_stop_locations())
 
   # Request a promise for the result of a location request for the given name
   # from the backend.
@@ -425,14 +1192,32 @@ class InvalidResponse(Exception):
 class Rejseplanen(object):
 
   def __init__(self, root, scheduler, http_cache, http_user_agent, reqs_per_sec,
-      max_accum, parallelism):
+      max_accum, parallelism, limiter_file=None, claims_file=None, store_file=None,
+      format=XML, transport_modes=None):
     self.scheduler = scheduler
     self.root = root
     self.http = http.HttpProxy(scheduler, cache=http_cache,
       user_agent=http_user_agent, reqs_per_sec=reqs_per_sec, max_accum=max_accum,
-      pool_size=parallelism)
-    self.location_repo = LocationRepository(scheduler, self)
+      pool_size=parallelism, limiter_file=limiter_file,
+      claims_file=claims_file)
+    self.format = format
+    self.transport_modes = transport_modes
+    self.strings = StringTable()
+    self.store = None if (store_file is None) else store.Store(store_file)
+    self.gazetteer = Gazetteer(self.strings, self.store)
+    self.location_repo = LocationRepository(scheduler, self, self.gazetteer,
+      max_in_flight=parallelism)
     self.journey_cache = cachetools.LRUCache(maxsize=8192)
+    self.journey_index = JourneyIndex()
+    self.date_corrections = DateCorrections(self.store)
+    self.board_windows = BoardWindows(self._get_board_variant(), self.store)
+    self.timetable_history = TimetableHistory(self.store)
+
+  # Returns a string that identifies the parameters, other than the stop and
+  # time, that boards are fetched with.
+  def _get_board_variant(self):
+    modes = "all" if (self.transport_modes is None) else ",".join(self.transport_modes)
+    return "%s %s %s" % (self.root, self.format.name, modes)
 
   # Returns the full rest api path given an endpoint.
   def get_request_path(self, endpoint):
@@ -441,20 +1226,24 @@ class Rejseplanen(object):
   def get_backend_stats(self):
     return self.http.get_stats()
 
+  # Returns the number of requests that have gone to the backend so far.
+  def get_backend_request_count(self):
+    return self.http.get_backend_request_count()
+
   # Issues the given request.
   def fetch(self, request):
-    http_request = request.get_http_request(self)
+    http_request = self.format.add_params(request.get_http_request(self))
     url = http_request.get_url()
-    xml_p = self.http.fetch_xml(http_request)
-    def process_xml(xml):
+    text_p = self.http.fetch_text(http_request, self.format.accepts)
+    def process_text(text):
       try:
-        return request.process_response(url, xml)
+        return request.process_response(url, text, self.strings, self.format)
       except InvalidResponse, e:
         for invalid_url in e.invalid_urls:
           _LOG.warning("Dropping %s from http cache", invalid_url)
           self.http.drop_from_cache(invalid_url)
         raise e
-    return xml_p.then(process_xml)
+    return text_p.then(process_text)
 
   # Returns a promise that will be resolved with location information about
   # the given name.
@@ -464,12 +1253,14 @@ class Rejseplanen(object):
   # Returns a promise for the result of an arrivals request for the given id at
   # the given time from the backend.
   def get_arrivals(self, id, timestamp):
-    return self.fetch(ArrivalsRequest().set_id(id).set_timestamp(timestamp))
+    return self.fetch(ArrivalsRequest().set_id(id).set_timestamp(timestamp)
+      .set_modes(self.transport_modes))
 
   # Returns a promise for the result of an departures request for the given id
   # at the given time from the backend.
   def get_departures(self, id, timestamp):
-    return self.fetch(DeparturesRequest().set_id(id).set_timestamp(timestamp))
+    return self.fetch(DeparturesRequest().set_id(id).set_timestamp(timestamp)
+      .set_modes(self.transport_modes))
 
   # Returns the arrivals/departures for the given id starting at the given
   # timestamp.
@@ -480,39 +1271,105 @@ class Rejseplanen(object):
       assert type == DEPARTURES
       return self.get_departures(id, timestamp)
 
-  # Returns the given transit's journey details.
+  # Records that the board of the given type for the given id fetched at the
+  # given timestamp had transits up until last.
+  def record_board_window(self, type, id, timestamp, last):
+    self.board_windows.record(type, id, timestamp, last)
+
+  # Returns the timestamps of the windows of the given type for the given id,
+  # fetched in earlier runs, that cover the time from start to end.
+  def get_board_windows(self, type, id, start, end):
+    return self.board_windows.get_windows(type, id, start, end)
+
+  # Returns the journey fetched from the given url, of the same trip as the
+  # given transit the given number of days earlier, moved to the transit's
+  # date. If the moved journey doesn't explain the transit after all the
+  # transit's own journey is fetched instead.
+  def get_moved_journey(self, transit, url, days):
+    journey = self.journey_index.get(transit)
+    if not journey is None:
+      return self.scheduler.value(journey)
+    def move(journey):
+      moved = journey.add_days(transit, days, self.strings)
+      if not moved.has_transit(transit):
+        return self.get_journey(transit)
+      return self.journey_index.add(moved)
+    return self._fetch_journey(transit, url).then(move)
+
+  # Returns the given transit's journey details. If the transit is explained by
+  # a journey that has already been fetched for another sighting of the same
+  # trip that one is used instead of fetching it again.
   def get_journey(self, transit):
+    journey = self.journey_index.get(transit)
+    if not journey is None:
+      return self.scheduler.value(journey)
     url = transit.get_journey_url()
-    return self._get_journey_by_url(transit, url, True)
-
-  # Returns the given transit's journey details, fetched from the given url. If
-  # the result is inconsistent (detected by the transit not occurring in the
-  # journey) then we'll try again with the url adjusted if adjust_on_failure is
-  # True, otherwise the inconsistent result will just be returned.
-  def _get_journey_by_url(self, transit, url, adjust_on_inconsistent):
-    cached = self.journey_cache.get(url, None)
-    if not cached is None:
-      return cached
-    def retry_on_inconsistent(response):
-      if response.has_transit(transit):
+    result = None
+    if self.date_corrections.should_correct(transit):
+      # The url most likely has the wrong date so go straight for the adjusted
+      # one, falling back to the original if that turns out to be wrong.
+      adjusted_url = self._adjust_journey_url(url)
+      if not adjusted_url is None:
+        result = self._get_verified_journey(transit, adjusted_url, lambda: url)
+    if result is None:
+      result = self._get_verified_journey(transit, url,
+        lambda: self._adjust_journey_url(url))
+    return result.then(self.journey_index.add)
+
+  # Returns the journey details fetched from the given url. If the result is
+  # inconsistent (detected by the transit not occurring in the journey) then
+  # we'll try again with the url returned by get_fallback_url, unless that is
+  # None, otherwise the inconsistent result will just be returned. Whether the
+  # consistent journey needed its url adjusted is recorded so the next transit
+  # like this one can go straight for the right url.
+  def _get_verified_journey(self, transit, url, get_fallback_url):
+    original_url = transit.get_journey_url()
+    def record_if_consistent(response, response_url):
+      is_consistent = response.has_transit(transit)
+      if is_consistent:
+        self.date_corrections.record(transit, response_url != original_url)
+      return is_consistent
+    def verify_fallback(fallback_url, response):
+      record_if_consistent(response, fallback_url)
+      return response
+    def verify(response):
+      if record_if_consistent(response, url):
         return response
-      else:
-        new_url = self._adjust_journey_url(url)
-        if new_url is None:
-          return response
-        else:
-          return self._get_journey_by_url(transit, new_url, False)
-    result = self.fetch(JourneyRequest(url, transit))
-    if adjust_on_inconsistent:
-      result = result.then(retry_on_inconsistent)
-    self.journey_cache[url] = result
-    return result
-
-  _JOURNEY_RE = re.compile(r"^(.*date\%3D)(\d\d\.\d\d\.\d\d)$")
-  # Given a url that is known to have returned an inconsistent result, return
-  # an adjusted url that may give the right result. This is a workaround for
-  # a bug on rejseplanen where they get the dates wrong around midnight, they
-  # return the next day instead of the one we're interested in.
+      fallback_url = get_fallback_url()
+      if fallback_url is None:
+        return response
+      return (self._fetch_journey(transit, fallback_url)
+        .then(lambda r: verify_fallback(fallback_url, r)))
+    return self._fetch_journey(transit, url).then(verify)
+
+  # Returns the journey details fetched from the given url, as the journey of
+  # the given transit.
+  def _fetch_journey(self, transit, url):
+    # Urls for the same trip from different boards only differ in parameters
+    # that don't matter so the cache is keyed by the trip instead where
+    # possible. The cached journey belongs to whichever sighting fetched it
+    # first so each caller gets it as the journey of its own transit.
+    cache_key = parse_journey_ref(url) or url
+    fetched = self.journey_cache.get(cache_key, None)
+    if fetched is None:
+      fetched = self.fetch(JourneyRequest(url, transit))
+      self.journey_cache[cache_key] = fetched
+    def on_failed(error, trace):
+      # The board this transit came from may be just as stale as the one the
+      # journey was fetched for.
+      if isinstance(error, InvalidResponse):
+        board_url = transit.get_source_url()
+        if not board_url in error.invalid_urls:
+          _LOG.warning("Dropping %s from http cache", board_url)
+          self.http.drop_from_cache(board_url)
+          error.add_invalid_url(board_url)
+    return fetched.then(lambda journey: journey.with_transit(transit), on_failed)
+
+  _JOURNEY_RE = re.compile(r"^(.*date\%3D)(\d\d\.\d\d\.\d\d)(.*)$")
+  # Given a journey url, returns the url adjusted to work around a bug on
+  # rejseplanen where they get the dates wrong around midnight: they return the
+  # next day instead of the one we're interested in. Returns None if the url
+  # can't be adjusted.
   def _adjust_journey_url(self, url):
     matcher = Rejseplanen._JOURNEY_RE.match(url)
     if matcher is None:
@@ -526,8 +1383,13 @@ class Rejseplanen(object):
       # that explicitly.
       _LOG.warning("Failed to get previous date for %s", date)
       return None
-    return "%s%s" % (base_url, new_date)
+    return "%s%s%s" % (base_url, new_date, matcher.group(3))
 
-  # Closes the http connection down cleanly.
+  # Closes the http connection and the store down cleanly.
   def close(self):
     self.http.close()
+    if not self.store is None:
+      self.date_corrections.save()
+      self.board_windows.save()
+      self.gazetteer.save()
+      self.store.close()
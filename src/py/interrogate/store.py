@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import Queue
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+_LOG = logging.getLogger(__name__)
+
+
+# A persistent store for the information the interrogation learns and wants to
+# keep between runs, as opposed to the raw responses kept in the http cache.
+# Like the http cache it's backed by sqlite and only the thread that creates a
+# connection may use it, so all the work is done on an owner thread. The
+# tables are created by the users of the store.
+class Store(object):
+
+  def __init__(self, filename):
+    self.local = threading.local()
+    self.tasks = Queue.Queue()
+    self.filename = filename
+    self.keep_going = True
+    thread = threading.Thread(target=self._run_owner_thread)
+    thread.daemon = True
+    thread.start()
+
+  def _run_owner_thread(self):
+    # Shard workers share the store so allow for some waiting on locks.
+    self.db = sqlite3.connect(self.filename, timeout=60)
+    while self.keep_going:
+      (thunk, chan) = self.tasks.get()
+      try:
+        chan.put((thunk(), None))
+      except Exception, e:
+        chan.put((None, e))
+
+  # Calls the given function with the database connection on the owner thread
+  # and returns the result. Errors are rethrown on the calling thread.
+  def run(self, thunk):
+    chan = getattr(self.local, "chan", None)
+    if chan is None:
+      chan = Queue.Queue()
+      self.local.chan = chan
+    self.tasks.put((lambda: thunk(self.db), chan))
+    (result, error) = chan.get()
+    if not error is None:
+      raise error
+    return result
+
+  # Executes the given statements, a list of (sql, params) pairs, in a single
+  # transaction.
+  def execute_all(self, statements):
+    def do_execute_all(db):
+      for (sql, params) in statements:
+        db.execute(sql, params)
+      db.commit()
+    self.run(do_execute_all)
+
+  # Returns all the rows returned by the given query.
+  def query(self, sql, params=()):
+    return self.run(lambda db: db.execute(sql, params).fetchall())
+
+  # Closes the connection to the database.
+  def close(self):
+    def do_close(db):
+      self.keep_going = False
+      db.close()
+    return self.run(do_close)
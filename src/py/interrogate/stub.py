@@ -0,0 +1,598 @@
+#!/usr/bin/python
+
+
+# A local stand-in for the rejseplanen REST api that makes it possible to run
+# and measure the whole interrogation pipeline offline. The stub can either
+# replay the responses recorded in an http cache or synthesize responses for a
+# generated network of configurable size. On top of that it can inject latency
+# and errors to simulate a slow or unreliable backend.
+#
+# To run the pipeline against the stub, start it with --write-config to get a
+# matching interrogation config and then point main.py at that:
+#
+#   stub.py --port 8080 --routes 5000 --write-config synthetic.yaml
+#   main.py --config synthetic.yaml
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import heapq
+import itertools
+import logging
+import random
+import sys
+import threading
+import time
+import urlparse
+import xml.etree.cElementTree
+import xml.sax.saxutils
+import yaml
+import clock
+import http
+import rejseplanen
+# Imported by another name since this module has a main of its own.
+import main as interrogate
+
+
+logging.basicConfig(level=logging.INFO)
+_LOG = logging.getLogger(__name__)
+
+
+MINUTES_PER_DAY = 24 * 60
+
+# How many transits rejseplanen returns on a single board.
+BOARD_SIZE = 20
+
+# How many stop locations rejseplanen returns for a location request.
+LOCATION_LIST_SIZE = 10
+
+
+# The board parameters that turn off transport modes and the types of
+# transport each turns off.
+_TRANSPORT_MODE_PARAMS = [
+  ("useTog", ["IC", "LYN", "REG", "S", "TOG"]),
+  ("useBus", ["BUS", "EXB", "NB", "TB"]),
+  ("useMetro", ["M"]),
+]
+
+
+# Formats a minute of the day, possibly past midnight, relative to the given
+# date as a (date, time) pair of strings.
+def _format_minute(date, minute):
+  (days, minute_of_day) = divmod(minute, MINUTES_PER_DAY)
+  for i in range(0, days):
+    date = clock.get_next_date(date)
+  return (date, "%02i:%02i" % divmod(minute_of_day, 60))
+
+
+# Parses a "HH:MM" string into the minute of the day.
+def _parse_minute(time_str):
+  (hours, minutes) = time_str.split(":")
+  return int(hours) * 60 + int(minutes)
+
+
+# Returns an xml attribute list for the given (name, value) pairs.
+def _attributes(pairs):
+  parts = []
+  for (name, value) in pairs:
+    if isinstance(value, unicode):
+      value = value.encode("utf8")
+    parts.append("%s=%s" % (name, xml.sax.saxutils.quoteattr(str(value))))
+  return " ".join(parts)
+
+
+# A stop in a synthetic network.
+class SyntheticStop(object):
+
+  def __init__(self, index, name, x, y):
+    self.index = index
+    self.name = name
+    self.id = "%09i" % (8600000 + index)
+    self.x = x
+    self.y = y
+    # List of (pattern, position) pairs for every route direction that passes
+    # this stop.
+    self.visits = []
+
+
+# A single trip of a synthetic route.
+class SyntheticTrip(object):
+
+  def __init__(self, id, route, type, stops, times):
+    self.id = id
+    self.route = route
+    self.type = type
+    self.stops = stops
+    # The minute of the day each stop is served, possibly past midnight.
+    self.times = times
+
+  def get_origin(self):
+    return self.stops[0]
+
+  def get_destination(self):
+    return self.stops[-1]
+
+
+# One direction of a synthetic route: the trips that serve the same stops at
+# the same offsets, one every headway minutes. Trips are only materialized when
+# they're asked for so a network of thousands of routes stays small.
+class SyntheticPattern(object):
+
+  def __init__(self, index, route, type, stops, offsets, start, headway, count):
+    self.index = index
+    self.route = route
+    self.type = type
+    self.stops = stops
+    # The minutes from the start of a trip until each stop is served.
+    self.offsets = offsets
+    self.start = start
+    self.headway = headway
+    self.count = count
+
+  # Returns the id of the given trip of this pattern.
+  def get_trip_id(self, number):
+    return self.index * MINUTES_PER_DAY + number + 1
+
+  # Returns the given trip of this pattern.
+  def get_trip(self, number):
+    start = self.start + number * self.headway
+    times = [start + offset for offset in self.offsets]
+    return SyntheticTrip(self.get_trip_id(number), self.route, self.type,
+      self.stops, times)
+
+  # Yields (minute, trip number) for every trip that serves the stop at the
+  # given position no earlier than the given minute, in order.
+  def iter_visits(self, position, from_minute):
+    first = self.start + self.offsets[position]
+    number = max(0, -((first - from_minute) // self.headway))
+    while number < self.count:
+      yield (first + number * self.headway, number)
+      number += 1
+
+
+# A generated network of routes and trips that runs the same timetable every
+# day. Every route passes through one of a small number of hubs so the
+# interrogation pipeline can discover them all from the hubs. With date_bug
+# set, journey urls on boards get the date wrong for trips past midnight the
+# way rejseplanen's do: they give the date of the transit rather than the date
+# the trip started. Besides the bus routes there can be some regional train
+# routes that also pass through the hubs.
+class SyntheticNetwork(object):
+
+  def __init__(self, routes=100, stops_per_route=20, headway=15, first="05:00",
+      last="23:45", seed=8600, date_bug=False, train_routes=0):
+    self.date_bug = date_bug
+    self.random = random.Random(seed)
+    self.stops = []
+    self.patterns = []
+    self.route_names = ["Bus %i" % (i + 1) for i in range(0, routes)]
+    self.train_route_names = ["Re %i" % (i + 1) for i in range(0, train_routes)]
+    typed_route_names = ([(n, "BUS") for n in self.route_names] +
+      [(n, "REG") for n in self.train_route_names])
+    hub_count = max(1, routes // 50)
+    self.hubs = [self._new_stop("Hub %i" % (i + 1)) for i in range(0, hub_count)]
+    pool_size = max(stops_per_route, (routes * stops_per_route) // 2)
+    pool = [self._new_stop("Stop %i" % (i + 1)) for i in range(0, pool_size)]
+    first_minute = _parse_minute(first)
+    last_minute = _parse_minute(last)
+    for (index, (route_name, type)) in enumerate(typed_route_names):
+      stops = self.random.sample(pool, stops_per_route - 1)
+      stops.insert(len(stops) // 2, self.hubs[index % hub_count])
+      travel_times = [self.random.randint(1, 3) for s in stops[1:]]
+      for (route_stops, route_times) in [
+          (stops, travel_times),
+          (list(reversed(stops)), list(reversed(travel_times)))]:
+        start = first_minute + self.random.randint(0, headway - 1)
+        count = 0 if start > last_minute else (last_minute - start) // headway + 1
+        offsets = [0]
+        for travel_time in route_times:
+          offsets.append(offsets[-1] + travel_time)
+        self._add_pattern(route_name, type, route_stops, offsets, start, headway,
+          count)
+    self.stops_by_id = dict((s.id, s) for s in self.stops)
+
+  def _new_stop(self, name):
+    x = 10200000 + self.random.randint(-50000, 50000)
+    y = 56150000 + self.random.randint(-50000, 50000)
+    stop = SyntheticStop(len(self.stops), name, x, y)
+    self.stops.append(stop)
+    return stop
+
+  def _add_pattern(self, route_name, type, stops, offsets, start, headway, count):
+    pattern = SyntheticPattern(len(self.patterns), route_name, type, stops,
+      offsets, start, headway, count)
+    self.patterns.append(pattern)
+    for (position, stop) in enumerate(stops):
+      stop.visits.append((pattern, position))
+
+  # Returns the number of trips that run every day in this network.
+  def get_trip_count(self):
+    return sum(p.count for p in self.patterns)
+
+  # Returns the trip with the given id, None if there is no such trip.
+  def get_trip(self, trip_id):
+    (index, number) = divmod(trip_id - 1, MINUTES_PER_DAY)
+    if (trip_id < 1) or (index >= len(self.patterns)):
+      return None
+    pattern = self.patterns[index]
+    if number >= pattern.count:
+      return None
+    return pattern.get_trip(number)
+
+  # Returns the names of the hubs of this network.
+  def get_hub_names(self):
+    return [h.name for h in self.hubs]
+
+  # Returns the names of the bus routes of this network.
+  def get_route_names(self):
+    return self.route_names
+
+  # Returns the journey detail url for the given trip on the given date as seen
+  # on the board of the given stop. Like the real thing, the urls for the same
+  # trip differ between boards.
+  def get_journey_ref(self, base_url, trip, date, stop):
+    return ("%s/journeyDetail?ref=%i%%2F%i%%3Fdate%%3D%s%%26station_evaId%%3D%s"
+      % (base_url, trip.id, trip.get_origin().index, date, stop.id))
+
+  # Returns the xml response to a request to the given endpoint with the given
+  # parameters, None if the endpoint isn't known.
+  def get_response(self, base_url, endpoint, params):
+    if endpoint == "arrivalBoard":
+      return self._get_board(base_url, "ArrivalBoard", "Arrival", params)
+    elif endpoint == "departureBoard":
+      return self._get_board(base_url, "DepartureBoard", "Departure", params)
+    elif endpoint == "journeyDetail":
+      return self._get_journey(params)
+    elif endpoint == "location":
+      return self._get_location(params)
+    else:
+      return None
+
+  def _get_board(self, base_url, board_tag, transit_tag, params):
+    stop = self.stops_by_id.get(params.get("id"))
+    date = params.get("date")
+    time_str = params.get("time")
+    if (stop is None) or (date is None) or (time_str is None):
+      return "<%s error=\"invalid request\"/>" % board_tag
+    is_arrival = (transit_tag == "Arrival")
+    requested = _parse_minute(time_str)
+    excluded_types = set()
+    for (param, types) in _TRANSPORT_MODE_PARAMS:
+      if params.get(param) == "0":
+        excluded_types.update(types)
+    # The timetable is the same every day so trips from the previous day may
+    # still be running and boards spill over into the next day.
+    visits = []
+    days = [(-1, clock.get_previous_date(date)), (0, date),
+      (1, clock.get_next_date(date))]
+    for (day_offset, trip_date) in days:
+      shift = day_offset * MINUTES_PER_DAY
+      for (pattern, position) in stop.visits:
+        if is_arrival and position == 0:
+          continue
+        if (not is_arrival) and position == len(pattern.stops) - 1:
+          continue
+        if pattern.type in excluded_types:
+          continue
+        visits.append(self._iter_board_visits(pattern, position, shift,
+          requested, trip_date))
+    lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<%s>" % board_tag]
+    for (minute, pattern_index, number, trip_date, shift) in itertools.islice(
+        heapq.merge(*visits), BOARD_SIZE):
+      pattern = self.patterns[pattern_index]
+      trip = pattern.get_trip(number)
+      (transit_date, transit_time) = _format_minute(date, minute)
+      attribs = [("name", trip.route), ("type", trip.type), ("stop", stop.name),
+        ("time", transit_time), ("date", transit_date)]
+      if is_arrival:
+        attribs.append(("origin", trip.get_origin().name))
+      else:
+        attribs.append(("finalStop", trip.get_destination().name))
+        attribs.append(("direction", trip.get_destination().name))
+      lines.append("<%s %s>" % (transit_tag, _attributes(attribs)))
+      ref_date = trip_date
+      if self.date_bug and (minute - shift >= MINUTES_PER_DAY):
+        ref_date = clock.get_next_date(trip_date)
+      ref = self.get_journey_ref(base_url, trip, ref_date, stop)
+      lines.append("<JourneyDetailRef %s/>" % _attributes([("ref", ref)]))
+      lines.append("</%s>" % transit_tag)
+    lines.append("</%s>" % board_tag)
+    return "\n".join(lines)
+
+  # Yields (minute, pattern index, trip number, date, shift) for the trips of
+  # the given pattern that serve the given position from the requested minute
+  # on, with minutes shifted by the given amount to be relative to the board's
+  # date.
+  def _iter_board_visits(self, pattern, position, shift, requested, trip_date):
+    for (minute, number) in pattern.iter_visits(position, requested - shift):
+      yield (minute + shift, pattern.index, number, trip_date, shift)
+
+  def _get_journey(self, params):
+    ref = params.get("ref", "")
+    (trip_part, _, ref_query) = ref.partition("?")
+    date_part = dict(urlparse.parse_qsl(ref_query)).get("date", "")
+    trip = None
+    try:
+      trip = self.get_trip(int(trip_part.split("/")[0]))
+    except ValueError:
+      pass
+    if (trip is None) or (date_part == ""):
+      return "<JourneyDetail error=\"invalid ref\"/>"
+    lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<JourneyDetail>"]
+    last = len(trip.stops) - 1
+    for (position, stop) in enumerate(trip.stops):
+      (stop_date, stop_time) = _format_minute(date_part, trip.times[position])
+      attribs = [("name", stop.name), ("x", stop.x), ("y", stop.y),
+        ("routeIdx", position)]
+      if position > 0:
+        attribs += [("arrTime", stop_time), ("arrDate", stop_date)]
+      if position < last:
+        attribs += [("depTime", stop_time), ("depDate", stop_date)]
+      lines.append("<Stop %s/>" % _attributes(attribs))
+    lines.append("<JourneyName %s/>" % _attributes([("name", trip.route),
+      ("routeIdxFrom", 0), ("routeIdxTo", last)]))
+    lines.append("<JourneyType %s/>" % _attributes([("type", trip.type),
+      ("routeIdxFrom", 0), ("routeIdxTo", last)]))
+    lines.append("</JourneyDetail>")
+    return "\n".join(lines)
+
+  def _get_location(self, params):
+    input = params.get("input", "").decode("utf8").lower()
+    exact = [s for s in self.stops if s.name.lower() == input]
+    prefix = [s for s in self.stops
+      if s.name.lower().startswith(input) and not s in exact]
+    lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<LocationList>"]
+    for stop in (exact + prefix)[:LOCATION_LIST_SIZE]:
+      attribs = [("name", stop.name), ("x", stop.x), ("y", stop.y),
+        ("id", stop.id)]
+      lines.append("<StopLocation %s/>" % _attributes(attribs))
+    lines.append("</LocationList>")
+    return "\n".join(lines)
+
+
+# Converts an element to the json rejseplanen would give for it: attributes
+# become properties and children become properties named after their tag that
+# hold either an object or, if there's more than one, a list of objects.
+def _element_to_json(element):
+  result = dict(element.attrib)
+  for child in element:
+    result.setdefault(child.tag, []).append(_element_to_json(child))
+  for (name, value) in result.items():
+    if isinstance(value, list) and (len(value) == 1):
+      result[name] = value[0]
+  return result
+
+
+# Returns the json response corresponding to the given xml response.
+def xml_to_json(text):
+  if isinstance(text, unicode):
+    text = text.encode("utf8")
+  root = xml.etree.cElementTree.fromstring(text)
+  return json.dumps({root.tag: _element_to_json(root)}, ensure_ascii=False)
+
+
+# Backend that serves synthesized responses for a generated network.
+class SyntheticBackend(object):
+
+  def __init__(self, network, base_url):
+    self.network = network
+    self.base_url = base_url
+
+  def get_response(self, endpoint, params, path):
+    response = self.network.get_response(self.base_url, endpoint, params)
+    if (response is None) or (params.get("format") != "json"):
+      return response
+    return xml_to_json(response)
+
+
+# Backend that replays the responses recorded in an http cache. Any urls in the
+# recorded responses that point to the recorded backend are rewritten to point
+# to the stub instead.
+class ReplayBackend(object):
+
+  def __init__(self, cache_file, recorded_base_url, base_url):
+    self.cache = http.HttpRequestCache(cache_file)
+    self.recorded_base_url = recorded_base_url.rstrip("/")
+    self.base_url = base_url
+
+  def get_response(self, endpoint, params, path):
+    url = "%s%s" % (self.recorded_base_url, path)
+    response = self.cache.get_response(url)
+    if response is None:
+      return None
+    return response.replace(self.recorded_base_url, self.base_url)
+
+
+# Request handler that serves the responses of the server's backend with the
+# configured latency and error rate.
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    stub = self.server.stub
+    stub.inject_latency()
+    if stub.should_fail():
+      self.send_error(503, "Injected error")
+      return
+    parsed = urlparse.urlparse(self.path)
+    endpoint = parsed.path.rstrip("/").split("/")[-1]
+    params = dict(urlparse.parse_qsl(parsed.query))
+    response = stub.backend.get_response(endpoint, params, self.path)
+    if response is None:
+      self.send_error(404, "Unknown request")
+      return
+    if isinstance(response, unicode):
+      response = response.encode("utf8")
+    if params.get("format") == "json":
+      content_type = "application/json"
+    else:
+      content_type = "application/xml"
+    self.send_response(200)
+    self.send_header("Content-Type", "%s; charset=utf-8" % content_type)
+    self.send_header("Content-Length", str(len(response)))
+    self.end_headers()
+    self.wfile.write(response)
+
+  def log_message(self, format, *args):
+    _LOG.debug(format, *args)
+
+
+class ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+
+# A stub backend server. The latency is drawn uniformly from the given range
+# of milliseconds for every request and errors are injected at random with the
+# given rate.
+class StubServer(object):
+
+  def __init__(self, port=0, latency_min=0, latency_max=0, error_rate=0.0,
+      seed=None):
+    self.server = ThreadingHttpServer(("localhost", port), StubRequestHandler)
+    self.server.stub = self
+    self.backend = None
+    self.latency_min = latency_min
+    self.latency_max = latency_max
+    self.error_rate = error_rate
+    self.random = random.Random(seed)
+    self.random_lock = threading.Lock()
+
+  # Returns the base url to use for the rest api served by this stub.
+  def get_base_url(self):
+    return "http://localhost:%i" % self.server.server_address[1]
+
+  def set_backend(self, value):
+    self.backend = value
+    return self
+
+  def inject_latency(self):
+    if self.latency_max <= 0:
+      return
+    with self.random_lock:
+      millis = self.random.uniform(self.latency_min, self.latency_max)
+    time.sleep(millis / 1000.0)
+
+  def should_fail(self):
+    if self.error_rate <= 0:
+      return False
+    with self.random_lock:
+      return self.random.random() < self.error_rate
+
+  # Serves requests on a background thread.
+  def start(self):
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def serve_forever(self):
+    self.server.serve_forever()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+# Returns an interrogation config that covers the whole of the given network
+# when served from the given base url.
+def get_synthetic_config(network, base_url, date, http_cache):
+  return {
+    "reqs_per_sec": 1000,
+    "max_accum": 100,
+    "parallelism": 8,
+    "rest_base_url": base_url,
+    "http_cache": http_cache,
+    "date": date,
+    "time_range": {"start": "00:00", "end": "23:59"},
+    "hubs": network.get_hub_names(),
+    "route_whitelist": ["Bus .*"],
+  }
+
+
+# Returns a pipeline result with all the trips of the given network running
+# on the given date, as if the whole network had been interrogated.
+def get_synthetic_result(network, date):
+  strings = rejseplanen.StringTable()
+  midnight = clock.Timestamp.from_date_time(date, "00:00")
+  journeys = {}
+  for pattern in network.patterns:
+    for number in range(0, pattern.count):
+      trip = pattern.get_trip(number)
+      stop_times = []
+      for (index, (stop, minute)) in enumerate(zip(trip.stops, trip.times)):
+        time = midnight + minute * 60 * 1000
+        arrival = None if (index == 0) else time
+        departure = None if (index == len(trip.stops) - 1) else time
+        stop_times.append((stop.name, arrival, departure))
+      journeys.setdefault(trip.route, []).append(
+        rejseplanen.JourneyResponse.from_stops("url", None, trip.route,
+          stop_times, strings))
+  routes = dict((n, interrogate.RouteInfo(n, j, [])) for (n, j) in journeys.items())
+  return interrogate.PipelineResult(routes, {}, [], {})
+
+
+def _build_option_parser():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--port", type=int, default=8080,
+    help="The port to serve on (default: 8080)")
+  parser.add_argument("--replay", type=str,
+    help="Replay the responses recorded in this http cache")
+  parser.add_argument("--recorded-base-url", type=str,
+    default="http://xmlopen.rejseplanen.dk/bin/rest.exe",
+    help="The base url of the backend the replayed cache was recorded from")
+  parser.add_argument("--routes", type=int, default=100,
+    help="Number of routes in the synthetic network (default: 100)")
+  parser.add_argument("--stops-per-route", type=int, default=20,
+    help="Number of stops on each synthetic route (default: 20)")
+  parser.add_argument("--headway", type=int, default=15,
+    help="Minutes between trips on the synthetic routes (default: 15)")
+  parser.add_argument("--train-routes", type=int, default=0,
+    help="Number of regional train routes in the synthetic network (default: 0)")
+  parser.add_argument("--date-bug", action="store_true",
+    help="Give the wrong date in journey urls for trips past midnight")
+  parser.add_argument("--seed", type=int, default=8600,
+    help="Random seed used to generate the synthetic network")
+  parser.add_argument("--latency-min", type=float, default=0,
+    help="Minimum injected latency in milliseconds (default: 0)")
+  parser.add_argument("--latency-max", type=float, default=0,
+    help="Maximum injected latency in milliseconds (default: 0)")
+  parser.add_argument("--error-rate", type=float, default=0.0,
+    help="Fraction of requests that fail (default: 0)")
+  parser.add_argument("--write-config", type=str,
+    help="Write an interrogation config for the synthetic network to this file")
+  parser.add_argument("--date", type=str, default="01.10.14",
+    help="The date to use in the written config")
+  parser.add_argument("--http-cache", type=str, default="stubcache.db",
+    help="The http cache to use in the written config")
+  return parser
+
+
+def main(args):
+  options = _build_option_parser().parse_args(args)
+  stub = StubServer(port=options.port, latency_min=options.latency_min,
+    latency_max=options.latency_max, error_rate=options.error_rate,
+    seed=options.seed)
+  base_url = stub.get_base_url()
+  if options.replay is None:
+    network = SyntheticNetwork(routes=options.routes,
+      stops_per_route=options.stops_per_route, headway=options.headway,
+      seed=options.seed, date_bug=options.date_bug,
+      train_routes=options.train_routes)
+    _LOG.info("Generated %i routes, %i stops, %i trips",
+      len(network.route_names), len(network.stops), network.get_trip_count())
+    stub.set_backend(SyntheticBackend(network, base_url))
+    if not options.write_config is None:
+      config = get_synthetic_config(network, base_url, options.date,
+        options.http_cache)
+      with open(options.write_config, "wt") as file:
+        yaml.safe_dump(config, file, default_flow_style=False)
+  else:
+    stub.set_backend(ReplayBackend(options.replay, options.recorded_base_url,
+      base_url))
+  _LOG.info("Serving on %s", base_url)
+  stub.serve_forever()
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -2,6 +2,8 @@
 
 
 import unittest
+import os
+import time
 import clock
 
 
@@ -15,6 +17,71 @@ class MainTest(unittest.TestCase):
     self.assertEquals("29.02.12", clock.get_previous_date("01.03.12"))
     self.assertEquals("31.12.13", clock.get_previous_date("01.01.14"))
 
+  def test_get_next(self):
+    self.assertEquals("03.10.14", clock.get_next_date("02.10.14"))
+    self.assertEquals("01.10.14", clock.get_next_date("30.09.14"))
+    self.assertEquals("01.03.14", clock.get_next_date("28.02.14"))
+    self.assertEquals("29.02.12", clock.get_next_date("28.02.12"))
+    self.assertEquals("01.01.14", clock.get_next_date("31.12.13"))
+
+  def test_add_days(self):
+    old_tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/Copenhagen"
+    time.tzset()
+    clock.clear_cache()
+    try:
+      stamp = clock.Timestamp.from_date_time("29.03.14", "07:10")
+      self.assertEquals(clock.Timestamp.from_date_time("31.03.14", "07:10"),
+        clock.add_days(stamp, 2))
+      self.assertEquals(clock.Timestamp.from_date_time("27.03.14", "07:10"),
+        clock.add_days(stamp, -2))
+      self.assertEquals(stamp, clock.add_days(stamp, 0))
+      # The days between dates are whole even across daylight saving changes.
+      self.assertEquals(2, clock.get_days_between("29.03.14", "31.03.14"))
+      self.assertEquals(-1, clock.get_days_between("01.10.14", "30.09.14"))
+    finally:
+      if old_tz is None:
+        del os.environ["TZ"]
+      else:
+        os.environ["TZ"] = old_tz
+      time.tzset()
+      clock.clear_cache()
+
+  # Compares the fast conversions with the library ones for every minute of a
+  # year, in a time zone with daylight saving time.
+  def test_fast_conversion(self):
+    old_tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/Copenhagen"
+    time.tzset()
+    clock.clear_cache()
+    try:
+      times = ["%02i:%02i" % (h, m) for h in range(0, 24) for m in range(0, 60)]
+      date = "01.01.14"
+      while date != "01.01.15":
+        for time_str in times:
+          slow = clock.Timestamp._from_date_time_slow(date, time_str)
+          fast = clock.Timestamp.from_date_time(date, time_str)
+          self.assertEquals(slow, fast)
+          self.assertEquals(clock.Timestamp._to_date_slow(slow),
+            clock.Timestamp.to_date(fast))
+          self.assertEquals(clock.Timestamp._to_time_slow(slow),
+            clock.Timestamp.to_time(fast))
+        date = clock.get_next_date(date)
+      # Timestamps that aren't on the minute also work.
+      stamp = clock.Timestamp.from_date_time("30.03.14", "03:00") + 59999
+      self.assertEquals("03:00", clock.Timestamp.to_time(stamp))
+      # Times that aren't in the HH:MM format fall back to the library.
+      self.assertEquals(clock.Timestamp.from_date_time("01.10.14", "07:05"),
+        clock.Timestamp.from_date_time("01.10.14", "7:05"))
+      self.assertRaises(ValueError, clock.Timestamp.from_date_time, "01.10.14", "25:00")
+    finally:
+      if old_tz is None:
+        del os.environ["TZ"]
+      else:
+        os.environ["TZ"] = old_tz
+      time.tzset()
+      clock.clear_cache()
+
 
 if __name__ == '__main__':
   runner = unittest.TextTestRunner(verbosity=0)
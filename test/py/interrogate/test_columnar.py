@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+
+import unittest
+import logging
+import array
+import os
+import shutil
+import tempfile
+import clock
+import columnar
+import rejseplanen
+
+
+logging.disable(logging.WARNING)
+
+
+class FakeRouteInfo(object):
+
+  def __init__(self, journeys):
+    self.journeys = journeys
+
+  def get_journeys(self):
+    return self.journeys
+
+
+class FakeResult(object):
+
+  def __init__(self, routes, stops):
+    self.routes = routes
+    self.stops = stops
+
+  def get_stops(self):
+    return self.stops
+
+
+# Returns a journey of the given route through the given (name, "HH:MM")
+# stops starting on the given date, times earlier than the one before are on
+# the day after.
+def new_journey(route_name, date, stops, strings):
+  result = []
+  previous = None
+  for (index, (name, time)) in enumerate(stops):
+    timestamp = clock.Timestamp.from_date_time(date, time)
+    if (previous is not None) and (timestamp < previous):
+      timestamp += 24 * 60 * 60 * 1000
+    previous = timestamp
+    arrival = None if (index == 0) else timestamp
+    departure = None if (index == len(stops) - 1) else timestamp
+    result.append((name, arrival, departure))
+  return rejseplanen.JourneyResponse.from_stops("url", None, route_name, result,
+    strings)
+
+
+def new_location(name, id, x, y):
+  attribs = {"name": name, "id": id, "x": x, "y": y}
+  return rejseplanen.StopLocation("url", attribs, rejseplanen.StringTable())
+
+
+class ColumnarTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self):
+    strings = rejseplanen.StringTable()
+    bus = new_journey("Bus 1", "01.10.14",
+      [("A", "23:40"), ("B", "23:55"), ("C", "00:10")], strings)
+    # The same trip seen from another board.
+    again = new_journey("Bus 1", "01.10.14",
+      [("A", "23:40"), ("B", "23:55"), ("C", "00:10")], strings)
+    # An earlier trip of the same sub-route.
+    earlier = new_journey("Bus 1", "01.10.14",
+      [("A", "22:40"), ("B", "22:55"), ("C", "23:10")], strings)
+    train = new_journey("Re 1", "01.10.14", [("C", "07:00"), ("A", "07:30")],
+      strings)
+    routes = {"Re 1": FakeRouteInfo([train]),
+      "Bus 1": FakeRouteInfo([bus, again, earlier])}
+    stops = {"A": new_location("A", "1", 10200000, 56150000),
+      "C": new_location("C", "3", 10220000, 56170000)}
+    columnar.write(self.dir, "01.10.14", FakeResult(routes, stops))
+
+  def test_round_trip(self):
+    self.write()
+    timetable = columnar.read(self.dir)
+    try:
+      self.assertEquals("01.10.14", timetable.date)
+      self.assertEquals(["Bus 1", "Re 1"], timetable.routes)
+      # Stops with infos come first, the ones only trips know of after them.
+      self.assertEquals(["A", "C", "B"], timetable.stops)
+      self.assertEquals([10200000, 10220000, columnar.MISSING],
+        list(timetable.stop_x))
+      self.assertEquals([56150000, 56170000, columnar.MISSING],
+        list(timetable.stop_y))
+      # The two bus trips share their sub-route.
+      minute = 60
+      hour = 60 * minute
+      self.assertEquals(2, timetable.get_sub_route_count())
+      self.assertEquals([0, 1], list(timetable.sub_route_route))
+      self.assertEquals([0, 3, 5], list(timetable.sub_route_starts))
+      self.assertEquals([0, 2, 1, 1, 0], list(timetable.sub_route_stop))
+      self.assertEquals([columnar.MISSING, 15 * minute, 30 * minute,
+        columnar.MISSING, 30 * minute], list(timetable.sub_route_arrival))
+      self.assertEquals([0, 15 * minute, columnar.MISSING, 0, columnar.MISSING],
+        list(timetable.sub_route_departure))
+      self.assertEquals(3, timetable.get_trip_count())
+      self.assertEquals([0, 0, 1], list(timetable.trip_sub_route))
+      self.assertEquals([23 * hour + 40 * minute, 22 * hour + 40 * minute,
+        7 * hour], list(timetable.trip_start))
+      self.assertEquals(0, timetable.get_trip_route(1))
+      self.assertEquals(1, timetable.get_trip_route(2))
+      # Times past midnight are relative to the day the trip started.
+      self.assertEquals([
+          (0, columnar.MISSING, 23 * hour + 40 * minute),
+          (2, 23 * hour + 55 * minute, 23 * hour + 55 * minute),
+          (1, 24 * hour + 10 * minute, columnar.MISSING)],
+        timetable.get_trip_stop_times(0))
+      self.assertEquals([(1, columnar.MISSING, 7 * hour),
+          (0, 7 * hour + 30 * minute, columnar.MISSING)],
+        timetable.get_trip_stop_times(2))
+      self.assertEquals(clock.Timestamp.from_date_time("02.10.14", "00:10"),
+        timetable.to_timestamp(timetable.get_trip_stop_times(0)[2][1]))
+      self.assertEquals(None, timetable.to_timestamp(columnar.MISSING))
+      self.assertEquals(30 * minute, timetable.sub_route_arrival[-1])
+      self.assertRaises(IndexError, lambda: timetable.sub_route_arrival[5])
+      # The raw data is available without copying.
+      data = array.array("i", str(timetable.sub_route_stop[3:5].get_buffer()))
+      self.assertEquals([1, 0], list(data))
+    finally:
+      timetable.close()
+
+  def test_npy_header(self):
+    self.write()
+    with open(os.path.join(self.dir, "sub_route_stop.npy"), "rb") as file:
+      content = file.read()
+    self.assertEquals("\x93NUMPY\x01\x00", content[0:8])
+    # The data starts at a 64 byte boundary right after the header.
+    self.assertEquals(0, (len(content) - 5 * 4) % 64)
+    self.assertTrue("'shape': (5,)" in content)
+    self.assertEquals("\n", content[-5 * 4 - 1])
+
+  def test_reject_mismatched_column(self):
+    self.write()
+    os.rename(os.path.join(self.dir, "sub_route_stop.npy"),
+      os.path.join(self.dir, "stop_x.npy"))
+    self.assertRaises(ValueError, columnar.read, self.dir)
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=0)
+  unittest.main(testRunner=runner)
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+
+import unittest
+import logging
+import csv
+import os
+import shutil
+import tempfile
+import time
+import clock
+import gtfs
+import rejseplanen
+
+
+logging.disable(logging.WARNING)
+
+
+class FakeJourneyStop(object):
+
+  def __init__(self, name, arrival, departure):
+    self.name = name
+    self.arrival = arrival
+    self.departure = departure
+
+  def get_name(self):
+    return self.name
+
+  def get_arrival(self):
+    return self.arrival
+
+  def get_departure(self):
+    return self.departure
+
+
+class FakeJourney(object):
+
+  def __init__(self, route_name, stops):
+    self.route_name = route_name
+    self.stops = stops
+
+  def get_route_name(self):
+    return self.route_name
+
+  def get_stops(self):
+    return self.stops
+
+  def get_identity(self):
+    first = self.stops[0]
+    last = self.stops[-1]
+    return (self.route_name, first.name, first.departure, last.name,
+      last.arrival)
+
+
+# Returns a journey of the given route through the given (name, "HH:MM")
+# stops starting on the given date, times earlier than the one before are on
+# the day after.
+def new_journey(route_name, date, stops):
+  result = []
+  previous = None
+  for (index, (name, time)) in enumerate(stops):
+    timestamp = clock.Timestamp.from_date_time(date, time)
+    if (previous is not None) and (timestamp < previous):
+      timestamp += 24 * 60 * 60 * 1000
+    previous = timestamp
+    arrival = None if (index == 0) else timestamp
+    departure = None if (index == len(stops) - 1) else timestamp
+    result.append(FakeJourneyStop(name, arrival, departure))
+  return FakeJourney(route_name, result)
+
+
+def new_location(name, id, x, y):
+  attribs = {"name": name, "id": id, "x": x, "y": y}
+  return rejseplanen.StopLocation("url", attribs, rejseplanen.StringTable())
+
+
+class GtfsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.old_tz = clock.get_timezone()
+    clock.set_timezone(rejseplanen.TIMEZONE)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+    if self.old_tz is None:
+      os.environ.pop("TZ", None)
+      time.tzset()
+      clock.clear_cache()
+    else:
+      clock.set_timezone(self.old_tz)
+
+  # Returns the rows of the given file of the feed, without the header.
+  def read(self, name):
+    with open(os.path.join(self.dir, name), "rb") as file:
+      return list(csv.reader(file))[1:]
+
+  def test_write_feed(self):
+    writer = gtfs.GtfsWriter(self.dir)
+    first = new_journey("Bus 1", "01.10.14",
+      [("A", "23:40"), ("B", "23:55"), ("C", "00:10")])
+    # The same trip seen from another board.
+    again = new_journey("Bus 1", "01.10.14",
+      [("A", "23:40"), ("B", "23:55"), ("C", "00:10")])
+    train = new_journey("Re 1", "02.10.14", [("C", "07:00"), ("A", "07:30")])
+    self.assertTrue(writer.add_journey(first))
+    writer.add_stops([new_location("A", "1", 10200000, 56150000)])
+    self.assertFalse(writer.add_journey(again))
+    writer.add_journeys([train])
+    writer.add_stops([new_location("A", "1", 10200000, 56150000),
+      new_location(u"B\xe6k", "2", 10210000, 56160000)])
+    writer.close()
+    self.assertEquals([["1", "rejseplanen", "Bus 1", "3"],
+      ["2", "rejseplanen", "Re 1", "2"]], self.read("routes.txt"))
+    self.assertEquals([["1", "20141001", "1"], ["2", "20141002", "2"]],
+      self.read("trips.txt"))
+    # Times past midnight are relative to the day the trip started.
+    self.assertEquals([
+      ["1", "23:40:00", "23:40:00", "1", "0"],
+      ["1", "23:55:00", "23:55:00", "2", "1"],
+      ["1", "24:10:00", "24:10:00", "3", "2"],
+      ["2", "07:00:00", "07:00:00", "3", "0"],
+      ["2", "07:30:00", "07:30:00", "1", "1"]], self.read("stop_times.txt"))
+    # Stops are written when their infos come in, the ones that don't get any
+    # when the feed is closed.
+    self.assertEquals([
+      ["1", "1", "A", "56.150000", "10.200000"],
+      ["4", "2", u"B\xe6k".encode("utf-8"), "56.160000", "10.210000"],
+      ["2", "", "B", "", ""],
+      ["3", "", "C", "", ""]], self.read("stops.txt"))
+    self.assertEquals([
+      ["20141001", "0", "0", "1", "0", "0", "0", "0", "20141001", "20141001"],
+      ["20141002", "0", "0", "0", "1", "0", "0", "0", "20141002", "20141002"]],
+      self.read("calendar.txt"))
+    self.assertEquals([["rejseplanen", "Rejseplanen", "http://www.rejseplanen.dk",
+      "Europe/Copenhagen"]], self.read("agency.txt"))
+
+  def test_journey_without_times(self):
+    writer = gtfs.GtfsWriter(self.dir)
+    journey = new_journey("Bus 1", "01.10.14",
+      [("A", "07:00"), ("B", "07:10"), ("C", "07:20")])
+    # Without times at either end the trip can't be written, and isn't
+    # counted.
+    untimed = FakeJourneyStop("A", None, None)
+    self.assertFalse(writer.add_journey(FakeJourney("Bus 1",
+      [untimed] + journey.stops[1:])))
+    self.assertFalse(writer.add_journey(FakeJourney("Bus 1",
+      journey.stops[:2] + [FakeJourneyStop("C", None, None)])))
+    self.assertEquals(0, writer.trip_count)
+    # Stops in between without times are written without them.
+    journey.stops[1] = FakeJourneyStop("B", None, None)
+    self.assertTrue(writer.add_journey(journey))
+    writer.close()
+    self.assertEquals([
+      ["1", "07:00:00", "07:00:00", "1", "0"],
+      ["1", "", "", "2", "1"],
+      ["1", "07:20:00", "07:20:00", "3", "2"]], self.read("stop_times.txt"))
+
+  def test_timezone(self):
+    # The feed is in the zone the clock converts times in.
+    clock.set_timezone("America/New_York")
+    gtfs.GtfsWriter(self.dir).close()
+    self.assertEquals("America/New_York", self.read("agency.txt")[0][3])
+    del os.environ["TZ"]
+    self.assertRaises(AssertionError, gtfs.GtfsWriter, self.dir)
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=0)
+  unittest.main(testRunner=runner)
@@ -3,6 +3,11 @@
 
 import unittest
 import http
+import os
+import promise
+import shutil
+import subprocess
+import tempfile
 
 
 # Implementation that fakes out time and waiting.
@@ -19,6 +24,28 @@ class FakeLeakyBucket(http.LeakyBucket):
     self.current_time += millis
 
 
+# A clock that can be shared between a number of fake buckets.
+class FakeClock(object):
+
+  def __init__(self):
+    self.current_time = 0
+
+
+# Shared bucket that fakes out time and waiting using a shared clock.
+class FakeSharedLeakyBucket(http.SharedLeakyBucket):
+
+  def __init__(self, clock, filename, permits_per_second, max_accumulation):
+    self.clock = clock
+    super(FakeSharedLeakyBucket, self).__init__(filename, permits_per_second,
+      max_accumulation)
+
+  def get_current_time_millis(self):
+    return self.clock.current_time
+
+  def sleep_millis(self, millis):
+    self.clock.current_time += millis
+
+
 class LeakyBucketTest(unittest.TestCase):
 
   def test_simple(self):
@@ -45,6 +72,191 @@ class LeakyBucketTest(unittest.TestCase):
     leaky.wait_for_permit()
     self.assertEquals(10100, leaky.current_time)
 
+  def test_shared(self):
+    (handle, filename) = tempfile.mkstemp()
+    os.close(handle)
+    try:
+      clock = FakeClock()
+      first = FakeSharedLeakyBucket(clock, filename, 10, 2)
+      second = FakeSharedLeakyBucket(clock, filename, 10, 2)
+      # The two buckets together only get 10 permits per second.
+      for i in range(0, 5):
+        first.wait_for_permit()
+        second.wait_for_permit()
+      self.assertEquals(1000, clock.current_time)
+      # Skipping ahead only unlocks the accumulation once, not once per bucket.
+      clock.current_time = 5000
+      first.wait_for_permit()
+      second.wait_for_permit()
+      self.assertEquals(5000, clock.current_time)
+      first.wait_for_permit()
+      self.assertEquals(5100, clock.current_time)
+      # Setting the last permit never moves it back in time.
+      second.set_last_permit(0)
+      first.wait_for_permit()
+      self.assertEquals(5200, clock.current_time)
+    finally:
+      os.remove(filename)
+
+
+class HttpRequestTest(unittest.TestCase):
+
+  def test_get_url(self):
+    self.assertEquals("http://x/a", http.HttpRequest("http://x/a").get_url())
+    self.assertEquals("http://x/a?b=c",
+      http.HttpRequest("http://x/a").add_param(b="c").get_url())
+    self.assertEquals("http://x/a?ref=1&b=c",
+      http.HttpRequest("http://x/a?ref=1").add_param(b="c").get_url())
+
+
+# Claims made on behalf of a given process id at a fake time.
+class FakeSharedUrlClaims(http.SharedUrlClaims):
+
+  def __init__(self, clock, filename, pid):
+    super(FakeSharedUrlClaims, self).__init__(filename)
+    self.clock = clock
+    self.pid = pid
+
+  def get_current_time_secs(self):
+    return self.clock.current_time
+
+
+class SharedUrlClaimsTest(unittest.TestCase):
+
+  def setUp(self):
+    (handle, self.filename) = tempfile.mkstemp()
+    os.close(handle)
+    self.clock = FakeClock()
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def new_claims(self, pid):
+    return FakeSharedUrlClaims(self.clock, self.filename, pid)
+
+  def test_claims(self):
+    first = self.new_claims(os.getpid())
+    second = self.new_claims(os.getppid())
+    self.assertTrue(first.claim("http://a"))
+    self.assertFalse(second.claim("http://a"))
+    self.assertTrue(second.claim("http://b"))
+    self.assertTrue(second.claim("http://c"))
+    self.assertFalse(first.claim("http://c"))
+    self.assertFalse(first.claim("http://b"))
+    self.assertTrue(first.claim("http://d"))
+    # A fresh reader sees all the claims made so far.
+    third = self.new_claims(1)
+    for url in ["http://a", "http://b", "http://c", "http://d"]:
+      self.assertFalse(third.claim(url))
+
+  def test_release(self):
+    first = self.new_claims(os.getpid())
+    second = self.new_claims(os.getppid())
+    self.assertTrue(first.claim("http://a"))
+    self.assertTrue(first.claim("http://b"))
+    # Only the holder can release a claim.
+    second.release("http://b")
+    first.release("http://a")
+    self.assertTrue(second.claim("http://a"))
+    self.assertFalse(second.claim("http://b"))
+    self.assertFalse(first.claim("http://a"))
+
+  def test_dead_holder(self):
+    child = subprocess.Popen(["true"])
+    child.wait()
+    dead = self.new_claims(child.pid)
+    alive = self.new_claims(os.getpid())
+    self.assertTrue(dead.claim("http://a"))
+    # The process that made the claim is gone so it can be taken over.
+    self.assertTrue(alive.claim("http://a"))
+    self.assertFalse(dead.claim("http://a"))
+
+  def test_stale(self):
+    first = self.new_claims(os.getpid())
+    second = self.new_claims(os.getppid())
+    self.assertTrue(first.claim("http://a"))
+    self.clock.current_time = http.SharedUrlClaims.STALE_SECS
+    self.assertFalse(second.claim("http://a"))
+    self.clock.current_time = http.SharedUrlClaims.STALE_SECS + 1
+    self.assertTrue(second.claim("http://a"))
+
+
+class HttpRequestCacheTest(unittest.TestCase):
+
+  def test_errors(self):
+    (handle, filename) = tempfile.mkstemp()
+    os.close(handle)
+    try:
+      cache = http.HttpRequestCache(filename)
+      cache.add_response(1, "http://a", u"A")
+      # An error on the owner thread is rethrown to the caller and leaves the
+      # cache working.
+      self.assertRaises(ZeroDivisionError, lambda: cache._run_as_owner(lambda: 1 / 0))
+      self.assertEquals(u"A", cache.get_response("http://a"))
+      # Dropping a url that isn't cached is fine.
+      cache.drop("http://b")
+      cache.drop("http://a")
+      self.assertEquals(None, cache.get_response("http://a"))
+      cache.close()
+    finally:
+      os.remove(filename)
+
+  def test_content_type(self):
+    (handle, filename) = tempfile.mkstemp()
+    os.close(handle)
+    try:
+      is_json = lambda content_type: content_type == "application/json"
+      cache = http.HttpRequestCache(filename)
+      cache.add_response(1, "http://a", u"<a/>", "application/xml")
+      self.assertEquals(u"<a/>", cache.get_response("http://a"))
+      self.assertEquals(None, cache.get_response("http://a", is_json))
+      cache.add_response(2, "http://a", u"{}", "application/json")
+      self.assertEquals(u"{}", cache.get_response("http://a", is_json))
+      cache.close()
+      # The content type survives reopening the cache.
+      cache = http.HttpRequestCache(filename)
+      self.assertEquals(u"{}", cache.get_response("http://a", is_json))
+      cache.close()
+    finally:
+      os.remove(filename)
+
+
+
+class HttpProxyTest(unittest.TestCase):
+
+  # Runs the scheduler until the given promise is resolved.
+  def wait_for(self, scheduler, promise):
+    while not promise.is_resolved():
+      scheduler.run_next_task()
+
+  def test_cache_error(self):
+    dir = tempfile.mkdtemp()
+    try:
+      page = os.path.join(dir, "page.xml")
+      with open(page, "wt") as file:
+        file.write("<a/>")
+      scheduler = promise.Scheduler()
+      proxy = http.HttpProxy(scheduler, os.path.join(dir, "cache.db"), "test",
+        1000, 10, 1)
+      add_response = proxy.cache.add_response
+      def fail_to_add_response(*args):
+        raise IOError("disk full")
+      proxy.cache.add_response = fail_to_add_response
+      request = http.HttpRequest("file://%s" % page)
+      # Failing to cache the response fails the promise.
+      failed = proxy.fetch_text(request)
+      self.wait_for(scheduler, failed)
+      self.assertTrue(isinstance(failed.get_error(), IOError))
+      # The failure isn't kept around so fetching again tries again.
+      proxy.cache.add_response = add_response
+      fetched = proxy.fetch_text(request)
+      self.assertFalse(fetched is failed)
+      self.wait_for(scheduler, fetched)
+      self.assertEquals(u"<a/>", fetched.get())
+      proxy.close()
+    finally:
+      shutil.rmtree(dir)
+
 
 if __name__ == '__main__':
   runner = unittest.TextTestRunner(verbosity=0)
@@ -3,7 +3,101 @@
 
 import unittest
 import main
+import rejseplanen
+import store
 import random
+import os
+import shutil
+import tempfile
+
+
+# A transit that only has what's needed to merge boards.
+class FakeTransit(object):
+
+  def __init__(self, timestamp, route_name):
+    self.timestamp = timestamp
+    self.route_name = route_name
+
+  def get_unique_key(self):
+    return (self.timestamp, self.route_name)
+
+
+# A transit on a hub board, only has what's needed to find terminuses.
+class FakeHubTransit(object):
+
+  def __init__(self, route_name, terminus):
+    self.route_name = route_name
+    self.terminus = terminus
+
+  def get_route_name(self):
+    return self.route_name
+
+  def get_terminus(self):
+    return self.terminus
+
+
+# A transit with what's needed to check whether it has been explained.
+class FakeBoardTransit(object):
+
+  def __init__(self, route_name, type, stop, timestamp):
+    self.route_name = route_name
+    self.type = type
+    self.stop = stop
+    self.timestamp = timestamp
+
+  def get_route_name(self):
+    return self.route_name
+
+  def get_type(self):
+    return self.type
+
+  def get_stop(self):
+    return self.stop
+
+  def get_timestamp(self):
+    return self.timestamp
+
+
+# A journey stop, only has what's needed to explain transits.
+class FakeJourneyStop(object):
+
+  def __init__(self, route_name, name, arrival, departure):
+    self.route_name = route_name
+    self.name = name
+    self.arrival = arrival
+    self.departure = departure
+
+  def get_route_name(self):
+    return self.route_name
+
+  def get_name(self):
+    return self.name
+
+  def get_arrival(self):
+    return self.arrival
+
+  def get_departure(self):
+    return self.departure
+
+
+class FakeJourney(object):
+
+  def __init__(self, stops):
+    self.stops = stops
+
+  def get_stops(self):
+    return self.stops
+
+
+# A pipeline that records the boards it's asked to fetch rather than fetching
+# them.
+class RecordingPipeline(main.Pipeline):
+
+  def __init__(self):
+    self.fetched = []
+
+  def _fetch_transits_by_name(self, type, name, on_response=None):
+    self.fetched.append((type, name))
 
 
 class MainTest(unittest.TestCase):
@@ -11,15 +105,15 @@ class MainTest(unittest.TestCase):
   def test_coverage_tracker(self):
     t = main.CoverageTracker()
     self.assertEquals(0, t.get_next_uncovered(0, 10))
-    t = t.add_range(0, 2)
+    t.add_range(0, 2)
     self.assertEquals(3, t.get_next_uncovered(0, 10))
-    t = t.add_range(4, 5)
+    t.add_range(4, 5)
     self.assertEquals(3, t.get_next_uncovered(0, 10))
-    t = t.add_range(3, 3)
+    t.add_range(3, 3)
     self.assertEquals(6, t.get_next_uncovered(0, 10))
     self.assertEquals(6, t.get_next_uncovered(0, 6))
     self.assertEquals(None, t.get_next_uncovered(0, 5))
-    t = t.add_range(-5, -3)
+    t.add_range(-5, -3)
     self.assertEquals(6, t.get_next_uncovered(0, 10))
 
   def test_random_coverage_tracker(self):
@@ -33,7 +127,7 @@ class MainTest(unittest.TestCase):
       covered = set()
       for ir in range(0, 32):
         (start, end) = random_range()
-        t = t.add_range(start, end)
+        t.add_range(start, end)
         covered = covered.union(range(start, end + 1))
         for ic in range(0, 32):
           (start, end) = random_range()
@@ -44,6 +138,243 @@ class MainTest(unittest.TestCase):
           else:
             expected = min(available)
           self.assertEquals(expected, found)
+          gaps = t.get_uncovered(start, end)
+          self.assertEquals(sorted(available),
+            [v for (s, e) in gaps for v in range(s, e + 1)])
+          # Gaps are separated by covered values.
+          for ((_, e), (s, _)) in zip(gaps, gaps[1:]):
+            self.assertTrue(e + 1 < s)
+
+  def test_coverage_tracker_gaps(self):
+    t = main.CoverageTracker([(4, 5), (0, 2), (9, 12)])
+    self.assertEquals([(0, 2), (4, 5), (9, 12)], t.get_ranges())
+    self.assertEquals([(3, 3), (6, 8), (13, 20)], t.get_uncovered(0, 20))
+    self.assertEquals([(6, 7)], t.get_uncovered(5, 7))
+    self.assertEquals([], t.get_uncovered(9, 12))
+    self.assertEquals([(-3, -1)], t.get_uncovered(-3, 0))
+    # Copies change separately.
+    c = t.copy()
+    self.assertEquals(None, c.add_range(3, 8))
+    self.assertEquals([(0, 12)], c.get_ranges())
+    self.assertEquals([(0, 2), (4, 5), (9, 12)], t.get_ranges())
+
+  def test_window_planner(self):
+    minute = main.MIN_IN_MILLIS
+    planner = main.WindowPlanner(4)
+    key = ("departures", "1")
+    t = main.CoverageTracker()
+    # Without anything to go by only the first window is planned.
+    self.assertEquals([0], planner.plan(key, t, 0, 600 * minute))
+    planner.record(key, 0, 100 * minute)
+    t.add_range(0, 100 * minute - 1)
+    self.assertEquals([100 * minute, 190 * minute, 280 * minute, 370 * minute],
+      planner.plan(key, t, 0, 600 * minute))
+    # Windows aren't planned past the end or within covered ranges.
+    t.add_range(190 * minute, 300 * minute - 1)
+    self.assertEquals([100 * minute, 300 * minute],
+      planner.plan(key, t, 0, 350 * minute))
+    t.add_range(100 * minute, 400 * minute)
+    self.assertEquals([], planner.plan(key, t, 0, 400 * minute))
+    # A single window at a time is the same as not planning at all.
+    single = main.WindowPlanner(1)
+    single.record(key, 0, 100 * minute)
+    self.assertEquals([0], single.plan(key, main.CoverageTracker(), 0, 600 * minute))
+
+  def test_explanation_index(self):
+    hour = main.HOUR_IN_MILLIS
+    index = main.ExplanationIndex()
+    arrival = FakeBoardTransit("Bus 1", rejseplanen.ARRIVAL, "B", 2 * hour)
+    departure = FakeBoardTransit("Bus 1", rejseplanen.DEPARTURE, "A", hour)
+    other = FakeBoardTransit("Bus 2", rejseplanen.DEPARTURE, "A", hour)
+    late = FakeBoardTransit("Bus 1", rejseplanen.DEPARTURE, "A", 5 * hour)
+    index.add_transits([arrival, departure, other, late])
+    # Adding the same transits again makes no difference.
+    index.add_transits([departure, other])
+    def get_unexplained(start, end):
+      result = index.get_unexplained_transits(start, end)
+      return sorted(result, key=lambda t: (t.timestamp, t.route_name))
+    self.assertEquals([departure, other, arrival, late],
+      get_unexplained(0, 6 * hour))
+    self.assertEquals([departure, other], get_unexplained(hour, hour))
+    self.assertEquals([], get_unexplained(hour + 1, 2 * hour - 1))
+    # A journey explains the transits at its stops of its own route only.
+    index.add_journey(FakeJourney([
+      FakeJourneyStop("Bus 1", "A", None, hour),
+      FakeJourneyStop("Bus 1", "B", 2 * hour, None)]))
+    self.assertEquals([other, late], get_unexplained(0, 6 * hour))
+    # Transits that have already been explained stay explained.
+    index.add_transits([arrival])
+    self.assertEquals([other], get_unexplained(0, 4 * hour))
+
+  def test_config_dates(self):
+    dir = tempfile.mkdtemp()
+    try:
+      config_file = os.path.join(dir, "config.yaml")
+      def get_dates(config, *args):
+        with open(config_file, "wt") as file:
+          file.write(config)
+        parser = object.__new__(main.Interrogate)._build_option_parser()
+        return main.Config(parser.parse_args(["--config", config_file] + list(args))).get_dates()
+      self.assertEquals(["01.10.14"], get_dates("date: 01.10.14"))
+      self.assertEquals(["30.09.14", "01.10.14", "02.10.14"],
+        get_dates("dates: 30.09.14-02.10.14"))
+      self.assertEquals(["01.10.14", "03.10.14"],
+        get_dates("dates: [01.10.14, 03.10.14]"))
+      self.assertEquals(["01.10.14", "03.10.14"],
+        get_dates("date: 05.10.14", "--dates", "01.10.14,03.10.14"))
+      self.assertEquals([], get_dates("hubs: []"))
+    finally:
+      shutil.rmtree(dir)
+
+  def test_config_validate(self):
+    dir = tempfile.mkdtemp()
+    try:
+      config_file = os.path.join(dir, "config.yaml")
+      with open(config_file, "wt") as file:
+        file.write("\n".join([
+          "rest_base_url: http://x",
+          "date: 01.10.14",
+          "hubs: []",
+          "time_range: {start: '10:00', end: '11:00'}"]))
+      def validate(*args):
+        parser = object.__new__(main.Interrogate)._build_option_parser()
+        main.Config(parser.parse_args(["--config", config_file] + list(args))).validate()
+      validate()
+      validate("--gtfs", dir)
+      validate("--shards", "2")
+      # The feed is written by the workers so it can't be combined with shards.
+      self.assertRaises(AssertionError,
+        lambda: validate("--gtfs", dir, "--shards", "2"))
+    finally:
+      shutil.rmtree(dir)
+
+  def test_config_checkpoint_interval(self):
+    dir = tempfile.mkdtemp()
+    try:
+      config_file = os.path.join(dir, "config.yaml")
+      def get_interval(config, *args):
+        with open(config_file, "wt") as file:
+          file.write(config)
+        parser = object.__new__(main.Interrogate)._build_option_parser()
+        return main.Config(parser.parse_args(["--config", config_file] +
+          list(args))).get_checkpoint_interval()
+      # Runs only checkpoint when asked to.
+      self.assertEquals(0, get_interval("hubs: []"))
+      self.assertEquals(300, get_interval("hubs: []", "--resume"))
+      self.assertEquals(60, get_interval("checkpoint_interval: 60"))
+      self.assertEquals(10, get_interval("checkpoint_interval: 60",
+        "--checkpoint-interval", "10"))
+    finally:
+      shutil.rmtree(dir)
+
+  def test_checkpoint(self):
+    dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(dir, "checkpoint")
+      def new_checkpoint(run_key):
+        return main.Checkpoint(run_key, 0, store.Store(filename))
+      checkpoint = new_checkpoint("run")
+      checkpoint.clear()
+      checkpoint.add_board("01.10.14", ("departures", "1"),
+        main.BoardCache(["a"], main.CoverageTracker([(0, 10)])))
+      checkpoint.add_journeys([((1, "Bus 1"), "journey 1")])
+      checkpoint.add_stops([("A", "stop A")])
+      checkpoint.set_progress("turns", (1, 0))
+      checkpoint.save()
+      # Later saves add to the earlier ones and replace boards that grew.
+      checkpoint.add_board("01.10.14", ("departures", "1"),
+        main.BoardCache(["a", "b"], main.CoverageTracker([(0, 20)])))
+      checkpoint.add_journeys([((2, "Bus 1"), "journey 2")])
+      checkpoint.save()
+      checkpoint.close()
+      resumed = new_checkpoint("run")
+      (journeys, stops) = resumed.load()
+      self.assertEquals({(1, "Bus 1"): "journey 1", (2, "Bus 1"): "journey 2"},
+        journeys)
+      self.assertEquals({"A": "stop A"}, stops)
+      self.assertEquals((1, 0), resumed.get_progress("turns"))
+      boards = resumed.get_boards("01.10.14")
+      board = boards[("departures", "1")]
+      self.assertEquals(["a", "b"], board.responses)
+      self.assertEquals([(0, 20)], board.coverage.get_ranges())
+      self.assertEquals({}, resumed.get_boards("01.10.14"))
+      resumed.close()
+      # A different run doesn't resume the checkpoint.
+      other = new_checkpoint("other run")
+      self.assertEquals(None, other.load())
+      other.close()
+    finally:
+      shutil.rmtree(dir)
+
+  def test_shard_filter(self):
+    names = ["Bus %s" % i for i in range(0, 100)]
+    shards = [main.ShardFilter(i, 3) for i in range(0, 3)]
+    for name in names:
+      owners = [s for s in shards if s.contains(name)]
+      self.assertEquals(1, len(owners))
+    for shard in shards:
+      self.assertTrue(len([n for n in names if shard.contains(n)]) > 0)
+    single = main.ShardFilter(0, 1)
+    for name in names:
+      self.assertTrue(single.contains(name))
+
+  def test_derive_transport_modes(self):
+    derive = main.derive_transport_modes
+    self.assertEquals(["bus"], derive(["Bus .*"]))
+    self.assertEquals(["bus"], derive(["Bus 2A", "ExpB 9.*"]))
+    self.assertEquals(["train", "metro"], derive(["Metro .*", "IC .*", "Re 1?"]))
+    # Patterns that could match routes of any mode mean no filtering.
+    self.assertEquals(None, derive([]))
+    self.assertEquals(None, derive([".*"]))
+    self.assertEquals(None, derive(["Bus .*", "2A"]))
+    self.assertEquals(None, derive(["Bus 1|IC 2"]))
+    self.assertEquals(None, derive(["Bus? .*"]))
+
+  def test_prefetch_terminus_boards(self):
+    prefetcher = main.TerminusPrefetcher(main.StringFilter(["Bus .*"]),
+      main.ShardFilter(0, 1))
+    pipeline = RecordingPipeline()
+    prefetcher.add_pipeline(pipeline)
+    prefetch = prefetcher.prefetch
+    # Nothing is fetched until a route has been seen on both sides.
+    prefetch(0, [FakeHubTransit("Bus 1", "A"), FakeHubTransit("Tog 1", "T")])
+    self.assertEquals([], pipeline.fetched)
+    prefetch(1, [FakeHubTransit("Bus 1", "B"), FakeHubTransit("Bus 1", "C"),
+      FakeHubTransit("Bus 2", "D"), FakeHubTransit("Tog 1", "U")])
+    self.assertEquals([(rejseplanen.DEPARTURES, "A"), (rejseplanen.ARRIVALS, "B"),
+      (rejseplanen.ARRIVALS, "C")], pipeline.fetched)
+    # After that new terminuses are fetched as soon as they're seen.
+    prefetch(0, [FakeHubTransit("Bus 1", "A"), FakeHubTransit("Bus 1", "E")])
+    self.assertEquals((rejseplanen.DEPARTURES, "E"), pipeline.fetched[-1])
+    self.assertEquals(4, len(pipeline.fetched))
+    # The pipelines of the next turn, one per date, start out with all the
+    # terminuses seen so far.
+    prefetcher.start_round()
+    firsts = [RecordingPipeline(), RecordingPipeline()]
+    for first in firsts:
+      prefetcher.add_pipeline(first)
+      self.assertEquals([(rejseplanen.DEPARTURES, "A"), (rejseplanen.DEPARTURES, "E"),
+        (rejseplanen.ARRIVALS, "B"), (rejseplanen.ARRIVALS, "C")], first.fetched)
+    # New terminuses are fetched for all of them but not for the last turn.
+    prefetch(1, [FakeHubTransit("Bus 1", "F")])
+    for first in firsts:
+      self.assertEquals((rejseplanen.ARRIVALS, "F"), first.fetched[-1])
+    self.assertEquals(4, len(pipeline.fetched))
+
+  def test_merge_results(self):
+    # Hub boards are [departures, arrivals] with a list of transits per hub.
+    first_hubs = [[[FakeTransit(1, "a"), FakeTransit(2, "a")]], [[]]]
+    second_hubs = [[[FakeTransit(2, "a"), FakeTransit(3, "b")]], [[FakeTransit(0, "b")]]]
+    first = main.PipelineResult({"b": 1}, {"b": 2}, first_hubs, {"y": 3})
+    second = main.PipelineResult({"a": 4}, {"a": 5}, second_hubs, {"x": 6, "y": 3})
+    merged = main.PipelineResult.merge([first, second])
+    self.assertEquals(["a", "b"], list(merged.routes.keys()))
+    self.assertEquals([5, 2], list(merged.terminus_boards.values()))
+    def get_keys(hub_boards):
+      return [[[t.get_unique_key() for t in b] for b in bs] for bs in hub_boards]
+    self.assertEquals([[[(1, "a"), (2, "a"), (3, "b")]], [[(0, "b")]]],
+      get_keys(merged.hub_boards))
+    self.assertEquals(["x", "y"], list(merged.get_stops().keys()))
 
 if __name__ == '__main__':
   runner = unittest.TextTestRunner(verbosity=0)
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+
+import unittest
+import logging
+import random
+import shutil
+import tempfile
+import clock
+import columnar
+import main
+import planner
+import rejseplanen
+import stub
+
+
+logging.disable(logging.WARNING)
+
+
+_DATE = "01.10.14"
+
+
+def at(time):
+  return clock.Timestamp.from_date_time(_DATE, time)
+
+
+# Returns a result with the given trips, a list of (route name, [(stop name,
+# "HH:MM")]) pairs where the first stop only has a departure and the last
+# only an arrival.
+def new_result(trips):
+  strings = rejseplanen.StringTable()
+  journeys = {}
+  for (route_name, stops) in trips:
+    stop_times = []
+    for (index, (name, time)) in enumerate(stops):
+      arrival = None if (index == 0) else at(time)
+      departure = None if (index == len(stops) - 1) else at(time)
+      stop_times.append((name, arrival, departure))
+    journeys.setdefault(route_name, []).append(
+      rejseplanen.JourneyResponse.from_stops("url", None, route_name,
+        stop_times, strings))
+  routes = dict((n, main.RouteInfo(n, j, [])) for (n, j) in journeys.items())
+  return main.PipelineResult(routes, {}, [], {})
+
+
+# Returns the legs as (route, origin, "HH:MM", destination, "HH:MM") tuples.
+def describe(legs):
+  if legs is None:
+    return None
+  return [(l.get_route_name(), l.get_origin(),
+    clock.Timestamp.to_time(l.get_departure()), l.get_destination(),
+    clock.Timestamp.to_time(l.get_arrival())) for l in legs]
+
+
+_TRIPS = [
+  ("Bus 1", [("A", "07:00"), ("B", "07:10"), ("C", "07:20")]),
+  ("Bus 1", [("A", "07:30"), ("B", "07:40"), ("C", "07:50")]),
+  # Leaves B just after Bus 1 gets there, too soon to change.
+  ("Bus 2", [("B", "07:11"), ("D", "07:20")]),
+  ("Bus 2", [("B", "07:15"), ("D", "07:25")]),
+  ("Bus 2", [("B", "07:45"), ("D", "07:55")]),
+  # Slow but direct.
+  ("Bus 3", [("A", "07:05"), ("E", "07:20"), ("D", "07:40")]),
+]
+
+
+class PlannerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.planner = planner.Planner.from_result(new_result(_TRIPS), _DATE)
+
+  def test_earliest_arrival(self):
+    self.assertEquals(9, self.planner.get_connection_count())
+    self.assertEquals([("Bus 1", "A", "07:00", "C", "07:20")],
+      describe(self.planner.get_earliest_arrival("A", "C", at("07:00"))))
+    # Bus 2 at 07:11 leaves too soon after Bus 1 gets to B.
+    self.assertEquals([("Bus 1", "A", "07:00", "B", "07:10"),
+        ("Bus 2", "B", "07:15", "D", "07:25")],
+      describe(self.planner.get_earliest_arrival("A", "D", at("07:00"))))
+    self.planner.set_transfer_seconds("B", 0)
+    self.assertEquals([("Bus 1", "A", "07:00", "B", "07:10"),
+        ("Bus 2", "B", "07:11", "D", "07:20")],
+      describe(self.planner.get_earliest_arrival("A", "D", at("07:00"))))
+    # No transfer is needed to leave from the origin.
+    self.assertEquals([("Bus 2", "B", "07:11", "D", "07:20")],
+      describe(self.planner.get_earliest_arrival("B", "D", at("07:11"))))
+    self.assertEquals([("Bus 3", "E", "07:20", "D", "07:40")],
+      describe(self.planner.get_earliest_arrival("E", "D", at("07:01"))))
+    # Nothing gets there when leaving after the last bus.
+    self.assertEquals(None, self.planner.get_earliest_arrival("A", "D",
+      at("07:46")))
+    self.assertEquals(None, self.planner.get_earliest_arrival("C", "A",
+      at("07:00")))
+    self.assertEquals([], self.planner.get_earliest_arrival("A", "A",
+      at("07:00")))
+    self.assertRaises(planner.UnknownStop, self.planner.get_earliest_arrival,
+      "A", "X", at("07:00"))
+
+  def test_profile(self):
+    def profile(origin, destination, start, end):
+      return [(clock.Timestamp.to_time(d), clock.Timestamp.to_time(a))
+        for (d, a) in self.planner.get_profile(origin, destination, at(start),
+          at(end))]
+    # The direct bus is slower but worth taking when leaving after 07:00.
+    self.assertEquals([("07:00", "07:25"), ("07:05", "07:40"),
+      ("07:30", "07:55")], profile("A", "D", "06:00", "08:00"))
+    self.assertEquals([("07:05", "07:40"), ("07:30", "07:55")],
+      profile("A", "D", "07:01", "08:00"))
+    self.assertEquals([("07:00", "07:25"), ("07:05", "07:40")],
+      profile("A", "D", "07:00", "07:29"))
+    # Nothing leaves A for D after 07:30.
+    self.assertEquals([], profile("A", "D", "07:31", "08:00"))
+    self.assertEquals([("07:11", "07:20"), ("07:15", "07:25"),
+      ("07:45", "07:55")], profile("B", "D", "07:00", "08:00"))
+    # Journeys leaving after the end don't count, even if they get there
+    # sooner.
+    self.planner = planner.Planner.from_result(new_result(_TRIPS +
+      [("Bus 4", [("A", "07:20"), ("D", "07:35")])]), _DATE)
+    self.assertEquals([("07:05", "07:40")], profile("A", "D", "07:01", "07:10"))
+    self.assertEquals([("07:00", "07:25"), ("07:20", "07:35"),
+      ("07:30", "07:55")], profile("A", "D", "07:00", "08:00"))
+
+  def test_from_timetable(self):
+    dir = tempfile.mkdtemp()
+    try:
+      columnar.write(dir, _DATE, new_result(_TRIPS))
+      timetable = columnar.read(dir)
+      try:
+        from_timetable = planner.Planner.from_timetable(timetable)
+      finally:
+        timetable.close()
+    finally:
+      shutil.rmtree(dir)
+    for name in ["departures", "arrivals", "trips", "transfer_seconds"]:
+      self.assertEquals(getattr(self.planner, name),
+        getattr(from_timetable, name))
+    self.assertEquals(
+      describe(self.planner.get_earliest_arrival("A", "D", at("07:00"))),
+      describe(from_timetable.get_earliest_arrival("A", "D", at("07:00"))))
+
+  # Checks the profile on a synthetic network against one found the slow way,
+  # by scanning forward from every departure from the origin within range.
+  # Every journey in the profile also gets there no sooner than the earliest
+  # arrival when leaving at its departure.
+  def test_synthetic_network(self):
+    network = stub.SyntheticNetwork(routes=20, stops_per_route=10, headway=20)
+    synthetic = planner.Planner.from_result(
+      stub.get_synthetic_result(network, _DATE), _DATE)
+    names = [s.name for s in network.stops if len(s.visits) > 0]
+    generator = random.Random(4)
+    for i in range(0, 40):
+      (origin, destination) = generator.sample(names, 2)
+      start = at("06:00") + generator.randint(0, 12 * 60) * 60 * 1000
+      end = start + 2 * 60 * 60 * 1000
+      profile = synthetic.get_profile(origin, destination, start, end)
+      self.assertEquals(get_slow_profile(synthetic, origin, destination, start,
+        end), profile)
+      for (departure, arrival) in profile:
+        legs = synthetic.get_earliest_arrival(origin, destination, departure)
+        self.assertTrue(legs[-1].get_arrival() <= arrival)
+        # Consecutive legs leave time to change.
+        for (leg, next_leg) in zip(legs, legs[1:]):
+          self.assertEquals(leg.get_destination(), next_leg.get_origin())
+          self.assertTrue(leg.get_arrival() + planner.DEFAULT_TRANSFER_SECONDS *
+            1000 <= next_leg.get_departure())
+
+
+# Returns the profile of the journeys between the given stops leaving within
+# the given range by finding the earliest arrival of the journeys leaving at
+# each departure from the origin and keeping the ones no other journey beats.
+def get_slow_profile(planner, origin, destination, start, end):
+  origin_index = planner.stop_indices[origin]
+  destination_index = planner.stop_indices[destination]
+  journeys = []
+  for index in range(0, planner.get_connection_count()):
+    departure = planner._to_timestamp(planner.departures[index])
+    if (planner.origins[index] != origin_index) or not (start <= departure <= end):
+      continue
+    # Scan forward from the departure, only boarding at the origin then.
+    earliest = {}
+    boarded = set()
+    for later in range(index, planner.get_connection_count()):
+      later_departure = planner._to_timestamp(planner.departures[later])
+      if later_departure >= earliest.get(destination_index, later_departure + 1):
+        break
+      stop = planner.origins[later]
+      trip = planner.trips[later]
+      if not trip in boarded:
+        if stop == origin_index:
+          ready = departure if (later == index) else None
+        else:
+          ready = None
+        if stop in earliest:
+          transfer = earliest[stop] + planner.transfer_seconds[stop] * 1000
+          ready = transfer if (ready is None) else min(ready, transfer)
+        if (ready is None) or (ready > later_departure):
+          continue
+        boarded.add(trip)
+      stop = planner.destinations[later]
+      arrival = planner._to_timestamp(planner.arrivals[later])
+      earliest[stop] = min(earliest.get(stop, arrival), arrival)
+    if destination_index in earliest:
+      journeys.append((departure, earliest[destination_index]))
+  return sorted(set((d, a) for (d, a) in journeys
+    if not any((e >= d) and (b <= a) and ((e, b) != (d, a))
+      for (e, b) in journeys)))
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=0)
+  unittest.main(testRunner=runner)
@@ -0,0 +1,431 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import rejseplanen
+import promise
+import store
+import clock
+
+
+_DEPARTURES = u"""<?xml version="1.0" encoding="UTF-8"?>
+<DepartureBoard>
+<Departure name="Bus 2A" type="BUS" stop="Århus rtb." time="07:10" date="01.10.14" finalStop="Kolt">
+<JourneyDetailRef ref="http://x/journeyDetail?ref=1%2F2%3Fdate%3D01.10.14"/>
+</Departure>
+<Departure name="Bus 3A" type="BUS" stop="Århus rtb." time="07:12" date="01.10.14" finalStop="Trige">
+<JourneyDetailRef ref="http://x/journeyDetail?ref=3%2F4%3Fdate%3D01.10.14"/>
+</Departure>
+</DepartureBoard>
+"""
+
+_JOURNEY = u"""<?xml version="1.0" encoding="UTF-8"?>
+<JourneyDetail>
+<Stop name="Århus rtb." x="10200000" y="56150000" routeIdx="0" depTime="07:10" depDate="01.10.14"/>
+<Stop name="Kolt" x="10200000" y="56150000" routeIdx="1" arrTime="07:40" arrDate="01.10.14"/>
+<JourneyName name="Bus 2A" routeIdxFrom="0" routeIdxTo="1"/>
+</JourneyDetail>
+"""
+# The json rendition of the departures above, except that the second departure
+# has been left out to check that a single element isn't wrapped in a list.
+_DEPARTURES_JSON = u"""{"DepartureBoard": {
+  "Departure": {"name": "Bus 2A", "type": "BUS", "stop": "Århus rtb.",
+    "time": "07:10", "date": "01.10.14", "finalStop": "Kolt",
+    "JourneyDetailRef": {"ref": "http://x/journeyDetail?ref=1%2F2%3Fdate%3D01.10.14"}}
+}}
+"""
+
+_JOURNEY_JSON = u"""{"JourneyDetail": {
+  "Stop": [
+    {"name": "Århus rtb.", "x": "10200000", "y": "56150000", "routeIdx": "0",
+      "depTime": "07:10", "depDate": "01.10.14"},
+    {"name": "Kolt", "x": "10200000", "y": "56150000", "routeIdx": "1",
+      "arrTime": "07:40", "arrDate": "01.10.14"}],
+  "JourneyName": {"name": "Bus 2A", "routeIdxFrom": "0", "routeIdxTo": "1"}
+}}
+"""
+
+_LOCATIONS = u"""<?xml version="1.0" encoding="UTF-8"?>
+<LocationList>
+<StopLocation name="Lystrup, Bygaden (Aarhus)" x="10236000" y="56236000" id="751400101"/>
+<StopLocation name="Århus rtb." x="10200000" y="56150000" id="751400102"/>
+</LocationList>
+"""
+
+
+# A service that records location requests and lets the test decide when they
+# complete.
+class FakeLocationService(object):
+
+  def __init__(self, scheduler):
+    self.scheduler = scheduler
+    self.requests = []
+
+  def fetch(self, request):
+    result = self.scheduler.new_promise()
+    self.requests.append((request.input, result))
+    return result
+
+
+class RejseplanenTest(unittest.TestCase):
+
+  def test_parse_departures(self):
+    request = rejseplanen.DeparturesRequest()
+    departures = request.process_response("board", _DEPARTURES).get_departures()
+    self.assertEquals(2, len(departures))
+    first = departures[0]
+    self.assertEquals("Bus 2A", first.get_route_name())
+    self.assertEquals(u"Århus rtb.", first.get_stop())
+    self.assertEquals("Kolt", first.get_end())
+    self.assertEquals(clock.Timestamp.from_date_time("01.10.14", "07:10"),
+      first.get_timestamp())
+    self.assertEquals("http://x/journeyDetail?ref=1%2F2%3Fdate%3D01.10.14",
+      first.get_journey_url())
+    self.assertEquals("Trige", departures[1].get_terminus())
+
+  def test_parse_journey(self):
+    departure = rejseplanen.DeparturesRequest().process_response("board",
+      _DEPARTURES).get_departures()[0]
+    request = rejseplanen.JourneyRequest("journey", departure)
+    journey = request.process_response("journey", _JOURNEY)
+    self.assertEquals("Bus 2A", journey.get_route_name())
+    stops = journey.get_stops()
+    self.assertEquals(2, len(stops))
+    self.assertEquals("Bus 2A", stops[0].get_route_name())
+    self.assertEquals(None, stops[0].get_arrival())
+    self.assertEquals(None, stops[1].get_departure())
+    self.assertTrue(journey.has_transit(departure))
+
+  def test_parse_json(self):
+    request = rejseplanen.DeparturesRequest()
+    departures = request.process_response("board", _DEPARTURES_JSON,
+      format=rejseplanen.JSON).get_departures()
+    self.assertEquals(1, len(departures))
+    departure = departures[0]
+    self.assertEquals(u"Århus rtb.", departure.get_stop())
+    self.assertEquals("Kolt", departure.get_end())
+    self.assertEquals(clock.Timestamp.from_date_time("01.10.14", "07:10"),
+      departure.get_timestamp())
+    self.assertEquals("http://x/journeyDetail?ref=1%2F2%3Fdate%3D01.10.14",
+      departure.get_journey_url())
+    request = rejseplanen.JourneyRequest("journey", departure)
+    journey = request.process_response("journey", _JOURNEY_JSON,
+      format=rejseplanen.JSON)
+    self.assertEquals("Bus 2A", journey.get_route_name())
+    self.assertEquals(2, len(journey.get_stops()))
+    self.assertTrue(journey.has_transit(departure))
+    self.assertRaises(rejseplanen.InvalidResponse, request.process_response,
+      "journey", u'{"JourneyDetail": {"error": "no"}}', format=rejseplanen.JSON)
+    # Cached responses known to be in the other format aren't decoded.
+    self.assertTrue(rejseplanen.JSON.accepts("application/json"))
+    self.assertFalse(rejseplanen.JSON.accepts("application/xml"))
+    self.assertTrue(rejseplanen.XML.accepts("text/xml"))
+    self.assertFalse(rejseplanen.XML.accepts("application/json"))
+
+  def test_invalid_journey(self):
+    departure = rejseplanen.DeparturesRequest().process_response("board",
+      _DEPARTURES).get_departures()[0]
+    request = rejseplanen.JourneyRequest("journey", departure)
+    self.assertRaises(rejseplanen.InvalidResponse, request.process_response,
+      "journey", u"<JourneyDetail error=\"no\"/>")
+
+  def test_transport_modes(self):
+    class FakeService(object):
+      def get_request_path(self, endpoint):
+        return "http://x/%s" % endpoint
+    timestamp = clock.Timestamp.from_date_time("01.10.14", "07:00")
+    def get_url(request, modes):
+      request = request.set_id("1").set_timestamp(timestamp).set_modes(modes)
+      return request.get_http_request(FakeService()).get_url()
+    self.assertEquals(
+      "http://x/departureBoard?id=1&date=01.10.14&time=07%3A00",
+      get_url(rejseplanen.DeparturesRequest(), None))
+    self.assertEquals(
+      "http://x/departureBoard?id=1&date=01.10.14&time=07%3A00&useTog=0&useMetro=0",
+      get_url(rejseplanen.DeparturesRequest(), ["bus"]))
+    self.assertEquals(
+      "http://x/arrivalBoard?id=1&date=01.10.14&time=07%3A00&useBus=0",
+      get_url(rejseplanen.ArrivalsRequest(), ["train", "metro"]))
+
+  def test_parse_journey_ref(self):
+    self.assertEquals(("1/2", "01.10.14"), rejseplanen.parse_journey_ref(
+      "http://x/journeyDetail?ref=1%2F2%3Fdate%3D01.10.14"))
+    self.assertEquals(("1/2", "01.10.14"), rejseplanen.parse_journey_ref(
+      "http://x/journeyDetail?ref=1%2F2%3Fdate%3D01.10.14%26station_evaId%3D751"))
+    self.assertEquals(None, rejseplanen.parse_journey_ref("http://x/journeyDetail"))
+    self.assertEquals(None, rejseplanen.parse_journey_ref(
+      "http://x/journeyDetail?ref=1%2F2"))
+
+  def test_journey_index(self):
+    departure = rejseplanen.DeparturesRequest().process_response("board",
+      _DEPARTURES).get_departures()[0]
+    journey = rejseplanen.JourneyRequest("journey", departure).process_response(
+      "journey", _JOURNEY)
+    index = rejseplanen.JourneyIndex()
+    self.assertEquals(None, index.get(departure))
+    self.assertTrue(index.add(journey) is journey)
+    self.assertTrue(index.get(departure) is journey)
+    # The same trip fetched through another url is the same journey.
+    again = rejseplanen.JourneyRequest("other", departure).process_response(
+      "other", _JOURNEY)
+    self.assertTrue(index.add(again) is journey)
+    self.assertEquals(1, len(index))
+    self.assertEquals(("Bus 2A", u"Århus rtb.",
+      clock.Timestamp.from_date_time("01.10.14", "07:10"), "Kolt",
+      clock.Timestamp.from_date_time("01.10.14", "07:40")), journey.get_identity())
+    # The other departure is a different trip.
+    other = rejseplanen.DeparturesRequest().process_response("board",
+      _DEPARTURES).get_departures()[1]
+    self.assertEquals(None, index.get(other))
+
+  def test_date_corrections(self):
+    dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(dir, "store.db")
+      departures = rejseplanen.DeparturesRequest().process_response("board",
+        _DEPARTURES).get_departures()
+      corrections = rejseplanen.DateCorrections(store.Store(filename))
+      self.assertFalse(corrections.should_correct(departures[0]))
+      corrections.record(departures[0], True)
+      self.assertTrue(corrections.should_correct(departures[0]))
+      # Other routes are counted separately.
+      self.assertFalse(corrections.should_correct(departures[1]))
+      corrections.record(departures[0], False)
+      self.assertFalse(corrections.should_correct(departures[0]))
+      corrections.record(departures[0], True)
+      corrections.save()
+      corrections.store.close()
+      loaded = rejseplanen.DateCorrections(store.Store(filename))
+      self.assertTrue(loaded.should_correct(departures[0]))
+      # Saving adds to what's in the store.
+      loaded.record(departures[0], False)
+      loaded.record(departures[0], False)
+      loaded.save()
+      self.assertEquals([(2, 5)], loaded.store.query(
+        "SELECT corrected, total FROM date_corrections"))
+      loaded.store.close()
+    finally:
+      shutil.rmtree(dir)
+
+  def test_board_windows(self):
+    dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(dir, "store.db")
+      minute = 60 * 1000
+      midnight = clock.Timestamp.from_date_time("01.10.14", "00:00")
+      def at(minutes):
+        return midnight + minutes * minute
+      windows = rejseplanen.BoardWindows("xml", store.Store(filename))
+      self.assertEquals([], windows.get_windows("departures", "1", at(0), at(100)))
+      for (start, last) in [(0, 30), (30, 50), (20, 60), (80, 90), (85, 95)]:
+        windows.record("departures", "1", at(start), at(last))
+      # Empty boards cover nothing.
+      windows.record("departures", "1", at(95), at(95))
+      windows.record("arrivals", "1", at(0), at(100))
+      # Overlapping windows are skipped in favor of the one reaching furthest
+      # and gaps are left for the caller to fill in.
+      self.assertEquals([at(0), at(20), at(80), at(85)],
+        windows.get_windows("departures", "1", at(0), at(100)))
+      self.assertEquals([at(20)],
+        windows.get_windows("departures", "1", at(35), at(70)))
+      self.assertEquals([], windows.get_windows("departures", "1", at(60), at(79)))
+      self.assertEquals([], windows.get_windows("departures", "2", at(0), at(100)))
+      windows.save()
+      windows.store.close()
+      loaded = rejseplanen.BoardWindows("xml", store.Store(filename))
+      self.assertEquals([at(0), at(20), at(80), at(85)],
+        loaded.get_windows("departures", "1", at(0), at(100)))
+      self.assertEquals([("01.10.14", 6)], loaded.store.query(
+        "SELECT date, COUNT(*) FROM board_windows GROUP BY date"))
+      loaded.store.close()
+      # Windows fetched with other parameters aren't used.
+      other = rejseplanen.BoardWindows("json", store.Store(filename))
+      self.assertEquals([], other.get_windows("departures", "1", at(0), at(100)))
+      other.store.close()
+    finally:
+      shutil.rmtree(dir)
+
+  def test_move_journey(self):
+    departure = rejseplanen.DeparturesRequest().process_response("board",
+      _DEPARTURES).get_departures()[0]
+    journey = rejseplanen.JourneyRequest("journey", departure).process_response(
+      "journey", _JOURNEY)
+    moved = journey.add_days(departure, 2)
+    self.assertEquals("journey", moved.get_source_url())
+    self.assertEquals("Bus 2A", moved.get_route_name())
+    self.assertFalse(moved.has_transit(departure))
+    stops = moved.get_stops()
+    self.assertEquals(clock.Timestamp.from_date_time("03.10.14", "07:10"),
+      stops[0].get_departure())
+    self.assertEquals(None, stops[0].get_arrival())
+    self.assertEquals(clock.Timestamp.from_date_time("03.10.14", "07:40"),
+      stops[1].get_arrival())
+    self.assertEquals("Bus 2A", stops[1].get_route_name())
+    # The original is left alone.
+    self.assertTrue(journey.has_transit(departure))
+
+  def test_move_journey_across_dst(self):
+    old_tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/Copenhagen"
+    time.tzset()
+    clock.clear_cache()
+    try:
+      departure = rejseplanen.DeparturesRequest().process_response("board",
+        _DEPARTURES).get_departures()[0]
+      strings = rejseplanen.StringTable()
+      # Leaves before and arrives after the clocks go back on the 26th.
+      journey = rejseplanen.JourneyRequest("journey", departure).process_response(
+        "journey", _JOURNEY.replace("01.10.14", "25.10.14")
+          .replace("07:10", "01:30").replace("07:40", "03:30"), strings)
+      first = journey.add_days(departure, 1, strings)
+      second = journey.add_days(departure, 1, strings)
+      self.assertEquals(3 * 60 * 60 * 1000,
+        first.get_stops()[1].get_arrival() - first.get_stops()[0].get_departure())
+      self.assertNotEquals(journey.get_sub_route(), first.get_sub_route())
+      # The new sub-route is shared through the table.
+      self.assertTrue(first.get_sub_route() is second.get_sub_route())
+      self.assertTrue(first.get_sub_route().get_names() is
+        journey.get_sub_route().get_names())
+      # Moving it back restores the original sub-route.
+      self.assertTrue(first.add_days(departure, -1, strings).get_sub_route() is
+        journey.get_sub_route())
+    finally:
+      if old_tz is None:
+        del os.environ["TZ"]
+      else:
+        os.environ["TZ"] = old_tz
+      time.tzset()
+      clock.clear_cache()
+
+  def test_sub_routes(self):
+    departure = rejseplanen.DeparturesRequest().process_response("board",
+      _DEPARTURES).get_departures()[0]
+    request = rejseplanen.JourneyRequest("journey", departure)
+    strings = rejseplanen.StringTable()
+    journey = request.process_response("journey", _JOURNEY, strings)
+    later = request.process_response("journey",
+      _JOURNEY.replace("07:10", "08:10").replace("07:40", "08:40"), strings)
+    slower = request.process_response("journey",
+      _JOURNEY.replace("07:40", "07:45"), strings)
+    sub_route = journey.get_sub_route()
+    self.assertEquals("Bus 2A", sub_route.get_route_name())
+    self.assertEquals((u"\xc5rhus rtb.", "Kolt"), sub_route.get_names())
+    self.assertEquals((None, 30 * 60 * 1000), sub_route.get_arrivals())
+    self.assertEquals((0, None), sub_route.get_departures())
+    self.assertEquals(clock.Timestamp.from_date_time("01.10.14", "07:10"),
+      journey.get_start())
+    # Journeys an hour apart share the one sub-route, a slower one doesn't but
+    # still shares the stops.
+    self.assertTrue(later.get_sub_route() is sub_route)
+    self.assertNotEquals(sub_route, slower.get_sub_route())
+    self.assertTrue(slower.get_sub_route().get_names() is sub_route.get_names())
+    self.assertEquals(("Bus 2A", u"\xc5rhus rtb.",
+      clock.Timestamp.from_date_time("01.10.14", "08:10"), "Kolt",
+      clock.Timestamp.from_date_time("01.10.14", "08:40")), later.get_identity())
+    # Moving a journey keeps its sub-route.
+    self.assertTrue(journey.add_days(departure, 2).get_sub_route() is sub_route)
+
+  def test_timetable_history(self):
+    dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(dir, "store.db")
+      history = rejseplanen.TimetableHistory(store.Store(filename))
+      self.assertEquals(None, history.get_previous_date("01.10.14"))
+      board = {(600, u"Kolt"): (u"journey1", 0), (660, u"Kolt"): (u"journey2", 1)}
+      history.add_boards("30.09.14", {(u"Bus 2A", "departure", u"Århus"): board})
+      history.add_boards("28.09.14", {})
+      history.store.close()
+      loaded = rejseplanen.TimetableHistory(store.Store(filename))
+      self.assertEquals("30.09.14", loaded.get_previous_date("01.10.14"))
+      self.assertEquals("30.09.14", loaded.get_previous_date("01.11.14"))
+      self.assertEquals(None, loaded.get_previous_date("30.09.14"))
+      boards = loaded.get_boards("30.09.14")
+      ((fingerprint, transits),) = boards.values()
+      self.assertEquals([(u"Bus 2A", "departure", u"Århus")], boards.keys())
+      self.assertEquals(board, transits)
+      # The fingerprint only depends on the transits, not their journeys.
+      self.assertEquals(rejseplanen.TimetableHistory.get_fingerprint(
+        [(660, u"Kolt"), (600, u"Kolt")]), fingerprint)
+      self.assertNotEquals(rejseplanen.TimetableHistory.get_fingerprint(
+        [(600, u"Kolt")]), fingerprint)
+      self.assertEquals({}, loaded.get_boards("01.10.14"))
+      loaded.store.close()
+    finally:
+      shutil.rmtree(dir)
+
+  def test_normalize_stop_name(self):
+    self.assertEquals(u"lystrup bygaden (aarhus)",
+      rejseplanen.normalize_stop_name(u"Lystrup. Bygaden  (Aarhus)"))
+    self.assertEquals(u"århus rtb",
+      rejseplanen.normalize_stop_name(u"Århus Rtb."))
+
+  def test_gazetteer(self):
+    dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(dir, "store.db")
+      first = rejseplanen.Gazetteer(rejseplanen.StringTable(), store.Store(filename))
+      response = rejseplanen.LocationRequest().process_response("locs", _LOCATIONS)
+      first.add_all(response.get_stop_locations())
+      self.assertEquals(None, first.get(u"Lystrup"))
+      self.assertEquals(u"Lystrup, Bygaden (Aarhus)",
+        first.get(u"Lystrup. Bygaden  (Aarhus)").get_name())
+      # Aliases are only written on save.
+      self.assertEquals([], first.store.query("SELECT alias FROM stop_aliases"))
+      first.save()
+      self.assertEquals(1, len(first.store.query("SELECT alias FROM stop_aliases")))
+      # Or along with the next locations added.
+      first.get(u"Århus rtb")
+      first.add_all([rejseplanen.StopLocation("locs", {"name": u"Kolt", "id": "1",
+        "x": 1, "y": 2}, rejseplanen.StringTable())])
+      self.assertEquals(2, len(first.store.query("SELECT alias FROM stop_aliases")))
+      first.store.close()
+      # A new gazetteer on the same store knows the locations and the alias.
+      second = rejseplanen.Gazetteer(rejseplanen.StringTable(), store.Store(filename))
+      location = second.get(u"Århus rtb.")
+      self.assertEquals(u"751400102", location.get_id())
+      self.assertEquals((10200000, 56150000), location.get_position())
+      self.assertEquals("locs", location.get_source_url())
+      self.assertTrue(u"Lystrup. Bygaden  (Aarhus)" in second.by_name)
+      second.store.close()
+    finally:
+      shutil.rmtree(dir)
+
+  def test_location_repository(self):
+    scheduler = promise.Scheduler()
+    service = FakeLocationService(scheduler)
+    gazetteer = rejseplanen.Gazetteer(rejseplanen.StringTable())
+    repo = rejseplanen.LocationRepository(scheduler, service, gazetteer,
+      max_in_flight=2)
+    names = [u"Lystrup, Bygaden (Aarhus)", u"Århus rtb.", u"Kolt"]
+    results = [repo.get_info_by_name(n) for n in names]
+    scheduler.run_all_tasks()
+    # Only two requests are allowed to be in flight at once.
+    self.assertEquals(names[:2], [input for (input, p) in service.requests])
+    response = rejseplanen.LocationRequest().process_response("locs", _LOCATIONS)
+    service.requests[0][1].fulfill(response)
+    scheduler.run_all_tasks()
+    # The third name gets to go when the first request is done, while the
+    # second is still in flight.
+    self.assertEquals(u"751400101", results[0].get().get_id())
+    self.assertEquals(3, len(service.requests))
+    self.assertEquals(u"Kolt", service.requests[2][0])
+    service.requests[1][1].fulfill(response)
+    scheduler.run_all_tasks()
+    self.assertEquals(u"751400102", results[1].get().get_id())
+    service.requests[2][1].fulfill(rejseplanen.LocationResponse("none", []))
+    scheduler.run_all_tasks()
+    self.assertTrue(isinstance(results[2].get_error(), rejseplanen.UnknownLocation))
+    # Known names are resolved without asking the backend.
+    repo.get_info_by_name(u"Århus rtb.")
+    scheduler.run_all_tasks()
+    self.assertEquals(3, len(service.requests))
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=0)
+  unittest.main(testRunner=runner)
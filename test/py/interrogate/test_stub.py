@@ -0,0 +1,505 @@
+#!/usr/bin/python
+
+
+import unittest
+import logging
+import csv
+import os
+import shutil
+import tempfile
+import urllib2
+import yaml
+import stub
+import rejseplanen
+import promise
+import main
+import clock
+import columnar
+
+
+logging.disable(logging.INFO)
+
+
+class StubTest(unittest.TestCase):
+
+  def setUp(self):
+    self.network = stub.SyntheticNetwork(routes=4, stops_per_route=6, headway=30)
+    self.server = stub.StubServer().start()
+    self.base_url = self.server.get_base_url()
+    self.server.set_backend(stub.SyntheticBackend(self.network, self.base_url))
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.dir)
+
+  def fetch_text(self, path):
+    text = urllib2.urlopen("%s/%s" % (self.base_url, path)).read()
+    return text.decode("utf8")
+
+  def test_boards_match_journeys(self):
+    hub = self.network.hubs[0]
+    board = self.fetch_text("departureBoard?id=%s&date=01.10.14&time=07:00" % hub.id)
+    request = rejseplanen.DeparturesRequest()
+    departures = request.process_response("board", board).get_departures()
+    self.assertEquals(stub.BOARD_SIZE, len(departures))
+    for departure in departures:
+      path = departure.get_journey_url()[len(self.base_url) + 1:]
+      request = rejseplanen.JourneyRequest(path, departure)
+      journey = request.process_response("journey", self.fetch_text(path))
+      self.assertTrue(journey.has_transit(departure))
+      self.assertEquals(departure.get_end(), journey.get_stops()[-1].get_name())
+
+  def test_location(self):
+    locations = self.fetch_text("location?input=Hub+1")
+    response = rejseplanen.LocationRequest().process_response("location", locations)
+    first = response.get_stop_locations()[0]
+    self.assertEquals("Hub 1", first.get_name())
+    self.assertEquals(self.network.hubs[0].id, first.get_id())
+
+  def test_injected_errors(self):
+    failing = stub.StubServer(error_rate=1.0).start()
+    try:
+      failing.set_backend(stub.SyntheticBackend(self.network, failing.get_base_url()))
+      url = "%s/location?input=Hub" % failing.get_base_url()
+      self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url)
+    finally:
+      failing.stop()
+
+  # Returns the departures of the first trip of the network from its first two
+  # stops, as seen on the boards of those stops fetched by the given service.
+  def get_two_sightings(self, service):
+    trip = self.network.patterns[0].get_trip(0)
+    midnight = clock.Timestamp.from_date_time("01.10.14", "00:00")
+    sightings = []
+    for (stop, minute) in zip(trip.stops, trip.times)[0:2]:
+      timestamp = midnight + minute * 60 * 1000
+      board_p = service.get_departures(stop.id, timestamp)
+      self.wait_for(service, board_p)
+      sightings.append([d for d in board_p.get().get_departures()
+        if (d.get_route_name() == trip.route) and
+          (d.get_timestamp() == timestamp)][0])
+    return sightings
+
+  def new_service(self):
+    return rejseplanen.Rejseplanen(self.base_url, promise.Scheduler(),
+      os.path.join(self.dir, "cache.db"), "test", 1000, 100, 2)
+
+  # Runs the given service's scheduler until the given promise is resolved.
+  def wait_for(self, service, result_p):
+    while not result_p.is_resolved():
+      service.scheduler.run_next_task()
+
+  def test_journey_sightings(self):
+    service = self.new_service()
+    try:
+      (first, second) = self.get_two_sightings(service)
+      self.assertNotEquals(first.get_source_url(), second.get_source_url())
+      self.assertNotEquals(first.get_journey_url(), second.get_journey_url())
+      first_p = service._fetch_journey(first, first.get_journey_url())
+      second_p = service._fetch_journey(second, second.get_journey_url())
+      self.wait_for(service, first_p)
+      self.wait_for(service, second_p)
+      # The trip is only fetched once but each sighting gets it as its own.
+      self.assertTrue(first_p.get().get_transit() is first)
+      self.assertTrue(second_p.get().get_transit() is second)
+      self.assertTrue(first_p.get().get_sub_route() is
+        second_p.get().get_sub_route())
+    finally:
+      service.close()
+
+  def test_invalid_journey_sightings(self):
+    service = self.new_service()
+    try:
+      (first, second) = self.get_two_sightings(service)
+      synthetic = stub.SyntheticBackend(self.network, self.base_url)
+      class InvalidJourneys(object):
+        def get_response(self, endpoint, params, path):
+          if endpoint == "journeyDetail":
+            return "<JourneyDetail></JourneyDetail>"
+          return synthetic.get_response(endpoint, params, path)
+      self.server.set_backend(InvalidJourneys())
+      first_p = service._fetch_journey(first, first.get_journey_url())
+      second_p = service._fetch_journey(second, second.get_journey_url())
+      self.wait_for(service, first_p)
+      self.wait_for(service, second_p)
+      error = second_p.get_error()
+      self.assertTrue(isinstance(error, rejseplanen.InvalidResponse))
+      # The boards of both sightings are dropped so they're fetched again.
+      for board_url in [first.get_source_url(), second.get_source_url()]:
+        self.assertTrue(board_url in error.invalid_urls)
+        self.assertEquals(None, service.http.cache.get_response(board_url))
+    finally:
+      service.close()
+
+  # Writes a config for the synthetic network covering 07:00 to 09:00 and
+  # returns its file name.
+  def write_config(self, **settings):
+    config = stub.get_synthetic_config(self.network, self.base_url, "01.10.14",
+      os.path.join(self.dir, "cache.db"))
+    config["time_range"] = {"start": "07:00", "end": "09:00"}
+    config.update(settings)
+    config_file = os.path.join(self.dir, "config.yaml")
+    with open(config_file, "wt") as file:
+      yaml.safe_dump(config, file)
+    return config_file
+
+  # Checks that the result covers all the routes of the network and explains
+  # all the transits between 07:00 and 09:00 on the given date.
+  def check_result(self, result, date="01.10.14"):
+    self.assertEquals(sorted(self.network.get_route_names()),
+      sorted(result.routes.keys()))
+    start = clock.Timestamp.from_date_time(date, "07:00")
+    end = clock.Timestamp.from_date_time(date, "09:00")
+    self.assertEquals([], result.get_unexplained_transits(start, end))
+
+  def test_interrogate(self):
+    interrogate = main.Interrogate(["--config", self.write_config()])
+    try:
+      result = interrogate._interrogate()
+    finally:
+      interrogate._close()
+    self.check_result(result)
+
+  def test_gtfs(self):
+    directory = os.path.join(self.dir, "gtfs")
+    interrogate = main.Interrogate(["--config", self.write_config(),
+      "--gtfs", directory])
+    try:
+      result = interrogate._interrogate()
+    finally:
+      interrogate._close()
+    self.check_result(result)
+    def read(name):
+      with open(os.path.join(directory, name), "rb") as file:
+        return list(csv.DictReader(file))
+    self.assertEquals(sorted(self.network.get_route_names()),
+      sorted(r["route_short_name"] for r in read("routes.txt")))
+    # Every trip is there once and calls at stops with positions.
+    identities = set()
+    for route_info in result.routes.values():
+      for journey in route_info.get_journeys():
+        identities.add(journey.get_identity())
+    self.assertEquals(len(identities), len(read("trips.txt")))
+    stops = dict((s["stop_id"], s) for s in read("stops.txt"))
+    for stop_time in read("stop_times.txt"):
+      self.assertNotEquals("", stops[stop_time["stop_id"]]["stop_lat"])
+
+  def test_columnar(self):
+    directory = os.path.join(self.dir, "columnar")
+    interrogate = main.Interrogate(["--config", self.write_config(),
+      "--columnar", directory])
+    try:
+      result = interrogate._interrogate()
+      interrogate._output_result("01.10.14", result)
+    finally:
+      interrogate._close()
+    timetable = columnar.read(os.path.join(directory, "01.10.14"))
+    try:
+      self.assertEquals(sorted(self.network.get_route_names()),
+        timetable.routes)
+      # Every trip is there once with the times of its journey.
+      journeys = {}
+      for route_info in result.routes.values():
+        for journey in route_info.get_journeys():
+          journeys[journey.get_identity()] = journey
+      self.assertEquals(len(journeys), timetable.get_trip_count())
+      for trip in range(0, timetable.get_trip_count()):
+        stops = [(timetable.stops[stop], timetable.to_timestamp(arrival),
+            timetable.to_timestamp(departure))
+          for (stop, arrival, departure) in timetable.get_trip_stop_times(trip)]
+        journey = journeys[(timetable.routes[timetable.get_trip_route(trip)],
+          stops[0][0], stops[0][2], stops[-1][0], stops[-1][1])]
+        self.assertEquals([(s.get_name(), s.get_arrival(), s.get_departure())
+          for s in journey.get_stops()], stops)
+      # The trips of the network run far fewer sub-routes, and the timetable
+      # has the same ones as the result.
+      sub_routes = set()
+      for route_info in result.routes.values():
+        sub_routes.update(route_info.get_sub_routes().keys())
+      self.assertEquals(len(sub_routes), timetable.get_sub_route_count())
+      self.assertTrue(len(sub_routes) < timetable.get_trip_count() / 4)
+    finally:
+      timetable.close()
+
+  def test_interrogate_dates(self):
+    interrogate = main.Interrogate(["--config",
+      self.write_config(dates="30.09.14-02.10.14")])
+    try:
+      results = interrogate._interrogate_dates()
+    finally:
+      interrogate._close()
+    self.assertEquals(["30.09.14", "01.10.14", "02.10.14"], results.keys())
+    for (date, result) in results.items():
+      self.check_result(result, date)
+      # Each result only has the journeys of its own date.
+      for route_info in result.routes.values():
+        for journey in route_info.get_journeys():
+          departure = journey.get_stops()[0].get_departure()
+          self.assertEquals(date, clock.Timestamp.to_date(departure))
+    # The stops are the same every day and were shared between the dates.
+    stops = [result.get_stops() for result in results.values()]
+    for (name, info) in stops[0].items():
+      self.assertTrue(info is stops[1][name])
+      self.assertTrue(info is stops[2][name])
+
+  def test_delta(self):
+    def run(date, **settings):
+      config_file = self.write_config(date=date, delta=True, **settings)
+      interrogate = main.Interrogate(["--config", config_file])
+      try:
+        result = interrogate._interrogate()
+        request_count = interrogate.service.get_backend_request_count()
+      finally:
+        interrogate._close()
+      return (result, request_count, interrogate.date_interrogations[date].delta)
+    (first, first_count, first_delta) = run("30.09.14")
+    self.assertEquals(None, first_delta.reference_date)
+    # The next day has the same timetable so all the journeys are reused.
+    (second, second_count, second_delta) = run("01.10.14", delta_verify_rate=0.5)
+    self.check_result(second, "01.10.14")
+    self.assertEquals("30.09.14", second_delta.reference_date)
+    reused_count = second_delta.stats["reused journeys"]
+    self.assertTrue(reused_count > 0)
+    self.assertEquals(0, second_delta.stats["changed journeys"])
+    self.assertEquals(0, second_delta.stats["changed boards"])
+    self.assertTrue(0 < second_delta.stats["verified journeys"] < reused_count)
+    self.assertTrue(second_count < first_count)
+    # Journeys reused from a reused journey are moved from the original date.
+    (third, third_count, third_delta) = run("02.10.14", delta_verify_rate=0)
+    self.check_result(third, "02.10.14")
+    self.assertEquals(0, third_delta.stats["verified journeys"])
+    self.assertTrue(third_count < second_count)
+    # Once the timetable changes the boards that changed are noticed and the
+    # journeys of the new trips are fetched.
+    self.network = stub.SyntheticNetwork(routes=4, stops_per_route=6, headway=20)
+    self.server.set_backend(stub.SyntheticBackend(self.network, self.base_url))
+    (fourth, fourth_count, fourth_delta) = run("03.10.14")
+    self.check_result(fourth, "03.10.14")
+    self.assertTrue(fourth_delta.stats["changed boards"] > 0)
+
+  def test_resume(self):
+    class Interrupted(Exception):
+      pass
+    config_file = self.write_config(checkpoint_interval=0.001,
+      reqs_per_sec=200, max_accum=1)
+    # Cut the first run short once a checkpoint has some journeys.
+    interrogate = main.Interrogate(["--config", config_file])
+    checkpoint = interrogate.checkpoint
+    save = checkpoint.save
+    saved_journeys = []
+    def save_and_interrupt():
+      saved_journeys.extend(checkpoint.journeys)
+      save()
+      if len(saved_journeys) > 0:
+        raise Interrupted()
+    checkpoint.save = save_and_interrupt
+    try:
+      self.assertRaises(Interrupted, interrogate._interrogate)
+    finally:
+      interrogate._close()
+    def run(*args):
+      interrogate = main.Interrogate(["--config", config_file] + list(args))
+      service = interrogate.service
+      requests = []
+      fetch = service.fetch
+      def record_fetch(request):
+        requests.append(request)
+        return fetch(request)
+      service.fetch = record_fetch
+      try:
+        result = interrogate._interrogate()
+      finally:
+        interrogate._close()
+      return (result, requests)
+    (resumed, resumed_requests) = run("--resume")
+    self.check_result(resumed)
+    (again, again_requests) = run()
+    self.check_result(again)
+    # What the checkpoint had was not fetched again, not even from the http
+    # cache.
+    self.assertTrue(0 < len(resumed_requests) < len(again_requests))
+    resumed_urls = set(r.url for r in resumed_requests
+      if isinstance(r, rejseplanen.JourneyRequest))
+    for (key, journey) in saved_journeys:
+      self.assertFalse(journey.get_transit().get_journey_url() in resumed_urls)
+    self.assertEquals(sorted(again.get_stops().keys()),
+      sorted(resumed.get_stops().keys()))
+
+  def test_json(self):
+    hub = self.network.hubs[0]
+    path = "departureBoard?id=%s&date=01.10.14&time=07:00" % hub.id
+    request = rejseplanen.DeparturesRequest()
+    from_xml = request.process_response("board", self.fetch_text(path))
+    from_json = request.process_response("board",
+      self.fetch_text("%s&format=json" % path), format=rejseplanen.JSON)
+    self.assertEquals(
+      [(str(d), d.get_journey_url()) for d in from_xml.get_departures()],
+      [(str(d), d.get_journey_url()) for d in from_json.get_departures()])
+
+  def test_interrogate_json(self):
+    config_file = self.write_config(response_format="json")
+    interrogate = main.Interrogate(["--config", config_file])
+    try:
+      result = interrogate._interrogate()
+      cache = interrogate.service.http.cache
+      content_types = cache._run_as_owner(lambda: cache.db.execute(
+        "SELECT DISTINCT content_type FROM requests").fetchall())
+    finally:
+      interrogate._close()
+    self.check_result(result)
+    self.assertEquals([("application/json",)], content_types)
+
+  def test_interrogate_with_date_bug(self):
+    network = stub.SyntheticNetwork(routes=4, stops_per_route=6, headway=30,
+      last="23:59", date_bug=True)
+    self.server.set_backend(stub.SyntheticBackend(network, self.base_url))
+    config_file = self.write_config(time_range={"start": "00:00", "end": "01:00"})
+    interrogate = main.Interrogate(["--config", config_file])
+    try:
+      result = interrogate._interrogate()
+      corrections = interrogate.service.date_corrections
+    finally:
+      interrogate._close()
+    start = clock.Timestamp.from_date_time("01.10.14", "00:00")
+    end = clock.Timestamp.from_date_time("01.10.14", "01:00")
+    self.assertEquals([], result.get_unexplained_transits(start, end))
+    # The trips past midnight needed their dates corrected.
+    self.assertTrue(any(c > 0 for (c, t) in corrections.counts.values()))
+
+  # Runs an interrogation of a network with long routes, where trips pass
+  # through the hubs without starting or ending within the time range, and
+  # returns the interrogation, its result, and the pipelines it ran.
+  def interrogate_long_routes(self, **settings):
+    self.network = stub.SyntheticNetwork(routes=4, stops_per_route=20, headway=10)
+    self.server.set_backend(stub.SyntheticBackend(self.network, self.base_url))
+    config_file = self.write_config(
+      time_range={"start": "07:00", "end": "07:10"}, **settings)
+    interrogate = main.Interrogate(["--config", config_file])
+    pipelines = []
+    def new_pipeline(context, start, end):
+      pipeline = original_pipeline(context, start, end)
+      pipelines.append(pipeline)
+      return pipeline
+    original_pipeline = main.Pipeline
+    main.Pipeline = new_pipeline
+    try:
+      result = interrogate._interrogate()
+    finally:
+      main.Pipeline = original_pipeline
+      interrogate._close()
+    return (interrogate, result, pipelines)
+
+  def test_interrogate_several_turns(self):
+    (interrogate, result, pipelines) = self.interrogate_long_routes()
+    start = clock.Timestamp.from_date_time("01.10.14", "07:00")
+    end = clock.Timestamp.from_date_time("01.10.14", "07:10")
+    self.assertEquals([], result.get_unexplained_transits(start, end))
+    # The later turns reused what the first one resolved.
+    self.assertTrue(len(pipelines) > 1)
+    self.assertTrue(pipelines[0].known_journeys is pipelines[-1].known_journeys)
+    self.assertEquals(set(result.get_stops().keys()),
+      set(interrogate.known_stops.keys()))
+    # Only departure boards were expanded, back from the start of the range.
+    board_starts = interrogate.date_interrogations["01.10.14"].board_starts
+    self.assertTrue(len(board_starts) > 0)
+    for ((type, name), board_start) in board_starts.items():
+      self.assertEquals(rejseplanen.DEPARTURES, type)
+      self.assertTrue(board_start < start)
+
+  def test_interrogate_without_expansion_budget(self):
+    (interrogate, result, pipelines) = self.interrogate_long_routes(
+      expansion_budget=0)
+    start = clock.Timestamp.from_date_time("01.10.14", "07:00")
+    end = clock.Timestamp.from_date_time("01.10.14", "07:10")
+    self.assertEquals(1, len(pipelines))
+    unexplained = result.get_unexplained_transits(start, end)
+    self.assertTrue(len(unexplained) > 0)
+    # The explanation index agrees with the result.
+    def get_keys(transits):
+      return sorted((t.get_type(),) + t.get_unique_key() for t in transits)
+    self.assertEquals(get_keys(unexplained), get_keys(
+      interrogate.explanations.get_unexplained_transits(start, end)))
+
+  def test_interrogate_board_windows(self):
+    config_file = self.write_config(board_windows=4,
+      time_range={"start": "05:00", "end": "12:00"})
+    interrogate = main.Interrogate(["--config", config_file])
+    try:
+      result = interrogate._interrogate()
+    finally:
+      interrogate._close()
+    self.assertEquals(sorted(self.network.get_route_names()),
+      sorted(result.routes.keys()))
+    start = clock.Timestamp.from_date_time("01.10.14", "05:00")
+    end = clock.Timestamp.from_date_time("01.10.14", "12:00")
+    self.assertEquals([], result.get_unexplained_transits(start, end))
+    self.assertTrue(len(interrogate.window_planner.spans) > 0)
+
+  def test_rerun_with_wider_range(self):
+    def run(start, end):
+      config_file = self.write_config(time_range={"start": start, "end": end})
+      interrogate = main.Interrogate(["--config", config_file])
+      service = interrogate.service
+      windows = set()
+      get_transits = service.get_transits
+      def record_transits(type, id, timestamp):
+        windows.add((type, id, timestamp))
+        return get_transits(type, id, timestamp)
+      service.get_transits = record_transits
+      try:
+        result = interrogate._interrogate()
+        request_count = service.get_backend_request_count()
+      finally:
+        interrogate._close()
+      return (result, request_count, windows)
+    (first, first_count, first_windows) = run("07:00", "09:00")
+    (wider, wider_count, wider_windows) = run("06:00", "10:00")
+    self.assertTrue(wider_count > 0)
+    start = clock.Timestamp.from_date_time("01.10.14", "06:00")
+    end = clock.Timestamp.from_date_time("01.10.14", "10:00")
+    self.assertEquals([], wider.get_unexplained_transits(start, end))
+    # The windows of the first run were loaded again rather than fetching new
+    # ones over the same time.
+    self.assertTrue(first_windows.issubset(wider_windows))
+    (again, again_count, again_windows) = run("06:00", "10:00")
+    self.assertEquals(0, again_count)
+    self.assertTrue(again_windows.issubset(wider_windows))
+
+  def test_interrogate_bus_modes(self):
+    network = stub.SyntheticNetwork(routes=4, stops_per_route=6, headway=30,
+      train_routes=2)
+    self.network = network
+    self.server.set_backend(stub.SyntheticBackend(network, self.base_url))
+    interrogate = main.Interrogate(["--config", self.write_config()])
+    try:
+      result = interrogate._interrogate()
+      cache = interrogate.service.http.cache
+      urls = cache._run_as_owner(lambda: [url for (url,) in cache.db.execute(
+        "SELECT url FROM requests WHERE url LIKE '%Board%'").fetchall()])
+    finally:
+      interrogate._close()
+    self.check_result(result)
+    # The bus whitelist kept the trains off the boards.
+    self.assertTrue(len(urls) > 0)
+    for url in urls:
+      self.assertTrue("useTog=0" in url)
+    self.assertEquals([], sorted(interrogate.routes_ignored))
+
+  def test_sharded_interrogate(self):
+    network = stub.SyntheticNetwork(routes=9, stops_per_route=6, headway=30)
+    self.network = network
+    self.server.set_backend(stub.SyntheticBackend(network, self.base_url))
+    config_file = self.write_config(shards=3)
+    interrogate = main.Interrogate(["--config", config_file])
+    results = interrogate._run_coordinator()
+    self.assertEquals(["01.10.14"], results.keys())
+    result = results["01.10.14"]
+    self.check_result(result)
+    self.assertEquals(sorted(network.get_route_names()),
+      sorted(interrogate.routes_processed))
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=0)
+  unittest.main(testRunner=runner)